@@ -0,0 +1,300 @@
+"""
+Asyncio (ASGI) version of the ingestion endpoint.
+
+Same request and response contract as the Flask app in main.py, but Vision,
+Gemini and Firestore are called through their async clients, so a single
+instance can keep many analyses in flight instead of one per gunicorn
+thread. MAX_CONCURRENT_MESSAGES caps how many messages are processed at once.
+
+Run with:
+    uvicorn asgi_main:app --host 0.0.0.0 --port $PORT
+"""
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from utils.clients import (
+    get_bigquery_client, get_async_firestore_client, get_genai_client, warm_up, warm_up_vision_async,
+)
+from utils.bigquery_schema import table_id
+from utils.log_sampling import configure_logging, log_sampled
+from utils.counting import get_counting_backend, COUNTING_BACKEND
+from utils.gemini_segmentation import analyze_video_async, analysis_prompt_cache, GEMINI_MODEL
+from utils.prefilter import DECISION_SKIP, motion_energy, zone_risk
+from utils.sampling import DEFAULT_PROFILE
+from utils.early_incidents import AsyncEarlyIncidentWriter, EARLY_INCIDENTS_ENABLED, discarded_on_failure_async
+from utils.message_records import InvalidMessageError, decode_push_envelope, validate_message
+from utils.pipeline import (
+    FACE_DETECTION_TIMEOUT, VIDEO_ANALYSIS_TIMEOUT, MOTION_ENERGY_TIMEOUT, analysis_options, gate_on_prefilter,
+    route_video, prefilter_decision, faces_from, already_processed, recorded_analysis, analysis_record,
+    active_incidents_query, incident_types_of, indexed_active_types, build_message_results, require_analysis,
+    current_active_types,
+)
+from utils.firestore_persistence import persist_message_results_async
+from utils.bigquery_sink import BigQuerySink
+from utils.active_incidents import ActiveIncidentIndex, ACTIVE_INCIDENT_INDEX_ENABLED
+from utils.metrics import stage_timer, track_message, render_metrics
+from utils.idempotency import MessageLedger, IDEMPOTENCY_ENABLED, STAGE_ANALYSIS, STAGE_FIRESTORE, STAGE_BIGQUERY
+
+# Configure logging (LOG_FORMAT=json for structured logs)
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# For local development using a service account file
+service_account_path = "config/service_account.json"
+if os.path.exists(service_account_path):
+    logger.info(f"Using service account from: {service_account_path}")
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = service_account_path
+
+MAX_CONCURRENT_MESSAGES = int(os.environ.get("MAX_CONCURRENT_MESSAGES", "128"))
+
+message_ledger = MessageLedger()
+# The BigQuery stage is recorded from the sink's flushing thread once a row is inserted
+bigquery_sink = BigQuerySink(
+    table_id, on_inserted=lambda ledger_keys: message_ledger.record_stage_many(ledger_keys, STAGE_BIGQUERY),
+)
+active_incident_index = ActiveIncidentIndex() if ACTIVE_INCIDENT_INDEX_ENABLED else None
+
+# Created on startup so it belongs to the server's event loop
+message_semaphore = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global message_semaphore
+    message_semaphore = asyncio.Semaphore(MAX_CONCURRENT_MESSAGES)
+    warm_up(
+        lambda: get_bigquery_client().get_table(table_id),
+        get_genai_client,
+        analysis_prompt_cache.refresh,
+        *([active_incident_index.wait_ready] if active_incident_index is not None else []),
+    )
+    if COUNTING_BACKEND == "vision":
+        # Kept on app.state so the task isn't garbage collected before it finishes
+        app.state.vision_warm_up = asyncio.create_task(warm_up_vision_async())
+    else:
+        warm_up(lambda: get_counting_backend().warm_up())
+    logger.info(f"Async ingestion ready, up to {MAX_CONCURRENT_MESSAGES} concurrent messages")
+    yield
+    # uvicorn owns SIGTERM, so the sink is drained here rather than by a signal handler
+    await asyncio.to_thread(bigquery_sink.close)
+
+
+app = FastAPI(title="ingestion", description="Async Pub/Sub ingestion endpoint", lifespan=lifespan)
+
+
+async def _run_stage(name, coro, timeout, default):
+    """Await a stage with a timeout; fall back to default on timeout or error."""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"{name} timed out")
+    except Exception as e:
+        logger.error(f"{name} failed: {str(e)}")
+    return default
+
+
+async def _face_detection_stage(image_uri):
+    if not image_uri:
+        logger.warning("No image_uri provided, skipping face detection")
+        return 0
+    with stage_timer("detect_faces_uri") as timer:
+        faces_count_results = await get_counting_backend().count_async(image_uri)
+        if not faces_count_results.get("success", False):
+            timer.outcome = "error"
+    return faces_from(faces_count_results, image_uri)
+
+
+async def _video_analysis_stage(video_uri, model=GEMINI_MODEL, duration=None, profile=DEFAULT_PROFILE, incident_types=None,
+                                on_incident=None):
+    if not video_uri:
+        logger.warning("No video_uri provided, skipping video analysis")
+        return {}
+    with stage_timer("analyze_video"):
+        analysis_results = await analyze_video_async(
+            video_uri, model=model, duration=duration, profile=profile, incident_types=incident_types,
+            on_incident=on_incident,
+        )
+    log_sampled(logger, "Video analysis completed", video_uri=video_uri, analysis=analysis_results)
+    return analysis_results
+
+
+async def run_analysis_stages(message_data, active_types=(), on_incident=None):
+    """
+    Run face detection and video analysis, each with its own timeout.
+
+    Same contract as main.run_analysis_stages: returns (faces_count,
+    analysis_results, prefilter, routing), gating the video analysis on the
+    pre-filter's decision when pipeline.gate_on_prefilter says so, and
+    routing it to a model tier. A timed out stage is cancelled with its task;
+    analysis_results is None when the video analysis failed or timed out.
+    """
+    image_uri = message_data.get('image_uri')
+    video_uri = message_data.get('video_uri')
+    zone_id = message_data.get('zone_id')
+    options = dict(analysis_options(message_data), on_incident=on_incident)
+    started = time.monotonic()
+
+    def analyse(model):
+        remaining = max(0.0, started + VIDEO_ANALYSIS_TIMEOUT - time.monotonic())
+        return _run_stage("Video analysis", _video_analysis_stage(video_uri, model=model, **options), remaining, None)
+
+    prefilter = None
+    routing = None
+    risk = zone_risk(active_types) if video_uri else "none"
+    if not gate_on_prefilter(message_data, risk):
+        model = GEMINI_MODEL
+        if video_uri:
+            routing = route_video(video_uri, zone_id, risk)
+            model = routing["model"]
+        faces_count, analysis_results = await asyncio.gather(
+            _run_stage("Face detection", _face_detection_stage(image_uri), FACE_DETECTION_TIMEOUT, None),
+            analyse(model),
+        )
+    else:
+        faces_count, motion = await asyncio.gather(
+            _run_stage("Face detection", _face_detection_stage(image_uri), FACE_DETECTION_TIMEOUT, None),
+            # Downloads and decodes the clip when it has to be computed, so it runs on a thread
+            _run_stage(
+                "Motion energy", asyncio.to_thread(motion_energy, message_data, timeout=MOTION_ENERGY_TIMEOUT),
+                MOTION_ENERGY_TIMEOUT, None,
+            ),
+        )
+        prefilter = prefilter_decision(video_uri, faces_count, motion, risk)
+        if prefilter["decision"] == DECISION_SKIP:
+            analysis_results = {}
+        else:
+            routing = route_video(video_uri, zone_id, risk, activity=prefilter["decision"])
+            analysis_results = await analyse(routing["model"])
+
+    log_sampled(logger, "Analysis stages finished", seconds=round(time.monotonic() - started, 2))
+    return faces_count or 0, analysis_results, prefilter, routing
+
+
+async def get_active_incident_types(zone_id):
+    """Active incident types in zone_id, from the in-memory index when it is in sync."""
+    with stage_timer("active_incident_query"):
+        active_types = indexed_active_types(active_incident_index, zone_id)
+        if active_types is not None:
+            return active_types
+        try:
+            return incident_types_of(await active_incidents_query(get_async_firestore_client(), zone_id).get())
+        except Exception as e:
+            logger.warning(f"Active incident query for {zone_id} failed: {str(e)}")
+            return set()
+
+
+async def process_message(message_data, message_id=None):
+    """Async variant of main.process_message, with the same stages and ledger."""
+    zone_id = message_data.get('zone_id') if isinstance(message_data, dict) else None
+    with track_message(zone_id, invalid_errors=(InvalidMessageError,)):
+        await _process_message(message_data, message_id)
+
+
+async def _process_message(message_data, message_id):
+    validate_message(message_data)
+    zone_id = message_data.get('zone_id')
+    log_sampled(
+        logger, "Processing message", image_uri=message_data.get('image_uri'),
+        video_uri=message_data.get('video_uri'), zone_id=zone_id,
+    )
+
+    # Looked up once per message, alongside the ledger read (see main._process_message)
+    active_types_task = asyncio.create_task(get_active_incident_types(zone_id))
+    ledger_key = message_ledger.key_for(message_id, message_data) if IDEMPOTENCY_ENABLED else None
+    completed_stages = await message_ledger.completed_stages_async(ledger_key) if ledger_key else {}
+    if already_processed(ledger_key, completed_stages):
+        active_types_task.cancel()
+        return
+    active_types = await active_types_task
+
+    early_incidents = None
+    analysis = recorded_analysis(completed_stages)
+    if analysis is None and EARLY_INCIDENTS_ENABLED and ledger_key:
+        # Incidents are written as the analysis streams in, under the ids the full write uses
+        early_incidents = AsyncEarlyIncidentWriter(
+            message_data, ledger_key, active_types, active_index=active_incident_index,
+        )
+
+    # Provisional early incidents are deleted if the message fails or is cancelled before the full write
+    async with discarded_on_failure_async(early_incidents):
+        early_aggregated = set()
+        if analysis is None:
+            # A timed out analysis is cancelled with its task, so its stream stops writing incidents
+            analysis = await run_analysis_stages(message_data, active_types=active_types, on_incident=early_incidents)
+            require_analysis(message_data, analysis[1])
+            if early_incidents is not None:
+                early_aggregated = early_incidents.aggregated
+            if ledger_key:
+                await message_ledger.record_stage_async(ledger_key, STAGE_ANALYSIS, analysis_record(*analysis))
+
+        results = build_message_results(
+            message_data, *analysis, current_active_types(active_incident_index, zone_id, active_types),
+            early_aggregated=early_aggregated,
+        )
+
+        if STAGE_FIRESTORE not in completed_stages:
+            ledger_write = None
+            if ledger_key:
+                ledger_write = (message_ledger.async_document(ledger_key), message_ledger.stage_update(STAGE_FIRESTORE))
+            with stage_timer("firestore_write"):
+                await persist_message_results_async(
+                    get_async_firestore_client(), results.incidents, results.report, results.aggregated_incidents,
+                    doc_id=ledger_key, ledger_write=ledger_write,
+                )
+
+    if STAGE_FIRESTORE not in completed_stages:
+        if active_incident_index is not None:
+            active_incident_index.mark_active(zone_id, [incident.get('type') for incident in results.aggregated_incidents])
+        if early_incidents is not None:
+            early_incidents.record_report(results.incidents)
+
+    with stage_timer("bigquery_enqueue"):
+        bigquery_sink.add_rows(results.rows, row_ids=[ledger_key] if ledger_key else None)
+
+
+@app.post("/")
+async def handle_pubsub_message(request: Request):
+    """Handle incoming Pub/Sub messages."""
+    try:
+        envelope = await request.json()
+
+        try:
+            with stage_timer("decode"):
+                message_data, message_id = decode_push_envelope(envelope)
+            log_sampled(logger, "Received message", message_id=message_id, payload=message_data)
+            async with message_semaphore:
+                await process_message(message_data, message_id=message_id)
+        except InvalidMessageError as e:
+            logger.error(str(e))
+            # Don't retry - this is a permanent failure
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        # Return success status - Pub/Sub requires 2xx for acknowledgement
+        log_sampled(logger, "Message processed successfully")
+        return JSONResponse({"success": True, "message": "Message processed successfully"}, status_code=200)
+
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}")
+        # Return 500 error - Pub/Sub will retry the message
+        return JSONResponse({
+            "success": False,
+            "error": str(e),
+            "retry": True  # Indicate this should be retried by Pub/Sub
+        }, status_code=500)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics for the ingestion pipeline."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint for Cloud Run."""
+    return {"status": "healthy"}
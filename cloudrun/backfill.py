@@ -0,0 +1,394 @@
+"""
+Offline backfill of video analyses through Gemini batch prediction.
+
+Lists the clips under GCS prefixes (by default the <Zone>/video/ layout the
+dashboard's zone playlists read), submits them as Vertex batch prediction
+jobs with the live analysis prompt and response schema, waits for the jobs,
+and bulk-loads the results into the 'incidents' and 'analysis_reports'
+collections and vision_ml_table. Face counts for the clips' images come from
+offline Vision jobs started alongside. Batch jobs are cheaper than online
+calls and run on their own quota, so a backfill doesn't starve live ingestion.
+
+Progress is checkpointed to <work-dir>/checkpoint.json; re-running the same
+command resumes where the last run stopped:
+    python backfill.py --bucket my-bucket --zone "Main Stage" --work-dir gs://my-bucket/backfill/run-1
+"""
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import argparse
+import datetime
+
+service_account_path = "config/service_account.json"
+if os.path.exists(service_account_path):
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", service_account_path)
+
+from utils.clients import get_bigquery_client, get_firestore_client, get_genai_client, get_storage_client
+from utils.bigquery_schema import table_id
+from utils.gemini_segmentation import GEMINI_MODEL, build_analysis_prompt
+from utils.analysis_schema import build_analysis_schema, parse_analysis, response_schema_dict
+from utils.incident_profiles import incident_types_for
+from utils.message_records import build_incidents, build_analysis_report, calculate_bottle_neck_index, build_vision_row
+from utils.firestore_persistence import persist_message_results, flush_bulk_writer
+from utils.idempotency import MessageLedger
+from utils.sampling import MEDIA_RESOLUTIONS, sampling_profile_for
+from utils.vision_ml import start_face_detection_job, face_detection_jobs_done, read_face_detection_results
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = (".mp4",)
+TERMINAL_JOB_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+LOADABLE_JOB_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+# Backfilled footage is past; its incidents mustn't show up as active alerts
+BACKFILL_INCIDENT_STATUS = "resolved"
+
+
+def _split_gcs_uri(uri):
+    bucket_name, _, path = uri[len("gs://"):].partition("/")
+    return bucket_name, path
+
+
+def zone_prefix(zone):
+    """The GCS prefix of a zone's clips, as the dashboard builds it."""
+    return re.sub(r"\s+", "_", zone) + "/video/"
+
+
+class Checkpoint:
+    """
+    Backfill progress, stored as JSON in GCS next to the batch job files.
+
+    Holds the clips of each chunk, the batch job submitted for it, the job's
+    last known state, the face detection jobs for its images, and whether
+    its results have been loaded.
+    """
+
+    def __init__(self, work_dir):
+        self.bucket_name, prefix = _split_gcs_uri(work_dir.rstrip("/"))
+        self.prefix = prefix
+        self.state = {"chunks": []}
+
+    @property
+    def blob(self):
+        return get_storage_client().bucket(self.bucket_name).blob(f"{self.prefix}/checkpoint.json")
+
+    def load(self):
+        if self.blob.exists():
+            self.state = json.loads(self.blob.download_as_text())
+            logger.info(f"Resuming from gs://{self.bucket_name}/{self.prefix}/checkpoint.json")
+        return self
+
+    def save(self):
+        self.blob.upload_from_string(json.dumps(self.state, indent=1), content_type="application/json")
+
+    @property
+    def chunks(self):
+        return self.state["chunks"]
+
+
+def _clip_message(bucket_name, blob, zone_id):
+    """Message-shaped record for a clip, filled from the object's custom metadata where present."""
+    metadata = blob.metadata or {}
+
+    def _float(name):
+        try:
+            return float(metadata[name]) if metadata.get(name) is not None else None
+        except ValueError:
+            return None
+
+    return {
+        "video_uri": f"gs://{bucket_name}/{blob.name}",
+        "video_id": metadata.get("video_id") or os.path.splitext(os.path.basename(blob.name))[0],
+        "image_uri": metadata.get("image_uri"),
+        "zone_id": metadata.get("zone_id") or zone_id,
+        "camera_id": metadata.get("camera_id") or "backfill",
+        "timestamp": metadata.get("timestamp") or blob.time_created.isoformat(),
+        "location_lat": _float("location_lat"),
+        "location_long": _float("location_long"),
+    }
+
+
+def list_clips(bucket_name, prefixes):
+    """Message records for every clip under prefixes, a {prefix: zone_id} dict."""
+    clips = []
+    for prefix, zone_id in prefixes.items():
+        for blob in get_storage_client().list_blobs(bucket_name, prefix=prefix):
+            if blob.name.lower().endswith(VIDEO_EXTENSIONS):
+                clips.append(_clip_message(bucket_name, blob, zone_id))
+        logger.info(f"Found {len(clips)} clips so far after gs://{bucket_name}/{prefix}")
+    return clips
+
+
+def build_request(clip):
+    """One batch prediction input line analysing clip, as online analysis would."""
+    profile = sampling_profile_for(clip.get("zone_id"), clip.get("camera_id"))
+    incident_types = incident_types_for(clip.get("zone_id"))
+    video_part = {"fileData": {"fileUri": clip["video_uri"], "mimeType": "video/mp4"}}
+    if profile.fps is not None:
+        video_part["videoMetadata"] = {"fps": profile.fps}
+    generation_config = {
+        "responseMimeType": "application/json",
+        "responseSchema": response_schema_dict(build_analysis_schema(incident_types)),
+    }
+    if profile.media_resolution:
+        generation_config["mediaResolution"] = MEDIA_RESOLUTIONS[profile.media_resolution]
+    return {
+        "request": {
+            "contents": [{"role": "user", "parts": [video_part, {"text": build_analysis_prompt(incident_types)}]}],
+            "generationConfig": generation_config,
+        }
+    }
+
+
+def prepare(checkpoint, bucket_name, prefixes, chunk_size, limit=None):
+    """List the clips and write one batch input file per chunk, unless a previous run did."""
+    if checkpoint.chunks:
+        return
+    clips = list_clips(bucket_name, prefixes)
+    if limit:
+        clips = clips[:limit]
+    bucket = get_storage_client().bucket(checkpoint.bucket_name)
+    for index in range(0, len(clips), chunk_size):
+        chunk_clips = clips[index:index + chunk_size]
+        input_path = f"{checkpoint.prefix}/input/chunk-{index // chunk_size:04d}.jsonl"
+        body = "\n".join(json.dumps(build_request(clip)) for clip in chunk_clips)
+        bucket.blob(input_path).upload_from_string(body, content_type="application/jsonl")
+        checkpoint.chunks.append({
+            "input_uri": f"gs://{checkpoint.bucket_name}/{input_path}",
+            "output_uri": f"gs://{checkpoint.bucket_name}/{checkpoint.prefix}/output/chunk-{index // chunk_size:04d}",
+            "clips": chunk_clips,
+            "job": None,
+            "state": None,
+            "loaded": False,
+            "failed": [],
+        })
+    checkpoint.save()
+    logger.info(f"Prepared {len(clips)} clips in {len(checkpoint.chunks)} chunks")
+
+
+def submit_faces(checkpoint):
+    """Start offline face detection of the images of every chunk that doesn't have it yet."""
+    for chunk in checkpoint.chunks:
+        if chunk.get("faces_jobs") is not None or chunk["loaded"]:
+            continue
+        image_uris = [clip["image_uri"] for clip in chunk["clips"] if clip.get("image_uri")]
+        chunk["faces_output_uri"] = f"{chunk['output_uri']}-faces"
+        chunk["faces_jobs"] = start_face_detection_job(image_uris, chunk["faces_output_uri"]) if image_uris else []
+        checkpoint.save()
+
+
+def submit(checkpoint, model):
+    """Submit a batch prediction job for every chunk that doesn't have one yet."""
+    from google.genai.types import CreateBatchJobConfig
+    for index, chunk in enumerate(checkpoint.chunks):
+        if chunk["job"] is not None:
+            continue
+        job = get_genai_client().batches.create(
+            model=model,
+            src=chunk["input_uri"],
+            config=CreateBatchJobConfig(
+                dest=chunk["output_uri"],
+                display_name=f"backfill-{checkpoint.prefix.replace('/', '-')}-{index:04d}",
+            ),
+        )
+        chunk["job"] = job.name
+        checkpoint.save()
+        logger.info(f"Submitted {job.name} for {len(chunk['clips'])} clips")
+
+
+def _response_text(response):
+    candidates = (response or {}).get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts) or None
+
+
+def _read_predictions(output_uri):
+    """Yield (video_uri, response text or None, error) for every prediction under output_uri."""
+    bucket_name, prefix = _split_gcs_uri(output_uri)
+    for blob in get_storage_client().list_blobs(bucket_name, prefix=prefix.rstrip("/") + "/"):
+        if not blob.name.endswith(".jsonl"):
+            continue
+        for line in blob.download_as_text().splitlines():
+            if not line.strip():
+                continue
+            prediction = json.loads(line)
+            parts = prediction["request"]["contents"][0]["parts"]
+            video_uri = next(part["fileData"]["fileUri"] for part in parts if "fileData" in part)
+            yield video_uri, _response_text(prediction.get("response")), prediction.get("status")
+
+
+def load_rows(checkpoint, chunk, rows):
+    """
+    Append a chunk's rows to vision_ml_table in one load job, once.
+
+    A load job rather than streaming inserts: free, and one job per chunk.
+    The job id is saved in the checkpoint before the job starts, so a run
+    resuming after a crash finds the job and waits for it instead of
+    appending the rows again. Only a job that failed, which loaded nothing,
+    is replaced by a new one.
+    """
+    from google.cloud import bigquery
+    from google.api_core.exceptions import NotFound
+    client = get_bigquery_client()
+    if chunk.get("load_job"):
+        try:
+            client.get_job(chunk["load_job"]).result()
+            logger.info(f"Rows of {chunk['job']} were already loaded by {chunk['load_job']}")
+            return
+        except NotFound:
+            logger.info(f"Load job {chunk['load_job']} was never started, starting it")
+        except Exception as e:
+            logger.warning(f"Load job {chunk['load_job']} failed, starting another: {str(e)}")
+            chunk["load_job"] = None
+
+    if not chunk.get("load_job"):
+        chunk["load_job"] = f"backfill-{uuid.uuid4().hex}"
+        checkpoint.save()
+    client.load_table_from_json(
+        rows, table_id, job_id=chunk["load_job"],
+        job_config=bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND),
+    ).result()
+
+
+def load_chunk(checkpoint, chunk, ledger):
+    """Write the analyses of a finished chunk to Firestore and BigQuery."""
+    clips = {clip["video_uri"]: clip for clip in chunk["clips"]}
+    faces = read_face_detection_results(chunk["faces_output_uri"]) if chunk.get("faces_jobs") else {}
+    rows = []
+    loaded = set()
+    for video_uri, response_text, status in _read_predictions(chunk["output_uri"]):
+        clip = clips.get(video_uri)
+        if clip is None:
+            continue
+        if status or response_text is None:
+            logger.error(f"No analysis for {video_uri}: {status or 'empty response'}")
+            continue
+        try:
+            schema = build_analysis_schema(incident_types_for(clip.get("zone_id")))
+            analysis_results = parse_analysis(schema, response_text).model_dump()
+        except Exception as e:
+            logger.error(f"Unparseable analysis for {video_uri}: {str(e)}")
+            continue
+
+        incidents = [
+            dict(incident, status=BACKFILL_INCIDENT_STATUS) for incident in build_incidents(clip, analysis_results)
+        ]
+        report = build_analysis_report(clip, analysis_results)
+        report["backfill_job"] = chunk["job"]
+        # Historical incidents aren't active, so nothing goes to 'aggregrated_incidents';
+        # ids derived from the clip make a re-run overwrite instead of duplicating.
+        # Queued only: the chunk's writes are committed together by the flush below
+        persist_message_results(
+            get_firestore_client(), incidents, report, [],
+            doc_id=ledger.key_for(None, clip), mode="bulk", wait=False,
+        )
+        face_result = faces.get(clip.get("image_uri")) or {}
+        faces_count = face_result.get("total_faces") if face_result.get("success") else None
+        rows.append(build_vision_row(clip, faces_count, calculate_bottle_neck_index(report)))
+        loaded.add(video_uri)
+    flush_bulk_writer()
+
+    if rows:
+        load_rows(checkpoint, chunk, rows)
+
+    chunk["failed"] = sorted(set(clips) - loaded)
+    chunk["loaded"] = True
+    checkpoint.save()
+    logger.info(f"Loaded {len(rows)} analyses from {chunk['job']}, {len(chunk['failed'])} failed")
+
+
+def _faces_ready(checkpoint, chunk):
+    """Whether a chunk's face detection jobs, if any, have finished."""
+    if not chunk.get("faces_jobs") or chunk.get("faces_done"):
+        return True
+    try:
+        if not face_detection_jobs_done(chunk["faces_jobs"]):
+            return False
+    except Exception as e:
+        # Load the analyses anyway; clips without a face count get none
+        logger.error(f"Face detection for {chunk['output_uri']} failed: {str(e)}")
+    chunk["faces_done"] = True
+    checkpoint.save()
+    return True
+
+
+def wait_and_load(checkpoint, poll_interval):
+    """Poll the submitted jobs, loading each chunk as soon as its job finishes."""
+    ledger = MessageLedger()
+    while True:
+        pending = 0
+        for chunk in checkpoint.chunks:
+            if chunk["loaded"] or chunk["job"] is None:
+                continue
+            if chunk["state"] not in TERMINAL_JOB_STATES:
+                job = get_genai_client().batches.get(name=chunk["job"])
+                state = getattr(job.state, "name", str(job.state))
+                if state != chunk["state"]:
+                    logger.info(f"{chunk['job']}: {state}")
+                    chunk["state"] = state
+                    checkpoint.save()
+            if chunk["state"] in LOADABLE_JOB_STATES:
+                if not _faces_ready(checkpoint, chunk):
+                    pending += 1
+                    continue
+                load_chunk(checkpoint, chunk, ledger)
+            elif chunk["state"] in TERMINAL_JOB_STATES:
+                logger.error(f"{chunk['job']} ended in {chunk['state']}, its clips were not analysed")
+                chunk["failed"] = [clip["video_uri"] for clip in chunk["clips"]]
+                chunk["loaded"] = True
+                checkpoint.save()
+            else:
+                pending += 1
+        if not pending:
+            return
+        time.sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", required=True, help="Bucket holding the clips")
+    parser.add_argument("--zone", action="append", default=[], help="Zone whose <Zone>/video/ clips to backfill")
+    parser.add_argument("--prefix", action="append", default=[], help="Other prefix to backfill; its first path segment is the zone")
+    parser.add_argument("--work-dir", required=True, help="gs:// directory for job input, output and the checkpoint")
+    parser.add_argument("--model", default=GEMINI_MODEL)
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Clips per batch job")
+    parser.add_argument("--limit", type=int, help="Only backfill the first N clips")
+    parser.add_argument("--poll-interval", type=float, default=60)
+    parser.add_argument("--no-wait", action="store_true", help="Submit the jobs and exit; re-run to load the results")
+    parser.add_argument("--no-faces", action="store_true", help="Don't run face detection on the clips' images")
+    args = parser.parse_args()
+
+    if not args.work_dir.startswith("gs://"):
+        parser.error("--work-dir must be a gs:// URI")
+    prefixes = {zone_prefix(zone): zone for zone in args.zone}
+    prefixes.update({prefix: prefix.split("/", 1)[0].replace("_", " ") for prefix in args.prefix})
+    if not prefixes:
+        parser.error("Give at least one --zone or --prefix")
+
+    started = datetime.datetime.now()
+    checkpoint = Checkpoint(args.work_dir).load()
+    prepare(checkpoint, args.bucket, prefixes, args.chunk_size, args.limit)
+    if not args.no_faces:
+        submit_faces(checkpoint)
+    submit(checkpoint, args.model)
+    if not args.no_wait:
+        wait_and_load(checkpoint, args.poll_interval)
+
+    failed = sum(len(chunk["failed"]) for chunk in checkpoint.chunks)
+    loaded = sum(len(chunk["clips"]) for chunk in checkpoint.chunks if chunk["loaded"]) - failed
+    logger.info(f"Backfill: {loaded} clips loaded, {failed} failed, in {datetime.datetime.now() - started}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of the face counting backends against each other.
+
+Runs every image through each backend (see utils.counting) and reports the
+latency percentiles of each, plus how far each backend's face counts are
+from the Vision API's, to judge whether a local backend is accurate enough
+to replace it:
+    python benchmark_counting.py gs://bucket/Main_Stage/image/a.jpg gs://bucket/...
+    python benchmark_counting.py --prefix gs://bucket/Main_Stage/image/ --limit 50
+"""
+import os
+import time
+import argparse
+import statistics
+
+service_account_path = "config/service_account.json"
+if os.path.exists(service_account_path):
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", service_account_path)
+
+from utils.clients import get_storage_client
+from utils.counting import BACKENDS, create_backend
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def list_images(prefix, limit):
+    bucket_name, _, path = prefix[len("gs://"):].partition("/")
+    uris = []
+    for blob in get_storage_client().list_blobs(bucket_name, prefix=path):
+        if blob.name.lower().endswith(IMAGE_EXTENSIONS):
+            uris.append(f"gs://{bucket_name}/{blob.name}")
+            if len(uris) >= limit:
+                break
+    return uris
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_backend(backend, uris):
+    """Return ([latency seconds], [face count or None]) for backend over uris."""
+    backend.warm_up()
+    latencies, counts = [], []
+    for uri in uris:
+        started = time.monotonic()
+        result = backend.count(uri)
+        latencies.append(time.monotonic() - started)
+        counts.append(result.get("total_faces") if result.get("success") else None)
+    return latencies, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("uris", nargs="*", help="Images to count")
+    parser.add_argument("--prefix", help="gs:// prefix to take images from")
+    parser.add_argument("--limit", type=int, default=20, help="Images to take from --prefix")
+    parser.add_argument("--backend", action="append", choices=sorted(BACKENDS), help="Backends to run (default: all)")
+    args = parser.parse_args()
+
+    uris = list(args.uris)
+    if args.prefix:
+        uris.extend(list_images(args.prefix, args.limit))
+    if not uris:
+        parser.error("Give image URIs or --prefix")
+    names = args.backend or sorted(BACKENDS)
+
+    results = {name: run_backend(create_backend(name), uris) for name in names}
+    reference = results.get("vision", (None, None))[1]
+
+    print(f"{len(uris)} images")
+    print(
+        f"{'backend':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'mean (ms)':>10} {'failed':>7} {'faces':>7} "
+        f"{'|diff| vs vision':>17} {'same count':>11}"
+    )
+    for name in names:
+        latencies, counts = results[name]
+        failed = sum(count is None for count in counts)
+        diff, same = "-", "-"
+        if reference is not None and name != "vision":
+            pairs = [(a, b) for a, b in zip(counts, reference) if a is not None and b is not None]
+            if pairs:
+                diff = f"{statistics.mean(abs(a - b) for a, b in pairs):.2f}"
+                same = f"{sum(a == b for a, b in pairs) / len(pairs):.0%}"
+        print(
+            f"{name:>10} {percentile(latencies, 0.5) * 1e3:>10.1f} {percentile(latencies, 0.95) * 1e3:>10.1f} "
+            f"{statistics.mean(latencies) * 1e3:>10.1f} {failed:>7} {sum(count or 0 for count in counts):>7} "
+            f"{diff:>17} {same:>11}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,15 @@ import json
 import base64
 import logging
 from flask import Flask, request, jsonify
-from google.cloud import vision
 from google.cloud.vision_v1 import types
 from google.cloud import pubsub_v1
 from google.cloud import bigquery
+from utils.clients import warm_up, warm_up_vision
+from utils.vision_ml import detect_faces_uri, detect_faces_batch, FACE_DETAIL_ENABLED
+from utils.log_sampling import configure_logging, log_sampled
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (LOG_FORMAT=json for structured logs)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
@@ -18,62 +20,8 @@ app = Flask(__name__)
 # Set up Google Cloud credentials
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "config/service_account.json"
 
-def detect_faces_uri(uri):
-    """Detects faces in the file located in Google Cloud Storage or the web."""
-    
-    try:
-        client = vision.ImageAnnotatorClient()
-        image = vision.Image()
-        image.source.image_uri = uri
-
-        response = client.face_detection(image=image)
-        faces = response.face_annotations
-
-        # Names of likelihood from google.cloud.vision.enums
-        likelihood_name = (
-            "UNKNOWN",
-            "VERY_UNLIKELY",
-            "UNLIKELY",
-            "POSSIBLE",
-            "LIKELY",
-            "VERY_LIKELY",
-        )
-
-        logger.info(f"Total faces detected: {len(faces)}")
-
-        face_results = []
-        for face in faces:
-            face_data = {
-                "anger": likelihood_name[face.anger_likelihood],
-                "joy": likelihood_name[face.joy_likelihood],
-                "surprise": likelihood_name[face.surprise_likelihood],
-                "sorrow": likelihood_name[face.sorrow_likelihood],
-                "bounds": [
-                    {"x": vertex.x, "y": vertex.y} 
-                    for vertex in face.bounding_poly.vertices
-                ]
-            }
-            face_results.append(face_data)
-            logger.info(f"Face detected: {face_data}")
-
-        if response.error.message:
-            raise Exception(
-                f"{response.error.message}\nFor more info on error messages, check: "
-                "https://cloud.google.com/apis/design/errors"
-            )
-
-        return {
-            "success": True,
-            "total_faces": len(faces),
-            "faces": face_results
-        }
-        
-    except Exception as e:
-        logger.error(f"Error in face detection: {str(e)}")
-        return {
-            "success": False,
-            "error": str(e)
-        }
+# Connect the shared Vision client in the background so the first request doesn't pay for it
+warm_up(warm_up_vision)
 
 def process_pubsub_message(message_data):
     """Process Pub/Sub message and extract image URI."""
@@ -166,7 +114,7 @@ def handle_pubsub_message():
         client.insert_rows_json(table_id, rows)
 
         # print the data that is inserted
-        logger.info(f"Data inserted: {rows}")
+        log_sampled(logger, "Data inserted", rows=rows)
 
         # return the result
         return jsonify(result), 200
@@ -182,13 +130,27 @@ def health_check():
 
 @app.route('/detect', methods=['POST'])
 def detect_faces_direct():
-    """Direct endpoint for face detection (for testing)."""
+    """
+    Direct endpoint for face detection (for testing).
+
+    Takes {"image_uri": uri} for one image, or {"image_uris": [...]} (or a
+    list as image_uri) for several, which are sent in batched Vision
+    requests and answered as {"results": [...]} in the same order.
+    "detail": true adds the per-face list to each result.
+    """
     try:
         data = request.get_json()
-        if not data or 'image_uri' not in data:
-            return jsonify({"error": "image_uri is required"}), 400
-            
-        result = detect_faces_uri(data['image_uri'])
+        if not data or ('image_uri' not in data and 'image_uris' not in data):
+            return jsonify({"error": "image_uri or image_uris is required"}), 400
+
+        uris = data.get('image_uris', data.get('image_uri'))
+        detail = bool(data.get('detail', FACE_DETAIL_ENABLED))
+        if isinstance(uris, list):
+            if not all(isinstance(uri, str) for uri in uris):
+                return jsonify({"error": "image_uris must be a list of strings"}), 400
+            return jsonify({"results": detect_faces_batch(uris, detail=detail)}), 200
+
+        result = detect_faces_uri(uris, detail=detail)
         return jsonify(result), 200
         
     except Exception as e:
@@ -43,6 +43,10 @@ gcloud projects add-iam-policy-binding $PROJECT_ID \
   --member="serviceAccount:${SERVICE_ACCOUNT_EMAIL}" \
   --role="roles/datastore.user"
 
+# Provision the BigQuery dataset and table once per deploy rather than on every cold start
+echo -e "${YELLOW}Provisioning BigQuery dataset and table...${NC}"
+python provision.py
+
 # Build and deploy to Cloud Run
 echo -e "${YELLOW}Building and deploying to Cloud Run...${NC}"
 gcloud run deploy $SERVICE_NAME \
@@ -1,13 +1,33 @@
 import os
-import json
+import time
 import logging
-from flask import Flask, request, jsonify
-from google.cloud import bigquery, firestore
-from utils.vision_ml import detect_faces_uri
-from utils.gemini_segmentation import analyze_video, SEVERITY_MAPPING
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, Response, request, jsonify
+from utils.clients import get_bigquery_client, get_firestore_client, get_genai_client, warm_up
+from utils.bigquery_schema import table_id
+from utils.log_sampling import configure_logging, log_sampled
+from utils.counting import get_counting_backend
+from utils.gemini_segmentation import analyze_video, analysis_prompt_cache, GEMINI_MODEL
+from utils.prefilter import DECISION_SKIP, motion_energy, zone_risk
+from utils.sampling import DEFAULT_PROFILE
+from utils.early_incidents import EarlyIncidentWriter, EARLY_INCIDENTS_ENABLED, discarded_on_failure
+from utils.message_records import InvalidMessageError, decode_push_envelope, validate_message
+from utils.pipeline import (
+    FACE_DETECTION_TIMEOUT, VIDEO_ANALYSIS_TIMEOUT, MOTION_ENERGY_TIMEOUT, analysis_options, gate_on_prefilter,
+    route_video, prefilter_decision, faces_from, already_processed, recorded_analysis, analysis_record,
+    active_incidents_query, incident_types_of, indexed_active_types, build_message_results, require_analysis,
+    current_active_types,
+)
+from utils.firestore_persistence import persist_message_results
+from utils.bigquery_sink import BigQuerySink, drain_on_shutdown
+from utils.active_incidents import ActiveIncidentIndex, ACTIVE_INCIDENT_INDEX_ENABLED
+from utils.metrics import stage_timer, track_message, render_metrics
+from utils.idempotency import MessageLedger, IDEMPOTENCY_ENABLED, STAGE_ANALYSIS, STAGE_FIRESTORE, STAGE_BIGQUERY
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (LOG_FORMAT=json for structured logs)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
@@ -26,43 +46,265 @@ else:
     if os.environ.get("K_SERVICE"):
         logger.info("Running in Cloud Run with default service account")
 
-# create a bigquery client
-client = bigquery.Client()
-
-# create a table
-project_id = "qualified-acre-466511-u6"
-dataset_id = "vision_ml"
-table_name = "vision_ml_table"
-table_id = f"{project_id}.{dataset_id}.{table_name}"
-
-# Create the dataset if it doesn't exist
-dataset_ref = bigquery.DatasetReference(project_id, dataset_id)
-try:
-    client.get_dataset(dataset_ref)
-    logger.info(f"Dataset {dataset_id} already exists")
-except Exception:
-    logger.info(f"Dataset {dataset_id} not found, creating it")
-    dataset = bigquery.Dataset(dataset_ref)
-    dataset = client.create_dataset(dataset)
-    logger.info(f"Dataset {dataset_id} created")
-
-# create a schema
-schema = [
-    bigquery.SchemaField("image_uri", "STRING"),
-    bigquery.SchemaField("zone_id", "STRING"),
-    bigquery.SchemaField("video_id", "STRING"),
-    bigquery.SchemaField("timestamp", "TIMESTAMP"),
-    bigquery.SchemaField("camera_id", "STRING"),
-    bigquery.SchemaField("faces_count", "INTEGER"),
-    bigquery.SchemaField("location_lat", "FLOAT"),
-    bigquery.SchemaField("location_long", "FLOAT"),
-    bigquery.SchemaField("bottle_neck_index", "FLOAT"),
-]
-# create the table if not exists
-table = bigquery.Table(table_id, schema=schema)
-client.create_table(table, exists_ok=True)
-logger.info(f"Table {table_id} is ready")
-firestore_db = firestore.Client()
+# Schema provisioning runs once at deploy time (provision.py), and clients are
+# created lazily, so nothing here blocks on the network during a cold start.
+
+# Redeliveries resume from the first stage that didn't complete
+message_ledger = MessageLedger()
+
+# vision_ml_table rows from all request threads are micro-batched in the background;
+# a message's BigQuery stage is only recorded once its row has actually been inserted
+bigquery_sink = BigQuerySink(
+    table_id, on_inserted=lambda ledger_keys: message_ledger.record_stage_many(ledger_keys, STAGE_BIGQUERY),
+)
+drain_on_shutdown(bigquery_sink)
+
+# Active aggregated incidents per zone, kept fresh by a Firestore listener
+active_incident_index = None
+if ACTIVE_INCIDENT_INDEX_ENABLED:
+    active_incident_index = ActiveIncidentIndex()
+
+
+def _warm_up_bigquery():
+    # Opens the HTTP connection pool with a free metadata call
+    get_bigquery_client().get_table(table_id)
+
+
+# Open client channels in the background so the first message doesn't pay for them;
+# starting the listener also opens the Firestore channel, and waiting for its first
+# snapshot comes last so it doesn't hold up the other clients
+warm_up(
+    _warm_up_bigquery,
+    lambda: get_counting_backend().warm_up(),
+    get_genai_client,
+    analysis_prompt_cache.refresh,
+    *([active_incident_index.wait_ready] if active_incident_index is not None else []),
+)
+
+# Face detection and video analysis run on a shared pool and are joined before
+# the Firestore / BigQuery writes; side by side, or one after the other when
+# the pre-filter needs the face count first. Sized for gunicorn's 8 threads
+# with two stages each. A stage that times out can't be interrupted, so each
+# one passes what is left of its timeout to its client calls; that way the
+# worker it holds is free again about when the message stops waiting for it.
+STAGE_WORKERS = int(os.environ.get("STAGE_WORKERS", "16"))
+stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+
+
+def _face_detection_stage(image_uri, timeout=None):
+    """Return the number of faces in image_uri, or None if detection fails; see utils.counting."""
+    if not image_uri:
+        logger.warning("No image_uri provided, skipping face detection")
+        return 0
+    with stage_timer("detect_faces_uri") as timer:
+        faces_count_results = get_counting_backend().count(image_uri, timeout=timeout)
+        if not faces_count_results.get("success", False):
+            timer.outcome = "error"
+    return faces_from(faces_count_results, image_uri)
+
+
+def _video_analysis_stage(video_uri, model=GEMINI_MODEL, duration=None, profile=DEFAULT_PROFILE, incident_types=None,
+                          on_incident=None, cancelled=None, timeout=None):
+    """Return the Gemini analysis for video_uri, or {} if there is no video."""
+    if not video_uri:
+        logger.warning("No video_uri provided, skipping video analysis")
+        return {}
+    with stage_timer("analyze_video"):
+        analysis_results = analyze_video(
+            video_uri, model=model, duration=duration, profile=profile, incident_types=incident_types,
+            on_incident=on_incident, cancelled=cancelled, timeout=timeout,
+        )
+    log_sampled(logger, "Video analysis completed", video_uri=video_uri, analysis=analysis_results)
+    return analysis_results
+
+
+def _join_stage(name, future, deadline, default):
+    """Wait for a stage until its deadline; fall back to default on timeout or error."""
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        # A running stage can't be cancelled; its client calls time out at about the same deadline
+        future.cancel()
+        logger.error(f"{name} timed out")
+    except Exception as e:
+        logger.error(f"{name} failed: {str(e)}")
+    return default
+
+
+def _submit_stage(fn, *args, **kwargs):
+    # Each stage runs in a copy of this context so its timings keep the message's zone label
+    return stage_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def run_analysis_stages(message_data, active_types=(), on_incident=None, cancelled=None):
+    """Run face detection and video analysis of a clip in a zone with active_types incidents.
+
+    Returns a (faces_count, analysis_results, prefilter, routing) tuple.
+    The two stages run concurrently and prefilter is None, unless the
+    pre-filter gates the analysis (see pipeline.gate_on_prefilter). Then
+    face detection and motion energy run first and decide() picks whether
+    to skip the video; prefilter is that decision. A video that is analysed
+    goes to the model tier route_model() picks, and routing records that
+    choice; it is None when there was no analysis. on_incident is passed on
+    to analyze_video. Each stage has its own timeout. Face detection or
+    motion energy that fails or times out yields None, so the rest of the
+    message can still be processed; a video analysis that does yields
+    analysis_results None (see pipeline.require_analysis). When the video
+    analysis times out, cancelled (a threading.Event) is set, which stops a
+    streamed analysis and its on_incident calls.
+    """
+    image_uri = message_data.get('image_uri')
+    video_uri = message_data.get('video_uri')
+    zone_id = message_data.get('zone_id')
+    options = dict(
+        analysis_options(message_data), on_incident=on_incident,
+        cancelled=cancelled if cancelled is not None else threading.Event(),
+    )
+    started = time.monotonic()
+    faces_future = _submit_stage(_face_detection_stage, image_uri, timeout=FACE_DETECTION_TIMEOUT)
+
+    def analyse(model):
+        return _submit_stage(
+            _video_analysis_stage, video_uri, model=model,
+            timeout=max(0.0, started + VIDEO_ANALYSIS_TIMEOUT - time.monotonic()), **options,
+        )
+
+    def join_analysis(analysis_future):
+        analysis_results = _join_stage("Video analysis", analysis_future, started + VIDEO_ANALYSIS_TIMEOUT, None)
+        if not analysis_future.done():
+            options["cancelled"].set()
+        return analysis_results
+
+    prefilter = None
+    routing = None
+    risk = zone_risk(active_types) if video_uri else "none"
+    if not gate_on_prefilter(message_data, risk):
+        model = GEMINI_MODEL
+        if video_uri:
+            routing = route_video(video_uri, zone_id, risk)
+            model = routing["model"]
+        analysis_future = analyse(model)
+        faces_count = _join_stage("Face detection", faces_future, started + FACE_DETECTION_TIMEOUT, None)
+        analysis_results = join_analysis(analysis_future)
+    else:
+        motion_future = _submit_stage(motion_energy, message_data, timeout=MOTION_ENERGY_TIMEOUT)
+        faces_count = _join_stage("Face detection", faces_future, started + FACE_DETECTION_TIMEOUT, None)
+        motion = _join_stage("Motion energy", motion_future, started + MOTION_ENERGY_TIMEOUT, None)
+        prefilter = prefilter_decision(video_uri, faces_count, motion, risk)
+        if prefilter["decision"] == DECISION_SKIP:
+            analysis_results = {}
+        else:
+            routing = route_video(video_uri, zone_id, risk, activity=prefilter["decision"])
+            analysis_results = join_analysis(analyse(routing["model"]))
+
+    log_sampled(logger, "Analysis stages finished", seconds=round(time.monotonic() - started, 2))
+    return faces_count or 0, analysis_results, prefilter, routing
+
+
+def query_active_incident_types(zone_id):
+    """Query Firestore for the incident types currently active in zone_id."""
+    try:
+        return incident_types_of(active_incidents_query(get_firestore_client(), zone_id).get())
+    except Exception as e:
+        logger.warning(f"Active incident query for {zone_id} failed: {str(e)}")
+        return set()
+
+
+def get_active_incident_types(zone_id):
+    """Active incident types in zone_id, from the in-memory index when it is in sync."""
+    with stage_timer("active_incident_query"):
+        active_types = indexed_active_types(active_incident_index, zone_id)
+        return active_types if active_types is not None else query_active_incident_types(zone_id)
+
+
+def process_message(message_data, message_id=None):
+    """
+    Runs the ingestion pipeline for one decoded message.
+
+    Shared by the push endpoint and the streaming pull subscriber. Raises
+    InvalidMessageError for permanent failures; any other exception means
+    the message should be retried. Completed stages are recorded in the
+    message ledger under message_id (or the clip identity when there is no
+    id), so a retry skips work that already succeeded.
+    """
+    zone_id = message_data.get('zone_id') if isinstance(message_data, dict) else None
+    with track_message(zone_id, invalid_errors=(InvalidMessageError,)):
+        _process_message(message_data, message_id)
+
+
+def _process_message(message_data, message_id):
+    validate_message(message_data)
+    zone_id = message_data.get('zone_id')
+
+    # Log incoming request data for debugging
+    log_sampled(
+        logger, "Processing message", image_uri=message_data.get('image_uri'),
+        video_uri=message_data.get('video_uri'), zone_id=zone_id,
+    )
+
+    # Looked up once per message, alongside the ledger read; the zone's risk, the
+    # early incident writer and the aggregated incident dedup all use it
+    active_types_future = _submit_stage(get_active_incident_types, zone_id)
+    ledger_key = message_ledger.key_for(message_id, message_data) if IDEMPOTENCY_ENABLED else None
+    completed_stages = message_ledger.completed_stages(ledger_key) if ledger_key else {}
+    if already_processed(ledger_key, completed_stages):
+        active_types_future.cancel()
+        return
+    active_types = active_types_future.result()
+
+    early_incidents = None
+    analysis = recorded_analysis(completed_stages)
+    if analysis is None and EARLY_INCIDENTS_ENABLED and ledger_key:
+        # Incidents are written as the analysis streams in, under the ids the full write uses
+        early_incidents = EarlyIncidentWriter(
+            message_data, ledger_key, active_types, active_index=active_incident_index,
+        )
+
+    # The early incidents are provisional until the full write below; if the message fails first,
+    # they are deleted rather than left as alerts of an analysis that didn't complete
+    with discarded_on_failure(early_incidents):
+        early_aggregated = set()
+        if analysis is None:
+            # Set if the analysis times out, so a stream still running stops writing incidents
+            cancelled = early_incidents.cancelled if early_incidents is not None else threading.Event()
+            analysis = run_analysis_stages(
+                message_data, active_types=active_types, on_incident=early_incidents, cancelled=cancelled,
+            )
+            require_analysis(message_data, analysis[1])
+            if early_incidents is not None:
+                early_aggregated = early_incidents.aggregated
+            if ledger_key:
+                message_ledger.record_stage(ledger_key, STAGE_ANALYSIS, analysis_record(*analysis))
+
+        # For each agent, we've to check if the incident is already in active status in that zone
+        results = build_message_results(
+            message_data, *analysis, current_active_types(active_incident_index, zone_id, active_types),
+            early_aggregated=early_aggregated,
+        )
+
+        # incidents, analysis report and aggregated incidents in one commit, together
+        # with the ledger entry; ids derived from the ledger key keep a rerun from duplicating them
+        if STAGE_FIRESTORE not in completed_stages:
+            ledger_write = None
+            if ledger_key:
+                ledger_write = (message_ledger.document(ledger_key), message_ledger.stage_update(STAGE_FIRESTORE))
+            with stage_timer("firestore_write"):
+                persist_message_results(
+                    get_firestore_client(), results.incidents, results.report, results.aggregated_incidents,
+                    doc_id=ledger_key, ledger_write=ledger_write,
+                )
+
+    if STAGE_FIRESTORE not in completed_stages:
+        if active_incident_index is not None:
+            active_incident_index.mark_active(zone_id, [incident.get('type') for incident in results.aggregated_incidents])
+        if early_incidents is not None:
+            early_incidents.record_report(results.incidents)
+
+    # queue the row; the sink streams it to the table in the next batch and records
+    # the BigQuery stage once it is inserted. Until then a redelivery re-queues the
+    # row under the same insertId, which BigQuery deduplicates
+    with stage_timer("bigquery_enqueue"):
+        bigquery_sink.add_rows(results.rows, row_ids=[ledger_key] if ledger_key else None)
 
 
 @app.route('/', methods=['POST'])
@@ -71,220 +313,19 @@ def handle_pubsub_message():
     try:
         # Get the request data
         envelope = request.get_json()
-        logger.info(f"Received request: {envelope}")
-        
-        if not envelope:
-            logger.error("No Pub/Sub message received")
-            # Pub/Sub will retry if we return 4xx
-            return jsonify({"error": "No Pub/Sub message received"}), 400
-            
-        # Check if this is a Pub/Sub message
-        if not isinstance(envelope, dict) or 'message' not in envelope:
-            logger.warning("Invalid Pub/Sub message format")
-            # Try processing as direct JSON payload for testing purposes
-            message_data = envelope
-        else:
-            # Extract the Pub/Sub message
-            pubsub_message = envelope['message']
-            
-            # If the message has data, it will be base64-encoded
-            if 'data' in pubsub_message:
-                import base64
-                encoded_data = pubsub_message['data']
-                decoded_data = base64.b64decode(encoded_data).decode('utf-8')
-                logger.info(f"Decoded message data: {decoded_data}")
-                
-                try:
-                    message_data = json.loads(decoded_data)
-                except json.JSONDecodeError:
-                    logger.error(f"Failed to parse message as JSON: {decoded_data}")
-                    # Permanent failure - don't retry
-                    return jsonify({"error": "Invalid message format"}), 400
-            else:
-                # No data field
-                logger.warning("No data field in Pub/Sub message")
-                message_data = {}
-                
-            # Include any attributes from the Pub/Sub message
-            if 'attributes' in pubsub_message and pubsub_message['attributes']:
-                message_data.update(pubsub_message['attributes'])
-
-        logger.info(f"Processed message data: {message_data}")
-
-        # Validate required fields
-        required_fields = ['image_uri', 'zone_id', 'timestamp', 'camera_id']
-        missing_fields = [field for field in required_fields if field not in message_data]
-        if missing_fields:
-            logger.error(f"Missing required fields: {missing_fields}")
-            # Don't retry - this is a permanent failure
-            return jsonify({"error": f"Missing required fields: {missing_fields}"}), 400
-
-        image_uri = message_data.get('image_uri')
-        video_uri = message_data.get('video_uri')
-        zone_id = message_data.get('zone_id')
-        location_lat = message_data.get('location_lat')
-        location_long = message_data.get('location_long')
-        timestamp = message_data.get('timestamp')
-        camera_id = message_data.get('camera_id')
-        video_id = message_data.get('video_id')
-
-        # Log incoming request data for debugging
-        logger.info(f"Processing request with image_uri: {image_uri}, video_uri: {video_uri}, zone_id: {zone_id}")
-
-        # Perform face detection with error handling
-        faces_count = 0
-        try:
-            if image_uri:
-                faces_count_results = detect_faces_uri(image_uri)
-                logger.info(f"Face detection results: {faces_count_results}")
-                faces_count = faces_count_results.get("total_faces", 0)
-                logger.info(f"Face detection completed successfully with {faces_count} faces")
-            else:
-                logger.warning("No image_uri provided, skipping face detection")
-        except Exception as e:
-            logger.error(f"Face detection failed: {str(e)}")
-            # Continue processing without failing the entire request
-            faces_count = 0
-
-        ### Analysis results
-        analysis_results = {}
-        try:
-            if video_uri:
-                analysis_results = analyze_video(video_uri)
-                logger.info("Video analysis completed successfully: ", analysis_results)
-            else:
-                logger.warning("No video_uri provided, skipping video analysis")
-        except Exception as e:
-            logger.error(f"Video analysis failed: {str(e)}")
-            # Continue with empty analysis results
-            analysis_results = {}
 
-        incident_ids = []
-        incidents = []
-        if 'incidents' in analysis_results:
-            for incident_type, incident_data in analysis_results['incidents'].items():
-                if incident_data.get('score', 0) > 0.5:
-                    doc_ref = firestore_db.collection('incidents').document()
-                    incidents.append({
-                        "video_id": video_id,
-                        "image_uri": image_uri,
-                        "video_uri": video_uri,
-                        "camera_id": camera_id,
-                        "location_lat": location_lat,
-                        "location_long": location_long,
-                        "type": incident_type,
-                        "severity": SEVERITY_MAPPING.get(incident_type, "unknown"),
-                        "zone_id": zone_id,
-                        "timestamp": timestamp,
-                        "source": "gemini_mm",
-                        "details": {
-                            "confidence": incident_data.get('score'),
-                            "timestamps": incident_data.get('timestamps'),
-                            "explanation": incident_data.get('explanation')
-                        },
-                        "status": "active"
-                    })
-                    doc_ref.set(incidents[-1])
-                    incident_ids.append(doc_ref.id)
-
-        # Save the overall analysis report
-        report_ref = firestore_db.collection('analysis_reports').document()
-        firestore_data = {
-            "video_id": video_id,
-            "video_uri": video_uri,
-            "zone_id": zone_id,
-            "timestamp": timestamp,
-            "crowd_density": analysis_results.get("crowd_density"),
-            "crowd_sentiment": analysis_results.get("crowd_sentiment"),
-            "zone_capacity": analysis_results.get("zone_capacity"),
-            "normalized_crowd_density": analysis_results.get("normalized_crowd_density"),
-            "normalized_flow_speed": analysis_results.get("normalized_flow_speed"),
-            "overall_safety_assessment": analysis_results.get("overall_safety_assessment"),
-            "recommended_actions": analysis_results.get("recommended_actions"),
-            "incident_refs": [firestore_db.collection('incidents').document(id) for id in incident_ids]
-        }
-        
-        # Get numeric values for calculations, handling possible dictionary or complex structures
-        normalized_crowd_density = 0.0
-        normalized_flow_speed = 0.0
-        
-        # Extract crowd density - could be a number or dict with a score
-        if isinstance(firestore_data["normalized_crowd_density"], dict):
-            if "score" in firestore_data["normalized_crowd_density"]:
-                normalized_crowd_density = float(firestore_data["normalized_crowd_density"]["score"])
-            else:
-                # Try to get the first numeric value from the dict
-                for val in firestore_data["normalized_crowd_density"].values():
-                    if isinstance(val, (int, float)):
-                        normalized_crowd_density = float(val)
-                        break
-        elif firestore_data["normalized_crowd_density"] is not None:
-            try:
-                normalized_crowd_density = float(firestore_data["normalized_crowd_density"])
-            except (ValueError, TypeError):
-                normalized_crowd_density = 0.0
-                
-        # Extract flow speed - could be a number or dict with a score
-        if isinstance(firestore_data["normalized_flow_speed"], dict):
-            if "score" in firestore_data["normalized_flow_speed"]:
-                normalized_flow_speed = float(firestore_data["normalized_flow_speed"]["score"])
-            else:
-                # Try to get the first numeric value from the dict
-                for val in firestore_data["normalized_flow_speed"].values():
-                    if isinstance(val, (int, float)):
-                        normalized_flow_speed = float(val)
-                        break
-        elif firestore_data["normalized_flow_speed"] is not None:
-            try:
-                normalized_flow_speed = float(firestore_data["normalized_flow_speed"])
-            except (ValueError, TypeError):
-                normalized_flow_speed = 0.0
-                
-        # Calculate bottleneck index safely
-        bottle_neck_index = normalized_crowd_density * (1 - normalized_flow_speed)
-        logger.info(f"Calculated bottle_neck_index: {bottle_neck_index} from density: {normalized_crowd_density} and flow: {normalized_flow_speed}")
-        report_ref.set(firestore_data)
-
-        # send to the pub sub topic
-        # insert the data to the table
-        rows = [
-            {
-                "image_uri": image_uri,
-                "zone_id": zone_id,
-                "video_id": video_id,
-                "timestamp": timestamp,
-                "camera_id": camera_id,
-                "faces_count": faces_count,
-                "location_lat": location_lat,
-                "location_long": location_long,
-                "bottle_neck_index": bottle_neck_index
-            }
-        ]
+        try:
+            with stage_timer("decode"):
+                message_data, message_id = decode_push_envelope(envelope)
+            log_sampled(logger, "Received message", message_id=message_id, payload=message_data)
+            process_message(message_data, message_id=message_id)
+        except InvalidMessageError as e:
+            logger.error(str(e))
+            # Don't retry - this is a permanent failure
+            return jsonify({"error": str(e)}), 400
 
-        # For each agent, we've to check if the incident is already in active status in that zone
-        # get the active incidents in that zone
-        try: 
-            current_active_incidents = firestore_db.collection('aggregrated_incidents').where('zone_id', '==', zone_id).where('status', '==', 'active').get()
-        except Exception as e:
-            current_active_incidents = []
-
-        unique_types_in_active_incidents = set()
-        for current_active_incident in current_active_incidents:
-            current_active_incident = current_active_incident.to_dict()
-            unique_types_in_active_incidents.add(current_active_incident.get('type'))
-
-        for incident in incidents:
-            if incident.get('type') not in unique_types_in_active_incidents:
-                # insert the incident to the table 'aggregrated_incidents'
-                report_ref = firestore_db.collection('aggregrated_incidents').document()
-                report_ref.set(incident)
-
-
-        # insert the data to the table
-        client.insert_rows_json(table_id, rows)
-        
         # Return success status - Pub/Sub requires 2xx for acknowledgement
-        logger.info("Message processed successfully")
+        log_sampled(logger, "Message processed successfully")
         return jsonify({"success": True, "message": "Message processed successfully"}), 200
     
     except Exception as e:
@@ -296,6 +337,12 @@ def handle_pubsub_message():
             "retry": True  # Indicate this should be retried by Pub/Sub
         }), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for the ingestion pipeline."""
+    body, content_type = render_metrics()
+    return Response(body, mimetype=content_type)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for Cloud Run."""
@@ -0,0 +1,52 @@
+"""
+Import-time profile of the ingestion service.
+
+Imports the service in a fresh interpreter with `-X importtime` and reports
+the total import time plus the slowest modules, so cold-start regressions are
+easy to spot:
+    python profile_startup.py [module] [--top N]
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+
+def profile_imports(module):
+    """Return [(cumulative_us, self_us, module_name)] for importing module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env={"WARM_UP_CLIENTS": "false", **os.environ},
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    timings = []
+    for line in result.stderr.splitlines():
+        # Lines look like: "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        timings.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    timings = profile_imports(args.module)
+    top_level = [t for t in timings if t[2].strip() == args.module]
+    total_us = top_level[-1][0] if top_level else sum(t[1] for t in timings)
+    print(f"Importing {args.module} took {total_us / 1e6:.3f}s")
+    print(f"{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+    for cumulative_us, self_us, name in sorted(timings, reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1e3:>16.1f} {self_us / 1e3:>10.1f}  {name}")
+
+
+if __name__ == '__main__':
+    main()
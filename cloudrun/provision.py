@@ -0,0 +1,40 @@
+"""
+One-time provisioning of the BigQuery dataset and table used by the service.
+
+Run at deploy time (deploy.sh does this) instead of on every cold start:
+    python provision.py
+"""
+import os
+import logging
+from google.cloud import bigquery
+from utils.bigquery_schema import project_id, dataset_id, table_id, VISION_ML_TABLE_SCHEMA
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+service_account_path = "config/service_account.json"
+if os.path.exists(service_account_path):
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", service_account_path)
+
+
+def provision_bigquery(client):
+    # Create the dataset if it doesn't exist
+    dataset_ref = bigquery.DatasetReference(project_id, dataset_id)
+    try:
+        client.get_dataset(dataset_ref)
+        logger.info(f"Dataset {dataset_id} already exists")
+    except Exception:
+        logger.info(f"Dataset {dataset_id} not found, creating it")
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset = client.create_dataset(dataset)
+        logger.info(f"Dataset {dataset_id} created")
+
+    # create the table if not exists
+    schema = [bigquery.SchemaField(name, field_type) for name, field_type in VISION_ML_TABLE_SCHEMA]
+    table = bigquery.Table(table_id, schema=schema)
+    client.create_table(table, exists_ok=True)
+    logger.info(f"Table {table_id} is ready")
+
+
+if __name__ == '__main__':
+    provision_bigquery(bigquery.Client())
@@ -0,0 +1,104 @@
+"""
+Streaming pull entry point for the ingestion service.
+
+An alternative to the Pub/Sub push endpoint in main.py: instead of one HTTP
+request per message, this process holds a streaming pull on the subscription
+and feeds messages through the same process_message pipeline on a worker pool.
+FlowControl bounds how many messages (and bytes) are in flight per instance.
+
+Run with:
+    PUBSUB_SUBSCRIPTION=projects/<project>/subscriptions/<name> python subscriber.py
+"""
+import os
+import json
+import signal
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+from prometheus_client import start_http_server
+from main import process_message, InvalidMessageError, bigquery_sink
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_SUBSCRIPTION = os.environ.get("PUBSUB_SUBSCRIPTION", "vision-face-detection-pull-sub")
+PULL_MAX_MESSAGES = int(os.environ.get("PULL_MAX_MESSAGES", "8"))
+PULL_MAX_BYTES = int(os.environ.get("PULL_MAX_BYTES", str(10 * 1024 * 1024)))
+PULL_WORKERS = int(os.environ.get("PULL_WORKERS", str(PULL_MAX_MESSAGES)))
+# Port for the Prometheus /metrics endpoint; 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+
+
+def _subscription_path(subscriber):
+    if PUBSUB_SUBSCRIPTION.startswith("projects/"):
+        return PUBSUB_SUBSCRIPTION
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT", "qualified-acre-466511-u6")
+    return subscriber.subscription_path(project_id, PUBSUB_SUBSCRIPTION)
+
+
+def handle_message(message):
+    """Process one pulled message, acking on success and nacking on retryable failure."""
+    try:
+        message_data = json.loads(message.data.decode('utf-8')) if message.data else {}
+        if message.attributes:
+            message_data.update(message.attributes)
+        process_message(message_data, message_id=message.message_id)
+    except (json.JSONDecodeError, UnicodeDecodeError, InvalidMessageError) as e:
+        # Permanent failure - redelivering won't help
+        logger.error(f"Dropping invalid message {message.message_id}: {str(e)}")
+        message.ack()
+    except Exception as e:
+        logger.error(f"Error processing message {message.message_id}: {str(e)}")
+        message.nack()
+    else:
+        log_sampled(logger, "Message processed successfully", message_id=message.message_id)
+        message.ack()
+
+
+def main():
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        logger.info(f"Serving metrics on port {METRICS_PORT}")
+
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = _subscription_path(subscriber)
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=PULL_MAX_MESSAGES,
+        max_bytes=PULL_MAX_BYTES,
+    )
+    scheduler = ThreadScheduler(
+        executor=ThreadPoolExecutor(max_workers=PULL_WORKERS, thread_name_prefix="pull-worker")
+    )
+
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path,
+        callback=handle_message,
+        flow_control=flow_control,
+        scheduler=scheduler,
+        await_callbacks_on_shutdown=True,
+    )
+    logger.info(
+        f"Listening on {subscription_path} with max_messages={PULL_MAX_MESSAGES}, "
+        f"max_bytes={PULL_MAX_BYTES}, workers={PULL_WORKERS}"
+    )
+
+    # Stop pulling on SIGTERM and let in-flight callbacks finish before draining
+    # the BigQuery sink, rather than draining it while messages are still running.
+    signal.signal(signal.SIGTERM, lambda signum, frame: streaming_pull_future.cancel())
+
+    with subscriber:
+        try:
+            streaming_pull_future.result()
+        except KeyboardInterrupt:
+            streaming_pull_future.cancel()
+            streaming_pull_future.result()
+        except Exception as e:
+            logger.error(f"Streaming pull stopped: {str(e)}")
+            raise
+        finally:
+            bigquery_sink.close()
+
+
+if __name__ == '__main__':
+    main()
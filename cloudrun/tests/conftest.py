@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Nothing in the tests may reach Google Cloud: no background warm-up, listeners or cache refreshes
+os.environ.setdefault("WARM_UP_CLIENTS", "false")
+os.environ.setdefault("ACTIVE_INCIDENT_INDEX_ENABLED", "false")
+os.environ.setdefault("GEMINI_CONTEXT_CACHE_ENABLED", "false")
+# Sample every event, so the logging calls on the request path all run
+os.environ.setdefault("LOG_SAMPLE_RATE", "1")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
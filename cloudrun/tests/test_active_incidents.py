@@ -0,0 +1,38 @@
+import time
+from types import SimpleNamespace
+
+from utils.active_incidents import ActiveIncidentIndex
+
+
+class FakeQuery:
+    def __init__(self):
+        self.callback = None
+
+    def where(self, *args):
+        return self
+
+    def on_snapshot(self, callback):
+        self.callback = callback
+        return SimpleNamespace(unsubscribe=lambda: None)
+
+
+def added(doc_id, zone_id, incident_type):
+    document = SimpleNamespace(id=doc_id, to_dict=lambda: {"zone_id": zone_id, "type": incident_type})
+    return SimpleNamespace(document=document, type=SimpleNamespace(name="ADDED"))
+
+
+def test_lookups_do_not_wait_for_the_first_snapshot():
+    query = FakeQuery()
+    db = SimpleNamespace(collection=lambda name: query)
+    index = ActiveIncidentIndex(db=db, ready_timeout=5)
+
+    started = time.monotonic()
+    assert index.active_types("Main_Stage") is None
+    assert time.monotonic() - started < 1
+    assert query.callback is not None
+
+    query.callback([object()], [added("d1", "Main_Stage", "theft")], None)
+    index.mark_active("Main_Stage", ["fire_and_smoke"])
+
+    assert index.wait_ready(timeout=0)
+    assert index.active_types("Main_Stage") == {"theft", "fire_and_smoke"}
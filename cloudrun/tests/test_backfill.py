@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+from google.api_core.exceptions import NotFound
+
+import backfill
+
+
+class FakeBigQuery:
+    """Runs load jobs in memory; jobs in failing fail when waited on."""
+
+    def __init__(self, failing=()):
+        self.jobs = {}
+        self.failing = set(failing)
+        self.loaded = []
+
+    def _job(self, job_id):
+        def result():
+            if job_id in self.failing:
+                raise RuntimeError("load failed")
+        return SimpleNamespace(job_id=job_id, result=result)
+
+    def load_table_from_json(self, rows, destination, job_id=None, job_config=None):
+        self.jobs[job_id] = rows
+        if job_id not in self.failing:
+            self.loaded.extend(rows)
+        return self._job(job_id)
+
+    def get_job(self, job_id):
+        if job_id not in self.jobs:
+            raise NotFound(job_id)
+        return self._job(job_id)
+
+
+@pytest.fixture
+def bigquery(monkeypatch):
+    client = FakeBigQuery()
+    monkeypatch.setattr(backfill, "get_bigquery_client", lambda: client)
+    return client
+
+
+def checkpoint():
+    return SimpleNamespace(save=lambda: None)
+
+
+def test_resumed_load_does_not_append_twice(bigquery):
+    chunk = {"job": "batch-1"}
+    backfill.load_rows(checkpoint(), chunk, [{"a": 1}])
+    # The run crashed before marking the chunk loaded; the rerun finds the job
+    backfill.load_rows(checkpoint(), chunk, [{"a": 1}])
+
+    assert bigquery.loaded == [{"a": 1}]
+    assert list(bigquery.jobs) == [chunk["load_job"]]
+
+
+def test_load_job_recorded_but_never_started_is_started(bigquery):
+    chunk = {"job": "batch-1", "load_job": "backfill-1"}
+    backfill.load_rows(checkpoint(), chunk, [{"a": 1}])
+
+    assert list(bigquery.jobs) == ["backfill-1"]
+    assert bigquery.loaded == [{"a": 1}]
+
+
+def test_failed_load_job_is_replaced(bigquery):
+    bigquery.failing.add("backfill-1")
+    bigquery.jobs["backfill-1"] = [{"a": 1}]
+    chunk = {"job": "batch-1", "load_job": "backfill-1"}
+    backfill.load_rows(checkpoint(), chunk, [{"a": 1}])
+
+    assert chunk["load_job"] != "backfill-1"
+    assert bigquery.loaded == [{"a": 1}]
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+from utils.bigquery_sink import BigQuerySink
+
+
+def sink_with(insert_rows_json, inserted):
+    client = SimpleNamespace(insert_rows_json=insert_rows_json)
+    return BigQuerySink("p.d.t", client=client, max_latency=60, on_inserted=inserted.extend)
+
+
+def test_inserted_rows_are_reported_on_flush():
+    inserted = []
+    sink = sink_with(lambda table_id, rows, row_ids: [{"index": 1, "errors": ["invalid"]}], inserted)
+
+    sink.add_rows([{"a": 1}, {"a": 2}, {"a": 3}], row_ids=["k1", "k2", "k3"])
+    sink.add_rows([{"a": 4}])
+    assert inserted == []
+    sink.close(timeout=5)
+
+    # Rejected rows and rows queued without ids are not reported
+    assert inserted == ["k1", "k3"]
+
+
+def test_failed_requests_are_not_reported():
+    inserted = []
+
+    def insert_rows_json(table_id, rows, row_ids):
+        raise ConnectionError("unavailable")
+
+    sink = sink_with(insert_rows_json, inserted)
+    sink.add_rows([{"a": 1}], row_ids=["k1"])
+    sink.close(timeout=5)
+
+    assert inserted == []
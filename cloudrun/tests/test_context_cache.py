@@ -0,0 +1,50 @@
+import time
+import datetime
+import threading
+from types import SimpleNamespace
+
+from utils.context_cache import PromptCache
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+        self.release = threading.Event()
+
+    def list(self):
+        self.release.wait(5)
+        return []
+
+    def create(self, model, config):
+        self.created.append(config.display_name)
+        expire_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}", expire_time=expire_time)
+
+
+def fake_client(total_tokens):
+    models = SimpleNamespace(count_tokens=lambda model, contents: SimpleNamespace(total_tokens=total_tokens))
+    return SimpleNamespace(models=models, caches=FakeCaches())
+
+
+def test_prompt_below_minimum_is_never_cached():
+    client = fake_client(700)
+    cache = PromptCache("gemini-2.5-flash", "short prompt", enabled=True, client=client, min_tokens=1024)
+
+    assert cache.refresh() is None
+    assert not cache.enabled
+    assert cache.name() is None
+    assert client.caches.created == []
+
+
+def test_name_does_not_wait_for_the_entry():
+    client = fake_client(4000)
+    cache = PromptCache("gemini-2.5-flash", "long prompt", enabled=True, client=client, min_tokens=1024)
+
+    # The create is stuck in the background, but the request path goes on inline
+    assert cache.name() is None
+    client.caches.release.set()
+    deadline = time.monotonic() + 5
+    while cache.name() is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.name() == "cachedContents/1"
+    assert client.caches.created == [cache.display_name]
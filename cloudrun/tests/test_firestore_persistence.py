@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils import firestore_persistence
+from utils.firestore_persistence import BulkWriteError, persist_message_results
+
+
+class FakeDocument:
+    def __init__(self, path):
+        self._document_path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+
+class FakeDb:
+    def collection(self, name):
+        return SimpleNamespace(document=lambda doc_id: FakeDocument(f"{name}/{doc_id}"))
+
+
+class FakeBulkWriter:
+    """Commits queued writes on flush, failing those whose path is in failing."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.queued = []
+        self.committed = []
+        self.on_error = None
+
+    def on_write_error(self, callback):
+        self.on_error = callback
+
+    def set(self, reference, data, merge=False):
+        self.queued.append(reference)
+
+    def flush(self):
+        queued, self.queued = self.queued, []
+        for reference in queued:
+            if reference._document_path not in self.failing:
+                self.committed.append(reference._document_path)
+                continue
+            attempts = 1
+            while self.on_error(SimpleNamespace(
+                    attempts=attempts, message="unavailable", operation=SimpleNamespace(reference=reference)), self):
+                attempts += 1
+
+
+@pytest.fixture
+def bulk_writer(monkeypatch):
+    writer = FakeBulkWriter()
+    writer.on_write_error(firestore_persistence._on_bulk_write_error)
+    monkeypatch.setattr(firestore_persistence, "_bulk_writer", writer)
+    return writer
+
+
+def persist(doc_id):
+    incidents = [{"type": "congestion"}]
+    return persist_message_results(FakeDb(), incidents, {"video_id": "v"}, incidents, doc_id=doc_id, mode="bulk")
+
+
+def test_bulk_writes_are_committed_before_returning(bulk_writer):
+    assert persist("m1") == ["m1-congestion"]
+
+    assert bulk_writer.queued == []
+    assert sorted(bulk_writer.committed) == [
+        "aggregrated_incidents/m1-congestion", "analysis_reports/m1", "incidents/m1-congestion",
+    ]
+
+
+def test_failed_bulk_writes_fail_the_message(bulk_writer):
+    bulk_writer.failing.add("analysis_reports/m2")
+
+    with pytest.raises(BulkWriteError):
+        persist("m2")
+
+    # The failure is reported to its message only
+    bulk_writer.failing.clear()
+    persist("m2")
+    assert firestore_persistence._bulk_failed_paths == set()
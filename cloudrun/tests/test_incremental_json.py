@@ -0,0 +1,154 @@
+import json
+
+import pytest
+
+from utils.incremental_json import StreamedObjectMembers
+
+INCIDENTS = {
+    "incidents": {
+        "fire_and_smoke": {"score": 0.9, "timestamps": ["00:01", "00:04"], "explanation": "Smoke near the stage"},
+        "theft": {"score": 0.1, "timestamps": [], "explanation": "None seen"},
+    },
+    "summary": "Busy",
+}
+
+# (name, path, document, members expected in order)
+CASES = [
+    (
+        "flat members",
+        ("incidents",),
+        json.dumps(INCIDENTS),
+        list(INCIDENTS["incidents"].items()),
+    ),
+    (
+        "escaped quotes and braces in strings",
+        ("incidents",),
+        json.dumps({"incidents": {
+            "unruly_behavior": {"explanation": 'A sign reads "} ] { [" and a \\ backslash', "score": 0.7},
+            'key with "quotes" and }': {"score": 0.2},
+        }}),
+        [
+            ("unruly_behavior", {"explanation": 'A sign reads "} ] { [" and a \\ backslash', "score": 0.7}),
+            ('key with "quotes" and }', {"score": 0.2}),
+        ],
+    ),
+    (
+        "nested objects and arrays inside members",
+        ("incidents",),
+        json.dumps({"incidents": {
+            "crowd_surges": {"score": 0.8, "details": {"ranges": [{"start": 1, "end": [2, {"x": "}"}]}]}},
+            "list_member": [{"a": 1}, [2, 3]],
+        }}),
+        [
+            ("crowd_surges", {"score": 0.8, "details": {"ranges": [{"start": 1, "end": [2, {"x": "}"}]}]}}),
+            ("list_member", [{"a": 1}, [2, 3]]),
+        ],
+    ),
+    (
+        "scalar members are not reported",
+        ("incidents",),
+        json.dumps({"incidents": {"count": 2, "label": "{not an object}", "theft": {"score": 0.6}, "none": None}}),
+        [("theft", {"score": 0.6})],
+    ),
+    (
+        "same key elsewhere in the document is not watched",
+        ("incidents",),
+        json.dumps({"other": {"incidents": {"theft": {"score": 0.9}}}, "incidents": {"fire_and_smoke": {"score": 1}}}),
+        [("fire_and_smoke", {"score": 1})],
+    ),
+    (
+        "deeper path",
+        ("analysis", "incidents"),
+        json.dumps({"incidents": {"ignored": {}}, "analysis": {"model": "m", "incidents": {"theft": {"score": 0.5}}}}),
+        [("theft", {"score": 0.5})],
+    ),
+    (
+        "whitespace between tokens",
+        ("incidents",),
+        '{\n  "incidents" : {\n    "theft" : { "score" : 0.5 } ,\n    "fire" : [ 1 ]\n  }\n}\n',
+        [("theft", {"score": 0.5}), ("fire", [1])],
+    ),
+]
+
+
+def feed_all(path, chunks):
+    parser = StreamedObjectMembers(path)
+    members = []
+    for chunk in chunks:
+        members.extend(parser.feed(chunk))
+    return parser, members
+
+
+def split_in_two(document):
+    for index in range(len(document) + 1):
+        yield [document[:index], document[index:]]
+
+
+@pytest.mark.parametrize("name, path, document, expected", CASES, ids=[case[0] for case in CASES])
+def test_members_in_one_chunk(name, path, document, expected):
+    parser, members = feed_all(path, [document])
+
+    assert members == expected
+    assert parser.text == document
+
+
+@pytest.mark.parametrize("name, path, document, expected", CASES, ids=[case[0] for case in CASES])
+def test_members_split_at_every_boundary(name, path, document, expected):
+    for chunks in split_in_two(document):
+        assert feed_all(path, chunks)[1] == expected, f"split at {len(chunks[0])}"
+
+
+@pytest.mark.parametrize("name, path, document, expected", CASES, ids=[case[0] for case in CASES])
+def test_members_fed_one_character_at_a_time(name, path, document, expected):
+    assert feed_all(path, list(document))[1] == expected
+
+
+@pytest.mark.parametrize("name, path, document, expected", CASES, ids=[case[0] for case in CASES])
+def test_members_in_uneven_chunks(name, path, document, expected):
+    sizes = [1, 7, 2, 13, 5]
+    chunks = []
+    index = 0
+    while index < len(document):
+        size = sizes[len(chunks) % len(sizes)]
+        chunks.append(document[index:index + size])
+        index += size
+
+    assert feed_all(path, chunks)[1] == expected
+
+
+def test_members_are_reported_by_the_chunk_that_closes_them():
+    document = json.dumps(INCIDENTS)
+    first_close = document.index("}") + 1
+    parser = StreamedObjectMembers(("incidents",))
+
+    assert parser.feed(document[:first_close - 1]) == []
+    assert parser.feed(document[first_close - 1:first_close]) == [("fire_and_smoke", INCIDENTS["incidents"]["fire_and_smoke"])]
+    assert parser.feed(document[first_close:]) == [("theft", INCIDENTS["incidents"]["theft"])]
+
+
+# (name, truncated document, members completed before the cut)
+TRUNCATED = [
+    ("empty", "", []),
+    ("inside the watched key", '{"incid', []),
+    ("before the first member", '{"incidents": {', []),
+    ("inside a member", '{"incidents": {"theft": {"score": 0.', []),
+    ("inside a string with a brace", '{"incidents": {"theft": {"explanation": "a } b', []),
+    ("after an escape", '{"incidents": {"theft": {"explanation": "a \\', []),
+    ("inside a nested object", '{"incidents": {"theft": {"details": {"x": 1}', []),
+    (
+        "after a complete member",
+        '{"incidents": {"theft": {"score": 0.5}, "fire": {"score": 0.',
+        [("theft", {"score": 0.5})],
+    ),
+    (
+        "before the watched object closes",
+        '{"incidents": {"theft": {"score": 0.5}',
+        [("theft", {"score": 0.5})],
+    ),
+]
+
+
+@pytest.mark.parametrize("name, document, expected", TRUNCATED, ids=[case[0] for case in TRUNCATED])
+def test_truncated_input_reports_only_completed_members(name, document, expected):
+    for chunks in split_in_two(document):
+        assert feed_all(("incidents",), chunks)[1] == expected, f"split at {len(chunks[0])}"
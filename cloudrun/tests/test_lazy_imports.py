@@ -0,0 +1,15 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+CLOUDRUN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("module", ["google.cloud.vision", "google.genai"])
+def test_importing_main_does_not_load(module):
+    check = f"import sys, main; assert {module!r} not in sys.modules, '{module} was imported'"
+    env = dict(os.environ, WARM_UP_CLIENTS="false", ACTIVE_INCIDENT_INDEX_ENABLED="false")
+    result = subprocess.run([sys.executable, "-c", check], cwd=CLOUDRUN_DIR, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
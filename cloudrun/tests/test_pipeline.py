@@ -0,0 +1,33 @@
+from utils.idempotency import STAGE_ANALYSIS, STAGE_BIGQUERY, STAGE_FIRESTORE
+from utils.pipeline import already_processed, analysis_record, build_message_results, recorded_analysis
+
+MESSAGE = {"zone_id": "Main_Stage", "video_uri": "gs://bucket/Main_Stage/video/clip.mp4", "timestamp": "2026-01-01T12:00:00Z"}
+ANALYSIS = {
+    "incidents": {
+        "theft": {"score": 0.9, "explanation": "", "timestamps": []},
+        "fire_and_smoke": {"score": 0.8, "explanation": "", "timestamps": []},
+        "congestion": {"score": 0.0, "explanation": "", "timestamps": []},
+    },
+}
+
+
+def test_recorded_analysis_round_trips():
+    record = analysis_record(3, ANALYSIS, None, {"tier": "full"})
+
+    assert recorded_analysis({STAGE_ANALYSIS: record}) == (3, ANALYSIS, None, {"tier": "full"})
+    assert recorded_analysis({}) is None
+
+
+def test_only_a_recorded_bigquery_stage_skips_the_message():
+    assert already_processed("key", {STAGE_BIGQUERY: True})
+    assert not already_processed("key", {STAGE_ANALYSIS: {}, STAGE_FIRESTORE: True})
+
+
+def test_aggregated_incidents_skip_active_types_unless_written_early():
+    results = build_message_results(
+        MESSAGE, 3, ANALYSIS, None, None, active_types={"theft", "fire_and_smoke"}, early_aggregated={"fire_and_smoke"},
+    )
+
+    assert sorted(incident["type"] for incident in results.incidents) == ["fire_and_smoke", "theft"]
+    assert [incident["type"] for incident in results.aggregated_incidents] == ["fire_and_smoke"]
+    assert len(results.rows) == 1
@@ -0,0 +1,14 @@
+from utils.prefilter import DECISION_SKIP, decide, skip_possible
+
+
+def test_skip_needs_known_motion():
+    # Without motion energy decide() never skips, so the stages shouldn't be serialized
+    assert not skip_possible({"video_uri": "gs://bucket/clip.mp4"}, "none")
+    assert decide(0, None, "none")["decision"] != DECISION_SKIP
+
+
+def test_skip_possible_with_motion_in_a_quiet_zone():
+    message = {"video_uri": "gs://bucket/clip.mp4", "motion_energy": 0.0}
+    assert skip_possible(message, "none")
+    assert not skip_possible(message, "low")
+    assert decide(0, 0.0, "none")["decision"] == DECISION_SKIP
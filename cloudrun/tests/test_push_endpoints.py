@@ -0,0 +1,154 @@
+import json
+import base64
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import asgi_main
+
+MESSAGE = {
+    "image_uri": "gs://bucket/Main_Stage/image/frame.jpg",
+    "video_uri": "gs://bucket/Main_Stage/video/clip.mp4",
+    "zone_id": "Main_Stage",
+    "camera_id": "cam-1",
+    "timestamp": "2026-01-01T12:00:00Z",
+}
+
+
+def push_envelope(message_data, message_id="1234"):
+    return {
+        "message": {
+            "data": base64.b64encode(json.dumps(message_data).encode("utf-8")).decode("ascii"),
+            "messageId": message_id,
+        },
+        "subscription": "projects/p/subscriptions/s",
+    }
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    calls = []
+
+    def process_message(message_data, message_id=None):
+        calls.append((message_data, message_id))
+
+    async def process_message_async(message_data, message_id=None):
+        calls.append((message_data, message_id))
+
+    monkeypatch.setattr(main, "process_message", process_message)
+    monkeypatch.setattr(asgi_main, "process_message", process_message_async)
+    return calls
+
+
+def test_flask_push_is_acknowledged(processed):
+    response = main.app.test_client().post("/", json=push_envelope(MESSAGE))
+
+    assert response.status_code == 200
+    assert response.get_json()["success"] is True
+    assert processed == [(MESSAGE, "1234")]
+
+
+def test_flask_push_with_invalid_data_is_rejected(processed):
+    envelope = {"message": {"data": base64.b64encode(b"not json").decode("ascii"), "messageId": "1234"}}
+    response = main.app.test_client().post("/", json=envelope)
+
+    assert response.status_code == 400
+    assert processed == []
+
+
+def test_asgi_push_is_acknowledged(processed, monkeypatch):
+    monkeypatch.setattr(asgi_main, "message_semaphore", asyncio.Semaphore(1))
+    response = TestClient(asgi_main.app).post("/", json=push_envelope(MESSAGE))
+
+    assert response.status_code == 200
+    assert response.json()["success"] is True
+    assert processed == [(MESSAGE, "1234")]
+
+
+def test_incomplete_analysis_is_retried_not_recorded(monkeypatch):
+    recorded = []
+    ledger = SimpleNamespace(
+        key_for=lambda message_id, message_data: "key",
+        completed_stages=lambda key: {},
+        record_stage=lambda *args: recorded.append(args),
+    )
+    monkeypatch.setattr(main, "message_ledger", ledger)
+    monkeypatch.setattr(main, "EARLY_INCIDENTS_ENABLED", False)
+    monkeypatch.setattr(main, "get_active_incident_types", lambda zone_id: set())
+    monkeypatch.setattr(main, "run_analysis_stages", lambda message_data, **kwargs: (2, None, None, None))
+
+    response = main.app.test_client().post("/", json=push_envelope(MESSAGE))
+
+    assert response.status_code == 500
+    assert response.get_json()["retry"] is True
+    assert recorded == []
+
+
+def test_early_incidents_of_an_incomplete_analysis_are_deleted(monkeypatch):
+    writes = []
+    ledger = SimpleNamespace(
+        key_for=lambda message_id, message_data: "key",
+        completed_stages=lambda key: {},
+        record_stage=lambda *args: None,
+    )
+    monkeypatch.setattr(main, "message_ledger", ledger)
+    monkeypatch.setattr(main, "EARLY_INCIDENTS_ENABLED", True)
+    monkeypatch.setattr(main, "get_active_incident_types", lambda zone_id: set())
+    monkeypatch.setattr("utils.early_incidents.get_firestore_client", lambda: None)
+    monkeypatch.setattr(
+        "utils.early_incidents.persist_incident",
+        lambda db, incident, doc_id, aggregated: writes.append(("set", incident["type"], incident["status"])),
+    )
+    monkeypatch.setattr(
+        "utils.early_incidents.delete_incident",
+        lambda db, incident_type, doc_id, aggregated: writes.append(("delete", incident_type, aggregated)),
+    )
+
+    def run_analysis_stages(message_data, on_incident=None, **kwargs):
+        # The stream reports an incident, then the analysis times out
+        on_incident("fire_and_smoke", {"score": 0.9})
+        return 2, None, None, None
+
+    monkeypatch.setattr(main, "run_analysis_stages", run_analysis_stages)
+
+    response = main.app.test_client().post("/", json=push_envelope(MESSAGE))
+
+    assert response.status_code == 500
+    assert writes == [("set", "fire_and_smoke", "provisional"), ("delete", "fire_and_smoke", True)]
+
+
+def test_active_types_are_looked_up_once_per_message(monkeypatch):
+    lookups = []
+    ledger = SimpleNamespace(
+        key_for=lambda message_id, message_data: "key",
+        completed_stages=lambda key: {},
+        record_stage=lambda *args: None,
+        document=lambda key: None,
+        stage_update=lambda stage: {},
+    )
+    monkeypatch.setattr(main, "message_ledger", ledger)
+    monkeypatch.setattr(main, "EARLY_INCIDENTS_ENABLED", False)
+    monkeypatch.setattr(main, "get_active_incident_types", lambda zone_id: lookups.append(zone_id) or {"theft"})
+    seen = {}
+
+    def run_analysis_stages(message_data, active_types=(), **kwargs):
+        seen["risk"] = active_types
+        return 2, {"incidents": {"theft": {"score": 0.9}, "fire_and_smoke": {"score": 0.9}}}, None, None
+
+    monkeypatch.setattr(main, "run_analysis_stages", run_analysis_stages)
+    monkeypatch.setattr(
+        main, "persist_message_results",
+        lambda db, incidents, report, aggregated, **kwargs: seen.update(aggregated=aggregated),
+    )
+    monkeypatch.setattr(main, "get_firestore_client", lambda: None)
+    monkeypatch.setattr(main.bigquery_sink, "add_rows", lambda rows, row_ids=None: None)
+
+    response = main.app.test_client().post("/", json=push_envelope(MESSAGE))
+
+    assert response.status_code == 200
+    assert lookups == ["Main_Stage"]
+    assert seen["risk"] == {"theft"}
+    assert [incident["type"] for incident in seen["aggregated"]] == ["fire_and_smoke"]
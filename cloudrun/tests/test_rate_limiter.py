@@ -0,0 +1,93 @@
+import time
+import threading
+
+import pytest
+
+from utils import rate_limiter
+from utils.rate_limiter import AdaptiveRateLimiter, CallAbandoned, call_with_rate_limit
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+def test_rate_increases_additively_on_success():
+    limiter = AdaptiveRateLimiter("test-increase", initial_rate=2, max_rate=3)
+
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(2 + rate_limiter.RATE_LIMIT_INCREASE / 2)
+
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 3
+
+
+def test_rate_decreases_multiplicatively_on_throttle(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RATE_LIMIT_DECREASE_COOLDOWN", 60)
+    limiter = AdaptiveRateLimiter("test-decrease", initial_rate=8, min_rate=1)
+
+    limiter.on_throttled()
+    assert limiter.rate == pytest.approx(8 * rate_limiter.RATE_LIMIT_DECREASE)
+    # The saved-up burst is dropped with the cut
+    assert limiter._tokens <= 0
+
+    # A 429 within the cooldown is the same overload
+    limiter.on_throttled()
+    assert limiter.rate == pytest.approx(8 * rate_limiter.RATE_LIMIT_DECREASE)
+
+    monkeypatch.setattr(rate_limiter, "RATE_LIMIT_DECREASE_COOLDOWN", 0)
+    for _ in range(10):
+        limiter.on_throttled()
+    assert limiter.rate == 1
+
+
+def test_acquire_gives_up_before_a_token_past_the_deadline():
+    limiter = AdaptiveRateLimiter("test-deadline", initial_rate=0.5, burst=1)
+    limiter.acquire()
+    tokens = limiter._tokens
+
+    started = time.monotonic()
+    with pytest.raises(CallAbandoned):
+        limiter.acquire(deadline=time.monotonic() + 0.1)
+    assert time.monotonic() - started < 0.1
+    # The token wasn't taken, so it doesn't push later callers back
+    assert limiter._tokens == pytest.approx(tokens, abs=0.01)
+
+
+def test_cancelled_acquire_gives_the_token_back():
+    limiter = AdaptiveRateLimiter("test-cancelled", initial_rate=0.5, burst=1)
+    limiter.acquire()
+    cancelled = threading.Event()
+    threading.Timer(0.05, cancelled.set).start()
+
+    with pytest.raises(CallAbandoned):
+        limiter.acquire(cancelled=cancelled)
+    assert limiter._tokens == pytest.approx(0.0, abs=0.05)
+
+
+def test_throttled_call_is_not_retried_past_the_deadline(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "_backoff", lambda attempt: 5)
+    calls = []
+
+    def throttled():
+        calls.append(time.monotonic())
+        raise RateLimited("429")
+
+    started = time.monotonic()
+    with pytest.raises(RateLimited):
+        call_with_rate_limit("test-retry-deadline", throttled, deadline=time.monotonic() + 1)
+    assert len(calls) == 1
+    assert time.monotonic() - started < 1
+
+
+def test_throttled_call_is_retried_within_the_deadline(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "_backoff", lambda attempt: 0)
+    outcomes = [RateLimited("429"), "ok"]
+
+    def flaky():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert call_with_rate_limit("test-retry", flaky, deadline=time.monotonic() + 30) == "ok"
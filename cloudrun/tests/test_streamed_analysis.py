@@ -0,0 +1,128 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from utils import gemini_segmentation, rate_limiter
+from utils.early_incidents import EarlyIncidentWriter
+from utils.gemini_segmentation import AnalysisCancelled, _generate_streamed
+
+RESPONSE = ['{"incidents": {"theft": {"score": 0.9, "timestamps": []}', ', "congestion": {"score": 0.1}}}']
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+def streaming_client(*attempts):
+    """A genai client whose nth stream yields the chunks of attempts[n], raising any exception among them."""
+    attempts = list(attempts)
+
+    def generate_content_stream(model, contents, config):
+        for chunk in attempts.pop(0):
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield SimpleNamespace(text=chunk, usage_metadata=None)
+
+    return SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream))
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    monkeypatch.setattr(gemini_segmentation, "_analysis_request", lambda *args: ([], None))
+    monkeypatch.setattr(gemini_segmentation, "_parse_response", lambda text, incident_types: text)
+    monkeypatch.setattr(rate_limiter, "_backoff", lambda attempt: 0)
+
+    def use(*attempts):
+        client = streaming_client(*attempts)
+        monkeypatch.setattr(gemini_segmentation, "get_genai_client", lambda: client)
+    return use
+
+
+def test_rate_limited_stream_is_retried(stream):
+    stream([RESPONSE[0], RateLimited("429 RESOURCE_EXHAUSTED")], RESPONSE)
+    seen = []
+
+    text = _generate_streamed("gs://b/clip.mp4", "m", None, None, None, None, lambda t, i: seen.append(t))
+
+    assert text == "".join(RESPONSE)
+    # The retry replays the stream from the start
+    assert seen == ["theft", "theft", "congestion"]
+
+
+def test_cancelled_stream_stops(stream):
+    stream(RESPONSE)
+    cancelled = threading.Event()
+
+    def on_incident(incident_type, incident):
+        cancelled.set()
+
+    with pytest.raises(AnalysisCancelled):
+        _generate_streamed("gs://b/clip.mp4", "m", None, None, None, None, on_incident, cancelled)
+
+
+def test_writer_stops_once_cancelled(monkeypatch):
+    written = []
+    monkeypatch.setattr(
+        "utils.early_incidents.persist_incident",
+        lambda db, incident, doc_id, aggregated: written.append(incident["type"]),
+    )
+    marked = []
+    index = SimpleNamespace(mark_active=lambda zone_id, types: marked.extend(types))
+    writer = EarlyIncidentWriter({"zone_id": "Main_Stage"}, "key", active_types=(), db=object(), active_index=index)
+
+    writer("theft", {"score": 0.9})
+    writer.cancelled.set()
+    writer("fire_and_smoke", {"score": 0.9})
+
+    assert written == ["theft"]
+    assert marked == ["theft"]
+    assert writer.aggregated == {"theft"}
+
+
+def test_discarded_writer_deletes_its_incidents(monkeypatch):
+    written = []
+    deleted = []
+    monkeypatch.setattr(
+        "utils.early_incidents.persist_incident",
+        lambda db, incident, doc_id, aggregated: written.append((incident["type"], incident["status"])),
+    )
+    monkeypatch.setattr(
+        "utils.early_incidents.delete_incident",
+        lambda db, incident_type, doc_id, aggregated: deleted.append((incident_type, aggregated)),
+    )
+    unmarked = []
+    index = SimpleNamespace(
+        mark_active=lambda zone_id, types: None,
+        unmark_active=lambda zone_id, types: unmarked.extend(types),
+    )
+    writer = EarlyIncidentWriter(
+        {"zone_id": "Main_Stage"}, "key", active_types={"theft"}, db=object(), active_index=index,
+    )
+
+    writer("theft", {"score": 0.9})
+    writer("fire_and_smoke", {"score": 0.9})
+    writer.discard()
+
+    assert written == [("theft", "provisional"), ("fire_and_smoke", "provisional")]
+    assert deleted == [("fire_and_smoke", True), ("theft", False)]
+    assert unmarked == ["fire_and_smoke"]
+    assert writer.aggregated == set()
+
+
+def test_write_landing_after_discard_is_deleted(monkeypatch):
+    deleted = []
+    writer = EarlyIncidentWriter({"zone_id": "Main_Stage"}, "key", db=object())
+    # The message fails while the write is in flight
+    monkeypatch.setattr(
+        "utils.early_incidents.persist_incident", lambda db, incident, doc_id, aggregated: writer.discard(),
+    )
+    monkeypatch.setattr(
+        "utils.early_incidents.delete_incident",
+        lambda db, incident_type, doc_id, aggregated: deleted.append(incident_type),
+    )
+
+    writer("theft", {"score": 0.9})
+
+    assert deleted == ["theft", "theft"]
+    assert writer.aggregated == set()
@@ -0,0 +1,21 @@
+from utils.video_segments import merge_window_results, shift_ranges
+
+
+def test_window_ranges_are_always_offset():
+    # Even a range that would fit the clip as-is is taken to be window-relative
+    assert shift_ranges([{"start": 2.0, "end": 40.0}, {"start": None, "end": 3.0}], (25.0, 55.0)) == [
+        {"start": 27.0, "end": 65.0},
+    ]
+
+
+def test_merged_timestamps_are_in_clip_time():
+    windows = [(0.0, 30.0), (25.0, 55.0)]
+    results = [
+        {"incidents": {"theft": {"score": 0.4, "explanation": "a", "timestamps": [{"start": 20.0, "end": 28.0}]}}},
+        {"incidents": {"theft": {"score": 0.8, "explanation": "b", "timestamps": [{"start": 1.0, "end": 5.0}]}}},
+    ]
+
+    theft = merge_window_results(windows, results)["incidents"]["theft"]
+
+    assert theft["score"] == 0.8
+    assert theft["timestamps"] == [{"start": 20.0, "end": 30.0}]
@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+import threading
+from utils.clients import get_firestore_client
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_INCIDENT_INDEX_ENABLED = os.environ.get("ACTIVE_INCIDENT_INDEX_ENABLED", "true").lower() == "true"
+# How long warm-up waits for the listener's first snapshot
+ACTIVE_INCIDENT_READY_TIMEOUT = float(os.environ.get("ACTIVE_INCIDENT_READY_TIMEOUT", "2"))
+# How long a locally written incident counts as active before the listener confirms it
+ACTIVE_INCIDENT_PENDING_TTL = float(os.environ.get("ACTIVE_INCIDENT_PENDING_TTL", "60"))
+
+
+class ActiveIncidentIndex:
+    """
+    In-process index of the active aggregated incident types in each zone.
+
+    Seeded and kept current by an on_snapshot listener on the active
+    'aggregrated_incidents' documents, so the dedup check on the hot path is a
+    dictionary lookup instead of a Firestore query. Incidents this instance
+    has just written are marked active immediately, so messages arriving
+    before the listener catches up don't create duplicates.
+    """
+
+    def __init__(self, db=None, collection='aggregrated_incidents',
+                 ready_timeout=ACTIVE_INCIDENT_READY_TIMEOUT, pending_ttl=ACTIVE_INCIDENT_PENDING_TTL):
+        self._db = db
+        self.collection = collection
+        self.ready_timeout = ready_timeout
+        self.pending_ttl = pending_ttl
+
+        self._zones = {}    # zone_id -> {doc_id: incident type}
+        self._doc_zones = {}  # doc_id -> zone_id
+        self._pending = {}  # (zone_id, incident type) -> expiry time
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+
+    @property
+    def db(self):
+        """The Firestore client, created on first use unless one was passed in."""
+        return self._db if self._db is not None else get_firestore_client()
+
+    def start(self):
+        """Start listening, if not already; the first snapshot seeds the index."""
+        with self._start_lock:
+            if self._watch is not None:
+                return
+            query = self.db.collection(self.collection).where('status', '==', 'active')
+            self._watch = query.on_snapshot(self._on_snapshot)
+        logger.info(f"Listening for active incidents in {self.collection}")
+
+    def wait_ready(self, timeout=None):
+        """
+        Start listening and wait for the first snapshot, once, e.g. at warm-up.
+
+        Waits up to ready_timeout unless timeout is given; returns whether the
+        index is ready.
+        """
+        self.start()
+        ready = self._ready.wait(self.ready_timeout if timeout is None else timeout)
+        if not ready:
+            logger.warning(f"Active incident index not seeded after {self.ready_timeout}s, still listening")
+        return ready
+
+    def stop(self):
+        with self._start_lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+
+    def active_types(self, zone_id):
+        """
+        Return the set of active incident types in zone_id.
+
+        Returns None without waiting while the listener hasn't delivered its
+        first snapshot, so the caller can fall back to querying Firestore.
+        """
+        if not self._ready.is_set():
+            if self._watch is None:
+                self.start()
+            return None
+        now = time.monotonic()
+        with self._lock:
+            types = set(self._zones.get(zone_id, {}).values())
+            for (pending_zone, incident_type), expires_at in list(self._pending.items()):
+                if expires_at <= now:
+                    del self._pending[(pending_zone, incident_type)]
+                elif pending_zone == zone_id:
+                    types.add(incident_type)
+        return types
+
+    def mark_active(self, zone_id, incident_types):
+        """Record incident types just written for zone_id until the listener sees them."""
+        expires_at = time.monotonic() + self.pending_ttl
+        with self._lock:
+            for incident_type in incident_types:
+                self._pending[(zone_id, incident_type)] = expires_at
+
+    def unmark_active(self, zone_id, incident_types):
+        """Forget incident types marked active for zone_id whose documents were removed again."""
+        with self._lock:
+            for incident_type in incident_types:
+                self._pending.pop((zone_id, incident_type), None)
+
+    def _on_snapshot(self, doc_snapshots, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc_id = change.document.id
+                previous_zone = self._doc_zones.pop(doc_id, None)
+                if previous_zone is not None:
+                    self._zones.get(previous_zone, {}).pop(doc_id, None)
+                if change.type.name == 'REMOVED':
+                    continue
+
+                incident = change.document.to_dict()
+                zone_id, incident_type = incident.get('zone_id'), incident.get('type')
+                self._zones.setdefault(zone_id, {})[doc_id] = incident_type
+                self._doc_zones[doc_id] = zone_id
+                self._pending.pop((zone_id, incident_type), None)
+
+        if not self._ready.is_set():
+            logger.info(f"Active incident index seeded with {len(doc_snapshots)} incidents")
+            self._ready.set()
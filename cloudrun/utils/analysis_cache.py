@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+import datetime
+from collections import OrderedDict
+from utils.clients import get_firestore_client, get_storage_client
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_CACHE_ENABLED = os.environ.get("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+ANALYSIS_CACHE_TTL = int(os.environ.get("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", "256"))
+ANALYSIS_CACHE_COLLECTION = os.environ.get("ANALYSIS_CACHE_COLLECTION", "analysis_cache")
+
+
+def cache_key(gcs_uri, model, prompt, *variant):
+    """
+    Builds a content-addressed cache key for analysing gcs_uri with model and prompt.
+
+    variant holds anything else that changes the result, e.g. the windows of
+    a segmented analysis.
+
+    The key includes the object's generation and md5, so an overwritten clip
+    never hits a stale entry. Returns None when the object version can't be
+    determined (non-GCS URI or metadata lookup failure), in which case the
+    result must not be cached.
+    """
+    if not gcs_uri or not gcs_uri.startswith("gs://"):
+        return None
+    bucket_name, _, blob_name = gcs_uri[len("gs://"):].partition("/")
+    try:
+        blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    except Exception as e:
+        logger.warning(f"Could not read object metadata for {gcs_uri}, not caching: {str(e)}")
+        return None
+    if blob is None:
+        return None
+
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    parts = [gcs_uri, str(blob.generation), blob.md5_hash or "", model, prompt_hash, *variant]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Two-tier cache for video analysis results.
+
+    An in-process LRU (bounded by max_entries) sits in front of a Firestore
+    collection shared by all instances. Entries in both tiers expire after ttl
+    seconds; Firestore documents carry an 'expires_at' field so a TTL policy
+    on the collection can delete them server side.
+    """
+
+    def __init__(self, db=None, collection=ANALYSIS_CACHE_COLLECTION,
+                 max_entries=ANALYSIS_CACHE_MAX_ENTRIES, ttl=ANALYSIS_CACHE_TTL):
+        self._db = db
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        """The Firestore client, created on first use unless one was passed in."""
+        return self._db if self._db is not None else get_firestore_client()
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss."""
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    log_sampled(logger, "Analysis cache hit", tier="memory", key=key)
+                    return result
+                del self._entries[key]
+
+        try:
+            snapshot = self.db.collection(self.collection).document(key).get()
+        except Exception as e:
+            logger.warning(f"Analysis cache lookup failed for {key}: {str(e)}")
+            return None
+        if not snapshot.exists:
+            return None
+
+        doc = snapshot.to_dict()
+        expires_at = doc["expires_at"].timestamp()
+        if expires_at <= time.time():
+            return None
+        log_sampled(logger, "Analysis cache hit", tier="firestore", key=key)
+        self._remember(key, expires_at, doc["result"])
+        return doc["result"]
+
+    def put(self, key, result, **metadata):
+        """Store result under key in both tiers; metadata is saved alongside it in Firestore."""
+        if key is None:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, result)
+        try:
+            self.db.collection(self.collection).document(key).set({
+                **metadata,
+                "result": result,
+                "created_at": datetime.datetime.now(datetime.timezone.utc),
+                "expires_at": datetime.datetime.fromtimestamp(expires_at, datetime.timezone.utc),
+            })
+        except Exception as e:
+            logger.warning(f"Failed to persist analysis cache entry {key}: {str(e)}")
+
+    def _remember(self, key, expires_at, result):
+        with self._lock:
+            self._entries[key] = (expires_at, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
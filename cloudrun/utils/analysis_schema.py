@@ -0,0 +1,109 @@
+"""
+Typed shape of a Gemini video analysis.
+
+The same models are passed to Gemini as the response_schema, so the model is
+constrained to produce exactly this JSON, and used to parse the response.
+"""
+from functools import lru_cache
+from typing import List
+from pydantic import BaseModel, Field, create_model
+
+
+class TimeRange(BaseModel):
+    start: float
+    end: float
+
+
+class IncidentAssessment(BaseModel):
+    score: float = Field(description="Confidence from 0.0 (not present) to 1.0 (definitely present)")
+    explanation: str
+    timestamps: List[TimeRange] = Field(
+        description="Seconds from the start of the footage analysed, not of the full video when it is clipped "
+                    "to a segment, where the incident occurs; empty if not applicable",
+    )
+
+
+class CrowdDensity(BaseModel):
+    persons_per_sq_m: float
+    explanation: str
+
+
+class ZoneCapacity(BaseModel):
+    estimated_capacity: int
+    explanation: str
+
+
+class ScoredAssessment(BaseModel):
+    score: float
+    explanation: str
+
+
+@lru_cache(maxsize=None)
+def _build_analysis_schema(incident_types: tuple):
+    incidents = create_model(
+        "Incidents",
+        **{incident_type: (IncidentAssessment, ...) for incident_type in incident_types},
+    )
+    return create_model(
+        "VideoAnalysis",
+        incidents=(incidents, ...),
+        crowd_density=(CrowdDensity, ...),
+        crowd_sentiment=(ScoredAssessment, ...),
+        zone_capacity=(ZoneCapacity, ...),
+        normalized_crowd_density=(ScoredAssessment, ...),
+        normalized_flow_speed=(ScoredAssessment, ...),
+        overall_safety_assessment=(str, ...),
+        recommended_actions=(List[str], ...),
+    )
+
+
+def build_analysis_schema(incident_types):
+    """
+    The VideoAnalysis model for a set of incident types.
+
+    Each incident type becomes a required field of 'incidents', so the model
+    has to assess every one of them. Models are cached per set of types.
+    """
+    return _build_analysis_schema(tuple(incident_types))
+
+
+def parse_analysis(schema, response_text: str):
+    """
+    Parse a schema-constrained response into an instance of schema.
+
+    Raises pydantic.ValidationError if the response doesn't match the schema,
+    e.g. because it was truncated.
+    """
+    return schema.model_validate_json(response_text)
+
+
+def _inline_schema(node, defs):
+    if isinstance(node, list):
+        return [_inline_schema(item, defs) for item in node]
+    if not isinstance(node, dict):
+        return node
+    if "$ref" in node:
+        return _inline_schema(defs[node["$ref"].rsplit("/", 1)[-1]], defs)
+    inlined = {}
+    for key, value in node.items():
+        if key in ("$defs", "title"):
+            continue
+        if key == "type":
+            inlined[key] = value.upper()
+        elif key == "properties":
+            inlined[key] = {name: _inline_schema(prop, defs) for name, prop in value.items()}
+        else:
+            inlined[key] = _inline_schema(value, defs)
+    return inlined
+
+
+def response_schema_dict(schema) -> dict:
+    """
+    schema as a Vertex responseSchema for raw REST requests, e.g. batch prediction input.
+
+    The SDK does this conversion itself for online calls; here the JSON schema
+    pydantic produces has its $refs inlined and its types in Vertex's
+    upper-case form.
+    """
+    json_schema = schema.model_json_schema()
+    return _inline_schema(json_schema, json_schema.get("$defs", {}))
@@ -0,0 +1,18 @@
+# BigQuery destination for per-message vision / analysis rows
+project_id = "qualified-acre-466511-u6"
+dataset_id = "vision_ml"
+table_name = "vision_ml_table"
+table_id = f"{project_id}.{dataset_id}.{table_name}"
+
+# (name, type) pairs for vision_ml_table, provisioned by provision.py
+VISION_ML_TABLE_SCHEMA = [
+    ("image_uri", "STRING"),
+    ("zone_id", "STRING"),
+    ("video_id", "STRING"),
+    ("timestamp", "TIMESTAMP"),
+    ("camera_id", "STRING"),
+    ("faces_count", "INTEGER"),
+    ("location_lat", "FLOAT"),
+    ("location_long", "FLOAT"),
+    ("bottle_neck_index", "FLOAT"),
+]
@@ -0,0 +1,190 @@
+import os
+import time
+import uuid
+import atexit
+import signal
+import logging
+import threading
+from utils.clients import get_bigquery_client
+from utils.metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+BQ_SINK_MAX_ROWS = int(os.environ.get("BQ_SINK_MAX_ROWS", "500"))
+BQ_SINK_MAX_LATENCY = float(os.environ.get("BQ_SINK_MAX_LATENCY", "5"))
+BQ_SINK_MAX_BUFFERED_ROWS = int(os.environ.get("BQ_SINK_MAX_BUFFERED_ROWS", "50000"))
+
+
+class BigQuerySink:
+    """
+    Buffers rows from all request threads and streams them to BigQuery in batches.
+
+    A background thread flushes the buffer with batched insert_rows_json calls
+    as soon as max_rows rows are waiting, or max_latency seconds after the
+    oldest buffered row arrived, whichever comes first. Rows from a failed
+    request are put back and retried on the next flush; if BigQuery stays
+    unavailable the buffer is capped at max_buffered_rows, dropping the oldest.
+    Every row keeps the same insertId across retries, so BigQuery can drop
+    duplicates of a request that succeeded but was reported as failed.
+
+    on_inserted, if given, is called from the flushing thread with the row_ids
+    passed to add_rows for the rows of each batch BigQuery accepted.
+    """
+
+    def __init__(self, table_id, client=None, max_rows=BQ_SINK_MAX_ROWS,
+                 max_latency=BQ_SINK_MAX_LATENCY, max_buffered_rows=BQ_SINK_MAX_BUFFERED_ROWS,
+                 on_inserted=None):
+        self.table_id = table_id
+        self._client = client
+        self.on_inserted = on_inserted
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.max_buffered_rows = max_buffered_rows
+
+        self._rows = []
+        self._first_row_at = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="bigquery-sink", daemon=True)
+        self._thread.start()
+
+    @property
+    def client(self):
+        """The BigQuery client, created on first use unless one was passed in."""
+        return self._client if self._client is not None else get_bigquery_client()
+
+    def add_rows(self, rows, row_ids=None):
+        """
+        Queue rows for insertion; returns immediately.
+
+        row_ids are used as BigQuery insertIds for best-effort deduplication;
+        random ids are generated when they are not given, and those rows are
+        not reported to on_inserted.
+        """
+        tracked = row_ids is not None
+        if row_ids is None:
+            row_ids = [uuid.uuid4().hex for _ in rows]
+        entries = [(row_id, row, tracked) for row_id, row in zip(row_ids, rows)]
+        with self._cond:
+            if not self._closed:
+                self._buffer(entries)
+                if len(self._rows) >= self.max_rows:
+                    self._cond.notify()
+                return
+        # Requests still in flight after a shutdown drain insert synchronously
+        if not self._insert(entries):
+            raise RuntimeError(f"Failed to insert rows into {self.table_id}")
+
+    def close(self, timeout=None):
+        """Flush everything still buffered and stop the background thread."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        logger.info(f"BigQuery sink for {self.table_id} drained")
+
+    def _buffer(self, entries, front=False):
+        if not entries:
+            return
+        if not self._rows:
+            self._first_row_at = time.monotonic()
+        self._rows = entries + self._rows if front else self._rows + entries
+        overflow = len(self._rows) - self.max_buffered_rows
+        if overflow > 0:
+            logger.error(f"BigQuery sink buffer full, dropping {overflow} oldest rows")
+            self._rows = self._rows[overflow:]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._rows) >= self.max_rows:
+                        break
+                    if not self._rows:
+                        self._cond.wait()
+                        continue
+                    remaining = self._first_row_at + self.max_latency - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                rows, self._rows = self._rows, []
+                closed = self._closed
+
+            for start in range(0, len(rows), self.max_rows):
+                chunk = rows[start:start + self.max_rows]
+                if not self._insert(chunk) and not closed:
+                    with self._cond:
+                        self._buffer(rows[start:], front=True)
+                    # Back off until the next latency window before retrying
+                    time.sleep(self.max_latency)
+                    break
+
+            if closed:
+                return
+
+    def _insert(self, entries):
+        """Insert one batch of (row_id, row, tracked) entries; returns False if the request should be retried."""
+        row_ids = [row_id for row_id, _, _ in entries]
+        rows = [row for _, row, _ in entries]
+        try:
+            # Batches mix rows from every zone
+            with stage_timer("bigquery_insert", zone_id="all") as timer:
+                errors = self.client.insert_rows_json(self.table_id, rows, row_ids=row_ids)
+                if errors:
+                    timer.outcome = "error"
+        except Exception as e:
+            logger.error(f"Failed to insert {len(rows)} rows into {self.table_id}: {str(e)}")
+            return False
+        if errors:
+            # Row-level errors are permanent (bad schema / values), don't retry them
+            logger.error(f"BigQuery rejected rows in {self.table_id}: {errors}")
+        else:
+            logger.info(f"Inserted {len(rows)} rows into {self.table_id}")
+        self._notify_inserted(entries, errors)
+        return True
+
+    def _notify_inserted(self, entries, errors):
+        if self.on_inserted is None:
+            return
+        rejected = {error.get("index") for error in errors or ()}
+        inserted = [row_id for index, (row_id, _, tracked) in enumerate(entries)
+                    if tracked and index not in rejected]
+        if not inserted:
+            return
+        try:
+            self.on_inserted(inserted)
+        except Exception as e:
+            logger.error(f"on_inserted callback failed for {len(inserted)} rows in {self.table_id}: {str(e)}")
+
+
+def drain_on_shutdown(sink):
+    """
+    Drain sink when the process exits or receives SIGTERM.
+
+    Cloud Run sends SIGTERM before stopping an instance. Any SIGTERM handler
+    already installed (e.g. gunicorn's graceful shutdown) still runs after the
+    sink has been drained.
+    """
+    atexit.register(sink.close)
+
+    try:
+        previous_handler = signal.getsignal(signal.SIGTERM)
+    except ValueError:
+        return
+
+    def _handle_sigterm(signum, frame):
+        logger.info("SIGTERM received, draining BigQuery sink")
+        sink.close()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+        elif previous_handler == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    try:
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        logger.warning("Not in the main thread, BigQuery sink will only drain at exit")
@@ -0,0 +1,174 @@
+"""
+Lazily created, process-wide Google Cloud clients.
+
+Nothing here touches the network or imports a client library until a client
+is first asked for, so importing the service stays cheap and the first
+request (or warm_up) pays for client setup instead of the cold start.
+"""
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Vision requests are spread round-robin over this many clients, each with its own gRPC channel
+VISION_CHANNEL_POOL_SIZE = int(os.environ.get("VISION_CHANNEL_POOL_SIZE", "1"))
+# gRPC options for the Vision channels, merged over the defaults below, e.g. {"grpc.keepalive_time_ms": 60000}
+VISION_CHANNEL_OPTIONS = json.loads(os.environ.get("VISION_CHANNEL_OPTIONS", "{}"))
+VISION_CONNECT_TIMEOUT = float(os.environ.get("VISION_CONNECT_TIMEOUT", "10"))
+
+_DEFAULT_VISION_CHANNEL_OPTIONS = {
+    # Images are sent by reference, but responses with many faces can be large
+    "grpc.max_send_message_length": -1,
+    "grpc.max_receive_message_length": -1,
+    # Ping idle connections so they aren't silently dropped between messages
+    "grpc.keepalive_time_ms": 30000,
+    "grpc.keepalive_timeout_ms": 10000,
+    "grpc.keepalive_permit_without_calls": 1,
+    "grpc.http2.max_pings_without_data": 0,
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                started = time.monotonic()
+                client = factory()
+                _clients[name] = client
+                logger.info(f"Created {name} client in {time.monotonic() - started:.2f}s")
+    return client
+
+
+def get_bigquery_client():
+    def factory():
+        from google.cloud import bigquery
+        return bigquery.Client()
+    return _get_or_create("bigquery", factory)
+
+
+def get_firestore_client():
+    def factory():
+        from google.cloud import firestore
+        return firestore.Client()
+    return _get_or_create("firestore", factory)
+
+
+def get_async_firestore_client():
+    def factory():
+        from google.cloud import firestore
+        return firestore.AsyncClient()
+    return _get_or_create("firestore_async", factory)
+
+
+def _vision_channel_options():
+    return list({**_DEFAULT_VISION_CHANNEL_OPTIONS, **VISION_CHANNEL_OPTIONS}.items())
+
+
+_vision_round_robin = itertools.count()
+
+
+def _vision_pool():
+    def factory():
+        from google.cloud import vision
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+        return [
+            vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(
+                channel=ImageAnnotatorGrpcTransport.create_channel(options=_vision_channel_options()),
+            ))
+            for _ in range(max(1, VISION_CHANNEL_POOL_SIZE))
+        ]
+    return _get_or_create("vision", factory)
+
+
+def get_vision_client():
+    """
+    A Vision client from the process-wide pool.
+
+    The clients are thread-safe and keep their channels open and alive, so
+    requests only pay for credentials, the TCP connection and TLS once.
+    """
+    pool = _vision_pool()
+    return pool[next(_vision_round_robin) % len(pool)]
+
+
+def warm_up_vision():
+    """Create the Vision pool and wait for its channels to connect."""
+    import grpc
+    for client in _vision_pool():
+        grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=VISION_CONNECT_TIMEOUT)
+
+
+def get_vision_async_client():
+    def factory():
+        from google.cloud import vision
+        from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcAsyncIOTransport
+        return vision.ImageAnnotatorAsyncClient(transport=ImageAnnotatorGrpcAsyncIOTransport(
+            channel=ImageAnnotatorGrpcAsyncIOTransport.create_channel(options=_vision_channel_options()),
+        ))
+    return _get_or_create("vision_async", factory)
+
+
+async def warm_up_vision_async():
+    """
+    Create the async Vision client and wait for its channel to connect.
+
+    Its channel belongs to the event loop, so this runs on the loop rather
+    than as a warm_up task.
+    """
+    import asyncio
+    try:
+        channel = get_vision_async_client().transport.grpc_channel
+        await asyncio.wait_for(channel.channel_ready(), timeout=VISION_CONNECT_TIMEOUT)
+        logger.info("Vision channel ready")
+    except Exception as e:
+        logger.warning(f"Vision warm-up failed: {str(e)}")
+
+
+def get_genai_client():
+    def factory():
+        from google import genai
+        from google.genai.types import HttpOptions
+        return genai.Client(http_options=HttpOptions(api_version="v1"))
+    return _get_or_create("genai", factory)
+
+
+def get_storage_client():
+    def factory():
+        from google.cloud import storage
+        return storage.Client()
+    return _get_or_create("storage", factory)
+
+
+def warm_up(*tasks):
+    """
+    Run warm-up tasks on a background thread.
+
+    Each task is a zero-argument callable, typically one that creates a client
+    and issues a cheap call so its channel and connection pool are open before
+    real traffic arrives. Failures are logged and otherwise ignored; the
+    request path creates whatever is still missing on demand.
+    """
+    if os.environ.get("WARM_UP_CLIENTS", "true").lower() != "true":
+        return None
+
+    def run():
+        started = time.monotonic()
+        for task in tasks:
+            try:
+                task()
+            except Exception as e:
+                logger.warning(f"Warm-up task {getattr(task, '__name__', task)} failed: {str(e)}")
+        logger.info(f"Client warm-up finished in {time.monotonic() - started:.2f}s")
+
+    thread = threading.Thread(target=run, name="client-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,198 @@
+"""
+Pluggable backends for counting the faces (and people) in a camera image.
+
+"vision" sends the image to the Cloud Vision API, as the service always has.
+"opencv" runs OpenCV detectors on the instance's CPU instead, trading some
+accuracy for no network round-trip and no per-image charge. The backend is
+chosen with COUNTING_BACKEND; benchmark_counting.py compares them.
+
+Every backend returns detect_faces_uri's result shape, with 'total_faces'
+as the count, plus 'total_persons' where the backend counts people. OpenCV
+has no emotion likelihoods, so its results carry no 'emotions'.
+"""
+import os
+import abc
+import time
+import asyncio
+import logging
+import threading
+import urllib.request
+from utils.clients import get_storage_client, warm_up_vision
+from utils.vision_ml import detect_faces_uri, detect_faces_uri_async, face_area_histogram, FACE_DETAIL_ENABLED
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
+
+COUNTING_BACKEND = os.environ.get("COUNTING_BACKEND", "vision")
+# ONNX face model for cv2.FaceDetectorYN (e.g. OpenCV Zoo's face_detection_yunet_2023mar.onnx);
+# without it, OpenCV's bundled Haar cascade is used
+COUNTING_FACE_MODEL = os.environ.get("COUNTING_FACE_MODEL")
+COUNTING_FACE_SCORE = float(os.environ.get("COUNTING_FACE_SCORE", "0.7"))
+COUNTING_PERSONS_ENABLED = os.environ.get("COUNTING_PERSONS_ENABLED", "true").lower() == "true"
+# Images are scaled down to this long edge before detection
+COUNTING_MAX_EDGE = int(os.environ.get("COUNTING_MAX_EDGE", "1280"))
+COUNTING_FETCH_TIMEOUT = float(os.environ.get("COUNTING_FETCH_TIMEOUT", "10"))
+
+
+class CountingBackend(abc.ABC):
+    """Counts faces in the image at a gs:// or http(s) URI."""
+
+    name = None
+
+    @abc.abstractmethod
+    def count(self, uri, timeout=None) -> dict:
+        """Count the faces at uri, spending at most about timeout seconds on network calls."""
+
+    async def count_async(self, uri) -> dict:
+        # CPU-bound or blocking by default, so off the event loop
+        return await asyncio.to_thread(self.count, uri)
+
+    def warm_up(self):
+        """Load whatever the backend needs before the first image."""
+
+
+class VisionBackend(CountingBackend):
+    """Face detection with the Cloud Vision API."""
+
+    name = "vision"
+
+    def count(self, uri, timeout=None) -> dict:
+        return detect_faces_uri(uri, timeout=timeout)
+
+    async def count_async(self, uri) -> dict:
+        return await detect_faces_uri_async(uri)
+
+    def warm_up(self):
+        warm_up_vision()
+
+
+def read_image_bytes(uri, timeout=COUNTING_FETCH_TIMEOUT) -> bytes:
+    if uri.startswith("gs://"):
+        bucket_name, _, blob_name = uri[len("gs://"):].partition("/")
+        return get_storage_client().bucket(bucket_name).blob(blob_name).download_as_bytes(timeout=timeout)
+    with urllib.request.urlopen(uri, timeout=timeout) as response:
+        return response.read()
+
+
+class OpenCVBackend(CountingBackend):
+    """
+    Face and person detection on the CPU with OpenCV.
+
+    Faces are found with a YuNet ONNX model through cv2.FaceDetectorYN when
+    COUNTING_FACE_MODEL is set, else with the Haar cascade bundled with
+    OpenCV; people with OpenCV's HOG pedestrian detector. Detectors aren't
+    safe to share between threads, so each thread gets its own.
+    """
+
+    name = "opencv"
+
+    def __init__(self, face_model=COUNTING_FACE_MODEL, persons=COUNTING_PERSONS_ENABLED, max_edge=COUNTING_MAX_EDGE,
+                 detail=FACE_DETAIL_ENABLED):
+        self.face_model = face_model
+        self.detail = detail
+        self.persons = persons
+        self.max_edge = max_edge
+        self._local = threading.local()
+
+    def _detectors(self):
+        detectors = getattr(self._local, "detectors", None)
+        if detectors is None:
+            import cv2
+            if self.face_model:
+                face_detector = cv2.FaceDetectorYN.create(self.face_model, "", (320, 320), COUNTING_FACE_SCORE)
+            else:
+                face_detector = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+            person_detector = None
+            if self.persons:
+                person_detector = cv2.HOGDescriptor()
+                person_detector.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+            detectors = self._local.detectors = (face_detector, person_detector)
+        return detectors
+
+    def warm_up(self):
+        self._detectors()
+
+    def _decode(self, data):
+        import cv2
+        import numpy as np
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Image could not be decoded")
+        scale = min(1.0, self.max_edge / max(image.shape[:2]))
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return image, scale
+
+    def _faces(self, face_detector, image):
+        import cv2
+        if self.face_model:
+            face_detector.setInputSize((image.shape[1], image.shape[0]))
+            _, detections = face_detector.detect(image)
+            return [(d[0], d[1], d[2], d[3], float(d[-1])) for d in (detections if detections is not None else [])]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return [(x, y, w, h, None) for x, y, w, h in face_detector.detectMultiScale(gray, 1.1, 5, minSize=(24, 24))]
+
+    def detect(self, data) -> dict:
+        """Detect faces (and people) in encoded image bytes."""
+        face_detector, person_detector = self._detectors()
+        image, scale = self._decode(data)
+
+        faces, areas = [], []
+        for x, y, w, h, confidence in self._faces(face_detector, image):
+            # Bounds in the original image's pixels, as Vision reports them
+            x0, y0, x1, y1 = (int(round(v / scale)) for v in (x, y, x + w, y + h))
+            areas.append((x1 - x0) * (y1 - y0))
+            if self.detail:
+                faces.append({
+                    "confidence": confidence,
+                    "bounds": [{"x": x0, "y": y0}, {"x": x1, "y": y0}, {"x": x1, "y": y1}, {"x": x0, "y": y1}],
+                })
+        result = {"success": True, "total_faces": len(areas), "face_area_histogram": face_area_histogram(areas)}
+        if self.detail:
+            result["faces"] = faces
+        if person_detector is not None:
+            rects, _ = person_detector.detectMultiScale(image, winStride=(8, 8), padding=(8, 8), scale=1.05)
+            result["total_persons"] = len(rects)
+        return result
+
+    def count(self, uri, timeout=None) -> dict:
+        try:
+            started = time.monotonic()
+            data = read_image_bytes(uri, min(timeout, COUNTING_FETCH_TIMEOUT) if timeout is not None else COUNTING_FETCH_TIMEOUT)
+            fetched = time.monotonic()
+            result = self.detect(data)
+            log_sampled(
+                logger, "OpenCV counted faces", uri=uri, total_faces=result["total_faces"],
+                total_persons=result.get("total_persons"), fetch_seconds=round(fetched - started, 3),
+                detect_seconds=round(time.monotonic() - fetched, 3),
+            )
+            return result
+        except Exception as e:
+            logger.error(f"Error in OpenCV counting: {str(e)}")
+            return {"success": False, "error": str(e), "total_faces": 0}
+
+
+BACKENDS = {
+    VisionBackend.name: VisionBackend,
+    OpenCVBackend.name: OpenCVBackend,
+}
+
+
+def create_backend(name) -> CountingBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown counting backend {name}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_counting_backend() -> CountingBackend:
+    """The process-wide backend selected by COUNTING_BACKEND."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend(COUNTING_BACKEND)
+            logger.info(f"Counting with the {_backend.name} backend")
+        return _backend
@@ -0,0 +1,203 @@
+"""
+Early persistence of incidents from a streamed video analysis.
+
+Gemini writes an explanation and timestamps for every incident type, so a
+fire_and_smoke or active_shooter detection can sit behind many other
+assessments before the full response arrives. With the response streamed,
+each incident that crosses the threshold is written to 'incidents' (and to
+'aggregrated_incidents' if its type isn't active in the zone yet) as soon as
+its assessment is complete; the report and everything else follow when the
+analysis finishes.
+
+Early incidents are written with a provisional status, which the message's
+full write replaces with the final one. If the message fails before then,
+e.g. the analysis times out, they are deleted again, so an analysis that
+didn't complete leaves no alerts behind; a redelivery writes them afresh.
+"""
+import os
+import time
+import logging
+import threading
+import contextlib
+from utils.clients import get_firestore_client, get_async_firestore_client
+from utils.firestore_persistence import persist_incident, persist_incident_async, delete_incident, delete_incident_async
+from utils.message_records import build_incident, is_incident
+from utils.metrics import stage_timer, observe_time_to_alert
+
+logger = logging.getLogger(__name__)
+
+EARLY_INCIDENTS_ENABLED = os.environ.get("EARLY_INCIDENTS_ENABLED", "true").lower() == "true"
+# Status of an incident written ahead of its message's full write
+PROVISIONAL_STATUS = "provisional"
+
+
+class EarlyIncidentWriter:
+    """
+    on_incident callback for analyze_video that persists one message's incidents as they stream in.
+
+    Documents get the ids persist_message_results derives from doc_id, so the
+    full write of the message overwrites them with the final (for segmented
+    clips, merged) assessment instead of duplicating them. Each incident type
+    is written at most once, however many windows report it. Types written
+    to 'aggregrated_incidents' are marked active in active_index, and listed
+    in aggregated so the full write still overwrites them. Nothing is written
+    once cancelled (a threading.Event) is set, i.e. after the message stopped
+    waiting for the analysis, and discard() removes what was written when the
+    message fails. Also records the time to alert of every incident of the
+    message.
+    """
+
+    def __init__(self, message_data, doc_id, active_types=(), db=None, active_index=None, cancelled=None):
+        self.message_data = message_data
+        self.doc_id = doc_id
+        self.active_types = set(active_types or ())
+        self._db = db
+        self.active_index = active_index
+        self.cancelled = cancelled if cancelled is not None else threading.Event()
+        self.started = time.monotonic()
+        self.written = set()
+        self.aggregated = set()
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        return self._db if self._db is not None else get_firestore_client()
+
+    def _claim(self, incident_type, incident_data):
+        """Build the incident to write now, or None if it is below the threshold or already written."""
+        if not is_incident(incident_data) or self.cancelled.is_set():
+            return None
+        with self._lock:
+            if incident_type in self.written:
+                return None
+            self.written.add(incident_type)
+        return dict(build_incident(self.message_data, incident_type, incident_data), status=PROVISIONAL_STATUS)
+
+    def _release(self, incident_type):
+        # Let a later window retry a failed write; the full write covers it otherwise
+        with self._lock:
+            self.written.discard(incident_type)
+
+    def _persisted(self, incident, aggregated):
+        """Whether the write stands; False if the message was cancelled while it was in flight."""
+        if self.cancelled.is_set():
+            return False
+        if aggregated:
+            with self._lock:
+                self.aggregated.add(incident.get('type'))
+            if self.active_index is not None:
+                # Later messages from the zone must see it before the listener does
+                self.active_index.mark_active(self.message_data.get('zone_id'), [incident.get('type')])
+        observe_time_to_alert(incident.get('severity'), time.monotonic() - self.started, "early")
+        logger.info(
+            f"Persisted {incident.get('severity')} incident {incident.get('type')} for "
+            f"{self.message_data.get('video_uri')} ahead of the report"
+        )
+        return True
+
+    def _cancel(self):
+        """Stop writing and return [(incident type, aggregated)] of the incidents to delete."""
+        self.cancelled.set()
+        with self._lock:
+            written = sorted(self.written)
+            aggregated = set(self.aggregated)
+            self.aggregated.clear()
+        if aggregated and self.active_index is not None:
+            self.active_index.unmark_active(self.message_data.get('zone_id'), aggregated)
+        return [(incident_type, incident_type not in self.active_types) for incident_type in written]
+
+    def _delete_failed(self, incident_type, e):
+        logger.error(f"Failed to delete provisional incident {incident_type} of {self.doc_id}: {str(e)}")
+
+    def __call__(self, incident_type, incident_data):
+        incident = self._claim(incident_type, incident_data)
+        if incident is None:
+            return
+        aggregated = incident_type not in self.active_types
+        try:
+            with stage_timer("early_incident_write"):
+                persist_incident(self.db, incident, self.doc_id, aggregated=aggregated)
+        except Exception:
+            self._release(incident_type)
+            raise
+        if not self._persisted(incident, aggregated):
+            # discard() may have run before this write landed
+            self._delete(incident_type, aggregated)
+
+    def _delete(self, incident_type, aggregated):
+        try:
+            delete_incident(self.db, incident_type, self.doc_id, aggregated=aggregated)
+        except Exception as e:
+            self._delete_failed(incident_type, e)
+
+    def discard(self):
+        """
+        Stop writing and delete the incidents written so far, e.g. when the message failed.
+
+        Deletion errors are logged rather than raised, so they don't hide the
+        message's own failure.
+        """
+        for incident_type, aggregated in self._cancel():
+            self._delete(incident_type, aggregated)
+
+    def record_report(self, incidents):
+        """Record the time to alert of incidents that were only persisted with the report."""
+        elapsed = time.monotonic() - self.started
+        for incident in incidents:
+            if incident.get('type') not in self.written:
+                observe_time_to_alert(incident.get('severity'), elapsed, "report")
+
+
+class AsyncEarlyIncidentWriter(EarlyIncidentWriter):
+    """EarlyIncidentWriter for analyze_video_async, writing through the async Firestore client."""
+
+    @property
+    def db(self):
+        return self._db if self._db is not None else get_async_firestore_client()
+
+    async def __call__(self, incident_type, incident_data):
+        incident = self._claim(incident_type, incident_data)
+        if incident is None:
+            return
+        aggregated = incident_type not in self.active_types
+        try:
+            with stage_timer("early_incident_write"):
+                await persist_incident_async(self.db, incident, self.doc_id, aggregated=aggregated)
+        except Exception:
+            self._release(incident_type)
+            raise
+        if not self._persisted(incident, aggregated):
+            await self._delete(incident_type, aggregated)
+
+    async def _delete(self, incident_type, aggregated):
+        try:
+            await delete_incident_async(self.db, incident_type, self.doc_id, aggregated=aggregated)
+        except Exception as e:
+            self._delete_failed(incident_type, e)
+
+    async def discard(self):
+        """EarlyIncidentWriter.discard for the async client."""
+        for incident_type, aggregated in self._cancel():
+            await self._delete(incident_type, aggregated)
+
+
+@contextlib.contextmanager
+def discarded_on_failure(writer):
+    """Call writer.discard() if the block raises; writer may be None."""
+    try:
+        yield
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+
+
+@contextlib.asynccontextmanager
+async def discarded_on_failure_async(writer):
+    """discarded_on_failure for an AsyncEarlyIncidentWriter, which is also discarded if the task is cancelled."""
+    try:
+        yield
+    except BaseException:
+        if writer is not None:
+            await writer.discard()
+        raise
@@ -0,0 +1,222 @@
+import os
+import atexit
+import logging
+import threading
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
+
+# "batch": every message is committed as one atomic WriteBatch (default).
+# "bulk": writes are queued on a process-wide BulkWriter shared by all request
+#         threads, which coalesces them into large parallel batches. A message
+#         returns once a flush has committed its writes, and concurrent messages
+#         share flushes. Writes are retried by the BulkWriter but are no longer
+#         atomic per message.
+FIRESTORE_WRITE_MODE = os.environ.get("FIRESTORE_WRITE_MODE", "batch")
+BULK_WRITE_MAX_ATTEMPTS = int(os.environ.get("BULK_WRITE_MAX_ATTEMPTS", "5"))
+
+_bulk_writer = None
+# Guards the BulkWriter, which isn't thread-safe, and the flush counters below
+_bulk_writer_lock = threading.Lock()
+# Calls that queued writes, and how many of them the last completed flush covered
+_bulk_queued = 0
+_bulk_flushed = 0
+# Document paths of writes the BulkWriter gave up on, until their caller picks them up
+_bulk_failed_paths = set()
+_bulk_failed_lock = threading.Lock()
+
+
+class BulkWriteError(Exception):
+    """Writes queued on the shared BulkWriter failed after all their attempts."""
+
+
+def _on_bulk_write_error(failure, bulk_writer):
+    """Log a failed BulkWriter operation and decide whether to retry it."""
+    logger.error(f"Bulk write failed (attempt {failure.attempts}): {failure.message}")
+    if failure.attempts < BULK_WRITE_MAX_ATTEMPTS:
+        return True
+    with _bulk_failed_lock:
+        _bulk_failed_paths.add(failure.operation.reference._document_path)
+    return False
+
+
+def get_bulk_writer(db):
+    """Return the process-wide BulkWriter, creating it on first use."""
+    global _bulk_writer
+    with _bulk_writer_lock:
+        if _bulk_writer is None:
+            _bulk_writer = db.bulk_writer()
+            _bulk_writer.on_write_error(_on_bulk_write_error)
+            logger.info("Created shared Firestore BulkWriter")
+        return _bulk_writer
+
+
+def flush_bulk_writer():
+    """Block until every write queued on the shared BulkWriter is committed."""
+    with _bulk_writer_lock:
+        if _bulk_writer is not None:
+            _bulk_writer.flush()
+
+
+atexit.register(flush_bulk_writer)
+
+
+def _bulk_write(db, writes, wait=True):
+    """
+    Queue writes on the shared BulkWriter and, if wait, return once they are committed.
+
+    The writes are queued, then the writer is flushed unless a flush started
+    since has already covered them, so messages arriving together are
+    committed by one flush. Raises BulkWriteError if the BulkWriter gave up on
+    any of them, so the message isn't acknowledged with writes missing.
+    """
+    global _bulk_queued, _bulk_flushed
+    bulk_writer = get_bulk_writer(db)
+    with _bulk_writer_lock:
+        for doc_ref, data, merge in writes:
+            bulk_writer.set(doc_ref, data, merge=merge)
+        _bulk_queued += 1
+        ticket = _bulk_queued
+    if not wait:
+        return
+    with _bulk_writer_lock:
+        if _bulk_flushed < ticket:
+            covered = _bulk_queued
+            bulk_writer.flush()
+            _bulk_flushed = covered
+
+    paths = {doc_ref._document_path for doc_ref, _, _ in writes}
+    with _bulk_failed_lock:
+        failed = paths & _bulk_failed_paths
+        _bulk_failed_paths.difference_update(failed)
+    if failed:
+        raise BulkWriteError(f"{len(failed)} of {len(writes)} bulk writes failed: {sorted(failed)}")
+
+
+def _document(db, collection, doc_id=None, suffix=None):
+    if doc_id is None:
+        return db.collection(collection).document()
+    return db.collection(collection).document(f"{doc_id}-{suffix}" if suffix else doc_id)
+
+
+def _plan_writes(db, incidents, report, aggregated_incidents, doc_id=None, ledger_write=None):
+    """Return ([(doc_ref, data, merge)], incident_refs) for one message's documents."""
+    incident_refs = [_document(db, 'incidents', doc_id, incident.get('type')) for incident in incidents]
+    report_ref = _document(db, 'analysis_reports', doc_id)
+
+    writes = [(doc_ref, data, False) for doc_ref, data in zip(incident_refs, incidents)]
+    writes.append((report_ref, dict(report, incident_refs=incident_refs), False))
+    writes.extend(
+        (_document(db, 'aggregrated_incidents', doc_id, incident.get('type')), incident, False)
+        for incident in aggregated_incidents
+    )
+    if ledger_write is not None:
+        writes.append((*ledger_write, True))
+    return writes, incident_refs
+
+
+def persist_message_results(db, incidents, report, aggregated_incidents, doc_id=None, ledger_write=None, mode=None,
+                            wait=True):
+    """
+    Persists everything produced for one message.
+
+    Writes each incident to 'incidents', the report to 'analysis_reports'
+    (with 'incident_refs' pointing at the new incident documents) and each new
+    aggregated incident to 'aggregrated_incidents'. Document ids are generated
+    client side, so no round-trip is needed until the commit.
+
+    When doc_id is given, document ids are derived from it (and the incident
+    type) instead of being random, so persisting the same message twice
+    overwrites rather than duplicates. ledger_write is an optional
+    (doc_ref, data) pair merged in the same commit. mode overrides
+    FIRESTORE_WRITE_MODE for this call. Either way, the writes are committed
+    when this returns, unless wait is False in bulk mode: then they are only
+    queued, and the caller commits them with flush_bulk_writer().
+
+    Returns the list of incident document ids.
+    """
+    writes, incident_refs = _plan_writes(db, incidents, report, aggregated_incidents, doc_id, ledger_write)
+
+    if (mode or FIRESTORE_WRITE_MODE) == "bulk":
+        _bulk_write(db, writes, wait=wait)
+        log_sampled(
+            logger, f"{'Committed' if wait else 'Queued'} Firestore writes on the shared BulkWriter", writes=len(writes),
+        )
+    else:
+        batch = db.batch()
+        for doc_ref, data, merge in writes:
+            batch.set(doc_ref, data, merge=merge)
+        batch.commit()
+        log_sampled(logger, "Committed Firestore writes in one batch", writes=len(writes))
+
+    return [doc_ref.id for doc_ref in incident_refs]
+
+
+async def persist_message_results_async(db, incidents, report, aggregated_incidents, doc_id=None, ledger_write=None):
+    """
+    Async variant of persist_message_results for a firestore.AsyncClient.
+
+    Always commits one atomic batch; the BulkWriter is only available on the
+    sync client. ledger_write must reference a document from the same client.
+    """
+    writes, incident_refs = _plan_writes(db, incidents, report, aggregated_incidents, doc_id, ledger_write)
+    batch = db.batch()
+    for doc_ref, data, merge in writes:
+        batch.set(doc_ref, data, merge=merge)
+    await batch.commit()
+    log_sampled(logger, "Committed Firestore writes in one batch", writes=len(writes))
+    return [doc_ref.id for doc_ref in incident_refs]
+
+
+def _incident_documents(db, incident_type, doc_id, aggregated):
+    doc_refs = [_document(db, 'incidents', doc_id, incident_type)]
+    if aggregated:
+        doc_refs.append(_document(db, 'aggregrated_incidents', doc_id, incident_type))
+    return doc_refs
+
+
+def _plan_incident_writes(db, incident, aggregated, doc_id):
+    return [(doc_ref, incident) for doc_ref in _incident_documents(db, incident.get('type'), doc_id, aggregated)]
+
+
+def persist_incident(db, incident, doc_id, aggregated=False):
+    """
+    Persists one incident ahead of the rest of its message.
+
+    Writes it to 'incidents', and to 'aggregrated_incidents' if aggregated,
+    under the ids persist_message_results derives from doc_id, so the full
+    write of the message later overwrites these documents instead of
+    duplicating them. Returns the incident document id.
+    """
+    writes = _plan_incident_writes(db, incident, aggregated, doc_id)
+    batch = db.batch()
+    for doc_ref, data in writes:
+        batch.set(doc_ref, data)
+    batch.commit()
+    return writes[0][0].id
+
+
+async def persist_incident_async(db, incident, doc_id, aggregated=False):
+    """Async variant of persist_incident for a firestore.AsyncClient."""
+    writes = _plan_incident_writes(db, incident, aggregated, doc_id)
+    batch = db.batch()
+    for doc_ref, data in writes:
+        batch.set(doc_ref, data)
+    await batch.commit()
+    return writes[0][0].id
+
+
+def delete_incident(db, incident_type, doc_id, aggregated=False):
+    """Deletes the documents persist_incident wrote for incident_type under doc_id."""
+    batch = db.batch()
+    for doc_ref in _incident_documents(db, incident_type, doc_id, aggregated):
+        batch.delete(doc_ref)
+    batch.commit()
+
+
+async def delete_incident_async(db, incident_type, doc_id, aggregated=False):
+    """Async variant of delete_incident for a firestore.AsyncClient."""
+    batch = db.batch()
+    for doc_ref in _incident_documents(db, incident_type, doc_id, aggregated):
+        batch.delete(doc_ref)
+    await batch.commit()
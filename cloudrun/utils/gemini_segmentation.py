@@ -1,20 +1,42 @@
 import os
-import vertexai
-from google import genai
-from google.genai.types import HttpOptions
-from google.cloud import firestore
-from google.genai.types import HttpOptions, Part
-from utils.common_utils import recover_json
+import time
+import asyncio
+import inspect
+import logging
+import contextvars
+from functools import lru_cache
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from utils.analysis_schema import build_analysis_schema, parse_analysis
+from utils.clients import get_genai_client, get_storage_client
+from utils.metrics import stage_timer, count_tokens
+from utils.analysis_cache import AnalysisCache, cache_key, ANALYSIS_CACHE_ENABLED
+from utils.context_cache import PromptCache
+from utils.video_segments import SEGMENTED_ANALYSIS_ENABLED, plan_windows, merge_window_results, shift_ranges
+from utils.incremental_json import StreamedObjectMembers
+from utils.sampling import DEFAULT_PROFILE, MEDIA_RESOLUTIONS
+from utils.rate_limiter import call_with_rate_limit, call_with_rate_limit_async, time_left
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
 
 os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = "1"
 os.environ["GOOGLE_CLOUD_PROJECT"] = "qualified-acre-466511-u6"
 os.environ["GOOGLE_CLOUD_LOCATION"] = "us-central1"
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "config/service_account.json"
 
-# Initialize clients
-vertexai.init(project=os.environ.get("GOOGLE_CLOUD_PROJECT"), location=os.environ.get("GOOGLE_CLOUD_LOCATION"))
-client = genai.Client(http_options=HttpOptions(api_version="v1"))
-db = firestore.Client()
+# The genai client picks up the Vertex project and location from the environment
+# above and is created on first use (see utils.clients), so importing this module
+# doesn't open any clients.
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# Windows of a segmented analysis run on their own pool while the caller waits on them
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "16"))
+segment_executor = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix="segment")
+
+# Redelivered or resubmitted clips reuse the earlier analysis instead of calling Gemini again
+analysis_cache = AnalysisCache()
 
 # Severity mapping for different incident types
 SEVERITY_MAPPING = {
@@ -41,146 +63,40 @@ SEVERITY_MAPPING = {
     "parking_or_traffic_congestion": "medium"
 }
 
-analysis_prompt = """
-Analyze this video and provide a JSON response that assesses the presence of the following safety incidents.
+# What each incident type means, as the prompt describes it to the model
+INCIDENT_DEFINITIONS = {
+    "congestion": "Congestion: Overcrowding of people in a space beyond safe capacity.",
+    "crowd_surges": "Crowd Surges: Sudden, uncontrolled movements of a crowd.",
+    "unruly_behavior": "Unruly behavior: People acting aggressively, fighting, or causing disruption.",
+    "panic_or_danger": "Panic/danger: People showing fear, running chaotically, or responding to threats.",
+    "injuries_from_objects": "Injuries from objects: People getting hurt by falling, moving, or stationary objects.",
+    "injuries_from_slippery_surface": "Injuries from slippery surfaces: Falls or near-falls due to wet/slippery floors.",
+    "cardiac_arrest": "Cardiac arrest: Someone collapsing with signs of possible heart failure.",
+    "unauthorized_access": "Unauthorized access: People entering restricted areas.",
+    "theft": "Theft: Stealing of personal or event property.",
+    "unattended_bags": "Unattended bags: Bags or packages left without an owner.",
+    "weapon_detection": "Weapon detection: Presence of any type of weapon.",
+    "active_shooter": "Active shooter: An individual actively engaged in killing or attempting to kill people in a populated area.",
+    "property_damage": "Property damage: Intentional damage to property.",
+    "missing_signage": "Missing signage: Important signs are missing or broken.",
+    "fire_and_smoke": "Fire and Smoke: Detection of fire or smoke.",
+    "structural_failures": "Structural failures: Breakage of stages, barriers, or other structures.",
+    "weather_related_incidents": "Weather-related incidents: Incidents caused by severe weather conditions.",
+    "equipment_malfunctions": "Equipment malfunctions: Failure of screens, lighting, or other equipment.",
+    "staffing_shortages": "Staffing shortages: Not enough staff to manage the event safely.",
+    "waste_management_failures": "Waste management failures: Overflowing trash bins or unsanitary conditions.",
+    "parking_or_traffic_congestion": "Parking/traffic congestion: Severe congestion in parking areas or access roads.",
+}
+
+_PROMPT_TEMPLATE = """
+Analyze this video and assess the presence of the following safety incidents.
 
     For each incident type, provide:
     1. A confidence score between 0.0 (not present) and 1.0 (definitely present)
     2. A brief explanation of your assessment
-    3. Timestamp ranges where the incident occurs (if applicable)
-
-    Return your analysis in this exact JSON structure:
-    {
-      "incidents": {
-        "congestion": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "crowd_surges": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "unruly_behavior": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "panic_or_danger": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "injuries_from_objects": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "injuries_from_slippery_surface": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "cardiac_arrest": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "unauthorized_access": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "theft": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "unattended_bags": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "weapon_detection": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "active_shooter": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "property_damage": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "missing_signage": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "fire_and_smoke": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "structural_failures": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "weather_related_incidents": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "equipment_malfunctions": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "staffing_shortages": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "waste_management_failures": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        },
-        "parking_or_traffic_congestion": {
-          "score": <float>,
-          "explanation": <string>,
-          "timestamps": [{"start": <float>, "end": <float>}]
-        }
-      },
-      "crowd_density": {
-        "persons_per_sq_m": <float>,
-        "explanation": <string>
-      },
-      "crowd_sentiment": {
-        "score": <float>,
-        "explanation": <string>
-      },
-      "zone_capacity": {
-        "estimated_capacity": <integer>,
-        "explanation": <string>
-      },
-      "normalized_crowd_density": {
-        "score": <float>,
-        "explanation": <string>
-      },
-      "normalized_flow_speed": {
-        "score": <float>,
-        "explanation": <string>
-      },
-      "overall_safety_assessment": <string>,
-      "recommended_actions": [<string>]
-    }
+    3. Timestamp ranges where the incident occurs (if applicable), in seconds from the start of the
+       footage you are given. When the video is clipped to a segment, 0 is the start of that segment,
+       not of the full video.
 
     Important definitions:
     - Crowd Density: Estimated number of people per square meter (person/m2). Your explanation should detail how you estimated the area and the person count.
@@ -188,44 +104,364 @@ Analyze this video and provide a JSON response that assesses the presence of the
     - Zone Capacity: An estimation of the total number of people that can safely occupy the zone, with an explanation of the calculation.
     - Normalized Crowd Density: A score from 0.0 (empty) to 1.0 (at or over capacity), derived from crowd_density and zone_capacity. Explain your calculation.
     - Normalized Flow Speed: A score from 0.0 (static) to 1.0 (free-flowing), representing the speed of crowd movement.
-    - Congestion: Overcrowding of people in a space beyond safe capacity.
-    - Crowd Surges: Sudden, uncontrolled movements of a crowd.
-    - Unruly behavior: People acting aggressively, fighting, or causing disruption.
-    - Panic/danger: People showing fear, running chaotically, or responding to threats.
-    - Injuries from objects: People getting hurt by falling, moving, or stationary objects.
-    - Injuries from slippery surfaces: Falls or near-falls due to wet/slippery floors.
-    - Cardiac arrest: Someone collapsing with signs of possible heart failure.
-    - Unauthorized access: People entering restricted areas.
-    - Theft: Stealing of personal or event property.
-    - Unattended bags: Bags or packages left without an owner.
-    - Weapon detection: Presence of any type of weapon.
-    - Active shooter: An individual actively engaged in killing or attempting to kill people in a populated area.
-    - Property damage: Intentional damage to property.
-    - Missing signage: Important signs are missing or broken.
-    - Fire and Smoke: Detection of fire or smoke.
-    - Structural failures: Breakage of stages, barriers, or other structures.
-    - Weather-related incidents: Incidents caused by severe weather conditions.
-    - Equipment malfunctions: Failure of screens, lighting, or other equipment.
-    - Staffing shortages: Not enough staff to manage the event safely.
-    - Waste management failures: Overflowing trash bins or unsanitary conditions.
-    - Parking/traffic congestion: Severe congestion in parking areas or access roads.
-
-    DO NOT include any text outside of the JSON structure. Return ONLY valid, parseable JSON.
+{definitions}
 
+    Also assess crowd density, crowd sentiment, zone capacity, normalized crowd density and
+    normalized flow speed, give an overall safety assessment and list recommended actions.
  """
 
 
-def analyze_video(gcs_uri: str) -> dict:
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=[
-            Part.from_uri(
-                file_uri=gcs_uri,
-                mime_type="video/mp4",
-            ),
-            analysis_prompt,
-        ],
+def incident_types_subset(incident_types=None) -> tuple:
+    """
+    incident_types as a tuple in SEVERITY_MAPPING order, all of them if None.
+
+    Unknown types are dropped, and the fixed order gives a subset the same
+    prompt, schema and cache entries however it was listed.
+    """
+    if incident_types is None:
+        return tuple(SEVERITY_MAPPING)
+    requested = set(incident_types)
+    unknown = requested - set(SEVERITY_MAPPING)
+    if unknown:
+        logger.warning(f"Ignoring unknown incident types: {sorted(unknown)}")
+    return tuple(incident_type for incident_type in SEVERITY_MAPPING if incident_type in requested)
+
+
+@lru_cache(maxsize=None)
+def _build_analysis_prompt(incident_types: tuple) -> str:
+    definitions = "\n".join(f"    - {INCIDENT_DEFINITIONS[incident_type]}" for incident_type in incident_types)
+    return _PROMPT_TEMPLATE.format(definitions=definitions)
+
+
+def build_analysis_prompt(incident_types=None) -> str:
+    """The analysis prompt asking about incident_types only (all of them if None)."""
+    return _build_analysis_prompt(incident_types_subset(incident_types))
+
+
+analysis_prompt = build_analysis_prompt()
+
+_SEVERITY_RANK = {"critical": 0, "high": 1, "medium": 2, "low": 3}
+
+
+def _response_schema(incident_types: tuple):
+    """
+    The response schema for incident_types, most severe first.
+
+    Gemini writes properties in schema order, so when the response is
+    streamed the critical assessments arrive before the rest.
+    """
+    return build_analysis_schema(sorted(incident_types, key=lambda t: _SEVERITY_RANK.get(SEVERITY_MAPPING[t], 4)))
+
+
+# Gemini is constrained to this schema, so responses are valid JSON without
+# spelling the structure out in the prompt. Zones that only need some of the
+# incident types get a schema of those (see build_analysis_schema).
+VideoAnalysis = build_analysis_schema(SEVERITY_MAPPING)
+
+# The prompt for a set of incident types is static, so it is held in a Gemini
+# cached-content entry and each call only sends the video. Cached content is
+# tied to a model, so there is one entry per model and set of types in use.
+_prompt_caches = {}
+
+
+def prompt_cache(model: str = GEMINI_MODEL, incident_types=None) -> PromptCache:
+    """The PromptCache holding the prompt for incident_types (all if None) for model."""
+    incident_types = incident_types_subset(incident_types)
+    key = (model, incident_types)
+    if key not in _prompt_caches:
+        _prompt_caches.setdefault(key, PromptCache(model, _build_analysis_prompt(incident_types)))
+    return _prompt_caches[key]
+
+
+analysis_prompt_cache = prompt_cache(GEMINI_MODEL)
+
+
+def _video_duration(gcs_uri: str, duration) -> Optional[float]:
+    """Clip length in seconds: duration if given, else the object's 'duration' metadata, else None."""
+    try:
+        if duration is not None:
+            return float(duration)
+        if not gcs_uri.startswith("gs://"):
+            return None
+        bucket_name, _, blob_name = gcs_uri[len("gs://"):].partition("/")
+        blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+        if blob is None or not blob.metadata or blob.metadata.get("duration") is None:
+            return None
+        return float(blob.metadata["duration"])
+    except Exception as e:
+        logger.warning(f"Could not determine the duration of {gcs_uri}: {str(e)}")
+        return None
+
+
+def _analysis_windows(gcs_uri: str, duration) -> list:
+    """The (start, end) windows to analyse gcs_uri in, or [None] for the whole clip at once."""
+    if not SEGMENTED_ANALYSIS_ENABLED:
+        return [None]
+    duration = _video_duration(gcs_uri, duration)
+    if duration is None:
+        return [None]
+    windows = plan_windows(duration)
+    return windows if len(windows) > 1 else [None]
+
+
+def _analysis_request(gcs_uri: str, cached_content, window=None, profile=DEFAULT_PROFILE, incident_types=None,
+                      timeout=None) -> tuple:
+    """
+    (contents, config) for analysing gcs_uri, or one window of it.
+
+    The request references cached_content if there is one, samples the
+    video at the profile's frame rate and media resolution, and asks about
+    incident_types only (all of them if None). With a timeout (seconds),
+    the HTTP request is abandoned after that long.
+    """
+    # Imported here: google.genai is slow to import and only needed once a clip is analysed
+    from google.genai.types import FileData, GenerateContentConfig, HttpOptions, MediaResolution, Part, VideoMetadata
+    incident_types = incident_types_subset(incident_types)
+    video_metadata = {}
+    if window is not None:
+        video_metadata["start_offset"] = f"{window[0]:g}s"
+        video_metadata["end_offset"] = f"{window[1]:g}s"
+    if profile.fps is not None:
+        video_metadata["fps"] = profile.fps
+    if video_metadata:
+        video = Part(
+            file_data=FileData(file_uri=gcs_uri, mime_type="video/mp4"),
+            video_metadata=VideoMetadata(**video_metadata),
+        )
+    else:
+        video = Part.from_uri(
+            file_uri=gcs_uri,
+            mime_type="video/mp4",
+        )
+    contents = [video]
+    if cached_content is None:
+        contents.append(_build_analysis_prompt(incident_types))
+    config = GenerateContentConfig(
+        cached_content=cached_content,
+        response_mime_type="application/json",
+        response_schema=_response_schema(incident_types),
+        media_resolution=MediaResolution(MEDIA_RESOLUTIONS[profile.media_resolution]) if profile.media_resolution else None,
+        http_options=HttpOptions(timeout=max(1, int(timeout * 1000))) if timeout is not None else None,
     )
+    return contents, config
+
+
+def _analysis_cache_key(gcs_uri: str, model: str, windows: list, profile=DEFAULT_PROFILE, incident_types=None):
+    if not ANALYSIS_CACHE_ENABLED:
+        return None
+    # A segmented analysis is a different result from a whole-clip one
+    variant = [f"{window[0]:g}-{window[1]:g}" for window in windows if window is not None]
+    # and so is one sampled differently
+    if profile.fps is not None or profile.media_resolution is not None:
+        variant.append(profile.cache_variant())
+    # The prompt names the incident types, so each subset is keyed apart
+    return cache_key(gcs_uri, model, build_analysis_prompt(incident_types), *variant)
+
+
+def _parse_response(response_text: str, incident_types=None) -> dict:
+    # Raises on a response that doesn't match the schema, so a truncated or
+    # blocked response fails the stage instead of passing on a partial result
+    with stage_timer("parse_analysis"):
+        schema = build_analysis_schema(incident_types_subset(incident_types))
+        return parse_analysis(schema, response_text).model_dump()
+
+
+def _record_usage(gcs_uri: str, model: str, profile, response):
+    usage = response.usage_metadata
+    if usage is None:
+        return
+    count_tokens(profile.name, model, usage)
+    log_sampled(
+        logger, "Gemini usage", gcs_uri=gcs_uri, profile=profile.name, prompt_tokens=usage.prompt_token_count,
+        cached_tokens=usage.cached_content_token_count or 0, output_tokens=usage.candidates_token_count,
+    )
+
+
+def _generate(gcs_uri: str, model: str, cached_content, window, profile=DEFAULT_PROFILE, incident_types=None,
+              cancelled=None, deadline=None) -> dict:
+    def attempt():
+        # Each attempt's HTTP timeout is whatever is left until the deadline
+        contents, config = _analysis_request(gcs_uri, cached_content, window, profile, incident_types, time_left(deadline))
+        return get_genai_client().models.generate_content(model=model, contents=contents, config=config)
+
+    response = call_with_rate_limit(f"gemini:{model}", attempt, deadline=deadline, cancelled=cancelled)
+    _record_usage(gcs_uri, model, profile, response)
+    return _parse_response(response.text, incident_types)
+
+
+def _window_incident(window, incident):
+    """incident from a window's analysis, with its timestamps in clip time."""
+    if window is None:
+        return incident
+    return dict(incident, timestamps=shift_ranges(incident.get("timestamps"), window))
+
+
+class AnalysisCancelled(Exception):
+    """Raised by a streamed analysis whose caller stopped waiting for it."""
+
+
+def _consume_stream(gcs_uri: str, model: str, build_request, window, on_incident, cancelled=None):
+    """Read one streamed generation of build_request() to the end; returns (response text, last chunk)."""
+    contents, config = build_request()
+    incidents = StreamedObjectMembers(("incidents",))
+    last_chunk = None
+    for chunk in get_genai_client().models.generate_content_stream(model=model, contents=contents, config=config):
+        if cancelled is not None and cancelled.is_set():
+            raise AnalysisCancelled(f"Analysis of {gcs_uri} was cancelled")
+        last_chunk = chunk
+        for incident_type, incident in incidents.feed(chunk.text or ""):
+            try:
+                on_incident(incident_type, _window_incident(window, incident))
+            except Exception as e:
+                logger.error(f"Handling streamed {incident_type} for {gcs_uri} failed: {str(e)}")
+    return incidents.text, last_chunk
+
+
+def _generate_streamed(gcs_uri: str, model: str, cached_content, window, profile, incident_types, on_incident,
+                       cancelled=None, deadline=None) -> dict:
+    """
+    _generate, streaming the response.
+
+    on_incident(incident_type, incident) is called for each incident
+    assessment as soon as its object is complete, before the rest of the
+    response has arrived. Errors it raises are logged and don't affect the
+    analysis. A 429 while opening or reading the stream is retried like a
+    non-streamed call, replaying the stream from the start, so on_incident
+    may see an incident type again. Once cancelled (a threading.Event) is
+    set, the stream is abandoned with AnalysisCancelled, or CallAbandoned
+    while it waits to be retried; no attempt starts after deadline.
+    """
+    def build_request():
+        return _analysis_request(gcs_uri, cached_content, window, profile, incident_types, time_left(deadline))
+
+    text, last_chunk = call_with_rate_limit(
+        f"gemini:{model}", _consume_stream, gcs_uri, model, build_request, window, on_incident, cancelled,
+        deadline=deadline, cancelled=cancelled,
+    )
+    # Usage is reported on the final chunk
+    if last_chunk is not None:
+        _record_usage(gcs_uri, model, profile, last_chunk)
+    return _parse_response(text, incident_types)
+
+
+async def _generate_async(gcs_uri: str, model: str, cached_content, window, profile=DEFAULT_PROFILE, incident_types=None) -> dict:
+    contents, config = _analysis_request(gcs_uri, cached_content, window, profile, incident_types)
+    response = await call_with_rate_limit_async(
+        f"gemini:{model}",
+        get_genai_client().aio.models.generate_content,
+        model=model,
+        contents=contents,
+        config=config,
+    )
+    _record_usage(gcs_uri, model, profile, response)
+    return _parse_response(response.text, incident_types)
+
+
+async def _consume_stream_async(gcs_uri: str, model: str, contents, config, window, on_incident):
+    incidents = StreamedObjectMembers(("incidents",))
+    last_chunk = None
+    stream = await get_genai_client().aio.models.generate_content_stream(model=model, contents=contents, config=config)
+    async for chunk in stream:
+        last_chunk = chunk
+        for incident_type, incident in incidents.feed(chunk.text or ""):
+            try:
+                handled = on_incident(incident_type, _window_incident(window, incident))
+                if inspect.isawaitable(handled):
+                    await handled
+            except Exception as e:
+                logger.error(f"Handling streamed {incident_type} for {gcs_uri} failed: {str(e)}")
+    return incidents.text, last_chunk
+
+
+async def _generate_streamed_async(gcs_uri: str, model: str, cached_content, window, profile, incident_types, on_incident) -> dict:
+    """Async variant of _generate_streamed; on_incident may be a coroutine function. Cancel the task to stop it."""
+    contents, config = _analysis_request(gcs_uri, cached_content, window, profile, incident_types)
+    text, last_chunk = await call_with_rate_limit_async(
+        f"gemini:{model}", _consume_stream_async, gcs_uri, model, contents, config, window, on_incident,
+    )
+    if last_chunk is not None:
+        _record_usage(gcs_uri, model, profile, last_chunk)
+    return _parse_response(text, incident_types)
+
+
+def analyze_video(gcs_uri: str, model: str = GEMINI_MODEL, duration=None, profile=DEFAULT_PROFILE, incident_types=None,
+                  on_incident=None, cancelled=None, timeout=None) -> dict:
+    """
+    Analyse the clip at gcs_uri with model.
+
+    Clips of at least SEGMENT_MIN_DURATION seconds (per duration, or the
+    object's 'duration' metadata when duration isn't given) are analysed as
+    overlapping windows in parallel and the window results merged, so a long
+    clip takes about as long as one window. profile sets the frame rate and
+    media resolution the video is sampled at (see utils.sampling); token
+    usage is counted per profile. Only incident_types are assessed (all of
+    SEVERITY_MAPPING if None; see utils.incident_profiles), and the result's
+    'incidents' has exactly those keys. Results are cached by content.
+
+    With on_incident, the response is streamed and on_incident(incident_type,
+    incident) called for each incident assessment as soon as it is complete,
+    so alerts don't wait for the rest of the analysis. Incidents of a cached
+    result are only in the returned analysis. Setting cancelled (a
+    threading.Event) stops a streamed analysis, and with it on_incident
+    calls, with AnalysisCancelled, and stops any analysis waiting for the
+    rate limiter with CallAbandoned. With a timeout (seconds), no Gemini
+    request is started or retried after that long, and each request's HTTP
+    timeout is the time left.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    windows = _analysis_windows(gcs_uri, duration)
+    key = _analysis_cache_key(gcs_uri, model, windows, profile, incident_types)
+    cached_result = analysis_cache.get(key)
+    if cached_result is not None:
+        return cached_result
+
+    cached_content = prompt_cache(model, incident_types).name()
+
+    def generate(window):
+        if cancelled is not None and cancelled.is_set():
+            raise AnalysisCancelled(f"Analysis of {gcs_uri} was cancelled")
+        if on_incident is None:
+            return _generate(gcs_uri, model, cached_content, window, profile, incident_types, cancelled, deadline)
+        return _generate_streamed(
+            gcs_uri, model, cached_content, window, profile, incident_types, on_incident, cancelled, deadline,
+        )
+
+    if len(windows) == 1:
+        analysis_result = generate(None)
+    else:
+        logger.info(f"Analysing {gcs_uri} in {len(windows)} windows")
+        futures = [
+            segment_executor.submit(contextvars.copy_context().run, generate, window)
+            for window in windows
+        ]
+        # Any failed window fails the whole analysis rather than leaving a gap in it
+        analysis_result = merge_window_results(windows, [future.result() for future in futures])
+    analysis_cache.put(key, analysis_result, video_uri=gcs_uri, model=model)
+    return analysis_result
+
+
+async def analyze_video_async(gcs_uri: str, model: str = GEMINI_MODEL, duration=None, profile=DEFAULT_PROFILE,
+                              incident_types=None, on_incident=None) -> dict:
+    """Async variant of analyze_video using the genai client's aio interface."""
+    # The cache is backed by blocking GCS / Firestore calls, keep them off the event loop
+    windows = await asyncio.to_thread(_analysis_windows, gcs_uri, duration)
+    key = await asyncio.to_thread(_analysis_cache_key, gcs_uri, model, windows, profile, incident_types)
+    cached_result = await asyncio.to_thread(analysis_cache.get, key)
+    if cached_result is not None:
+        return cached_result
+
+    cached_content = await prompt_cache(model, incident_types).name_async()
+
+    def generate(window):
+        if on_incident is None:
+            return _generate_async(gcs_uri, model, cached_content, window, profile, incident_types)
+        return _generate_streamed_async(gcs_uri, model, cached_content, window, profile, incident_types, on_incident)
 
-    analysis_result = recover_json(response.text)
-    return analysis_result
\ No newline at end of file
+    if len(windows) == 1:
+        analysis_result = await generate(None)
+    else:
+        logger.info(f"Analysing {gcs_uri} in {len(windows)} windows")
+        results = await asyncio.gather(*[generate(window) for window in windows])
+        analysis_result = merge_window_results(windows, results)
+    await asyncio.to_thread(analysis_cache.put, key, analysis_result, video_uri=gcs_uri, model=model)
+    return analysis_result
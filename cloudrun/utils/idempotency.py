@@ -0,0 +1,112 @@
+import os
+import hashlib
+import logging
+import datetime
+from utils.clients import get_firestore_client, get_async_firestore_client
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_ENABLED = os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_COLLECTION = os.environ.get("IDEMPOTENCY_COLLECTION", "message_ledger")
+# Pub/Sub keeps unacked messages for 7 days by default; no redelivery can arrive later than that
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", str(7 * 24 * 3600)))
+
+# Pipeline stages, in the order they complete
+STAGE_ANALYSIS = "analysis"
+STAGE_FIRESTORE = "firestore"
+STAGE_BIGQUERY = "bigquery"
+
+
+class MessageLedger:
+    """
+    Records which pipeline stages have completed for each message.
+
+    When a message is redelivered after a failure, the pipeline resumes from
+    the first stage that has not completed instead of calling Vision and
+    Gemini and writing everything again. Ledger documents carry an
+    'expires_at' field for a Firestore TTL policy.
+    """
+
+    def __init__(self, db=None, collection=IDEMPOTENCY_COLLECTION, ttl=IDEMPOTENCY_TTL):
+        self._db = db
+        self.collection = collection
+        self.ttl = ttl
+
+    @property
+    def db(self):
+        """The Firestore client, created on first use unless one was passed in."""
+        return self._db if self._db is not None else get_firestore_client()
+
+    def key_for(self, message_id, message_data):
+        """
+        Returns the ledger key for a message.
+
+        The Pub/Sub messageId is used when available; otherwise the message is
+        identified by (camera_id, video_id, timestamp).
+        """
+        if message_id:
+            identity = f"message:{message_id}"
+        else:
+            identity = "clip:{}|{}|{}".format(
+                message_data.get('camera_id'),
+                message_data.get('video_id'),
+                message_data.get('timestamp'),
+            )
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def document(self, key):
+        return self.db.collection(self.collection).document(key)
+
+    def async_document(self, key):
+        """The ledger document for key on the shared firestore.AsyncClient."""
+        return get_async_firestore_client().collection(self.collection).document(key)
+
+    def completed_stages(self, key):
+        """Return {stage: recorded value} for every stage already completed for key."""
+        try:
+            snapshot = self.document(key).get()
+        except Exception as e:
+            # Without the ledger we can only fall back to processing from scratch
+            logger.warning(f"Could not read message ledger {key}: {str(e)}")
+            return {}
+        if not snapshot.exists:
+            return {}
+        return snapshot.to_dict().get("stages", {})
+
+    def stage_update(self, stage, value=True):
+        """Build the merge payload that marks stage as completed with value."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {
+            "stages": {stage: value},
+            "updated_at": now,
+            "expires_at": now + datetime.timedelta(seconds=self.ttl),
+        }
+
+    def record_stage(self, key, stage, value=True):
+        """Mark stage as completed for key."""
+        self.document(key).set(self.stage_update(stage, value), merge=True)
+
+    def record_stage_many(self, keys, stage, value=True):
+        """Mark stage as completed for every key, in batched writes."""
+        update = self.stage_update(stage, value)
+        # A Firestore batch holds at most 500 writes
+        for start in range(0, len(keys), 500):
+            batch = self.db.batch()
+            for key in keys[start:start + 500]:
+                batch.set(self.document(key), update, merge=True)
+            batch.commit()
+
+    async def completed_stages_async(self, key):
+        """Async variant of completed_stages."""
+        try:
+            snapshot = await self.async_document(key).get()
+        except Exception as e:
+            logger.warning(f"Could not read message ledger {key}: {str(e)}")
+            return {}
+        if not snapshot.exists:
+            return {}
+        return snapshot.to_dict().get("stages", {})
+
+    async def record_stage_async(self, key, stage, value=True):
+        """Async variant of record_stage."""
+        await self.async_document(key).set(self.stage_update(stage, value), merge=True)
@@ -0,0 +1,149 @@
+"""
+Downsizing of camera stills before face detection.
+
+Vision fetches image_uri at the camera's native resolution, and a 4K still
+is far more than counting faces needs. With IMAGE_PREPROCESSING_ENABLED,
+the image is read from GCS here, scaled down to IMAGE_PREPROCESSING_MAX_EDGE
+on its long edge, re-encoded as JPEG and sent to Vision as bytes. Images
+already within the size are sent as they are.
+
+Resized images are cached by object generation, so an overwritten object is
+never served stale: in process (IMAGE_PREPROCESSING_CACHE_ENTRIES) and, when
+IMAGE_PREPROCESSING_CACHE_URI is set, under that gs:// prefix for every
+instance. benchmark_preprocessing.py compares latency and counts per size.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from utils.clients import get_storage_client
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREPROCESSING_ENABLED = os.environ.get("IMAGE_PREPROCESSING_ENABLED", "false").lower() == "true"
+IMAGE_PREPROCESSING_MAX_EDGE = int(os.environ.get("IMAGE_PREPROCESSING_MAX_EDGE", "1280"))
+IMAGE_PREPROCESSING_QUALITY = int(os.environ.get("IMAGE_PREPROCESSING_QUALITY", "85"))
+IMAGE_PREPROCESSING_CACHE_ENTRIES = int(os.environ.get("IMAGE_PREPROCESSING_CACHE_ENTRIES", "64"))
+# gs://bucket/prefix shared by all instances; unset keeps the cache in process only
+IMAGE_PREPROCESSING_CACHE_URI = os.environ.get("IMAGE_PREPROCESSING_CACHE_URI", "")
+
+# The long edge images are sent to Vision at by default; None sends the URI as it is
+DEFAULT_MAX_EDGE = IMAGE_PREPROCESSING_MAX_EDGE if IMAGE_PREPROCESSING_ENABLED else None
+
+
+def _split_gcs_uri(uri):
+    bucket_name, _, blob_name = uri[len("gs://"):].partition("/")
+    return bucket_name, blob_name
+
+
+def resize_image(data, max_edge, quality=IMAGE_PREPROCESSING_QUALITY):
+    """
+    Scale encoded image bytes down to max_edge on the long edge.
+
+    Returns (bytes, scale), scale being the resized size over the original.
+    Images within max_edge come back unchanged with a scale of 1.0.
+    """
+    import cv2
+    import numpy as np
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Image could not be decoded")
+    scale = max_edge / max(image.shape[:2])
+    if scale >= 1.0:
+        return data, 1.0
+    image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Resized image could not be encoded")
+    return encoded.tobytes(), scale
+
+
+class PreprocessedImageCache:
+    """
+    Resized images keyed by (uri, generation, max edge, quality).
+
+    An in-process LRU of max_entries sits in front of an optional GCS
+    prefix, where each image is an object with its scale in the metadata.
+    A lifecycle rule on the prefix can expire old entries.
+    """
+
+    def __init__(self, max_entries=IMAGE_PREPROCESSING_CACHE_ENTRIES, cache_uri=IMAGE_PREPROCESSING_CACHE_URI):
+        self.max_entries = max_entries
+        self.cache_uri = cache_uri.rstrip("/")
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_blob(self, key):
+        uri, generation, max_edge, quality = key
+        bucket_name, prefix = _split_gcs_uri(self.cache_uri)
+        name = f"{prefix}/{uri[len('gs://'):]}@{generation}/{max_edge}-q{quality}.jpg".lstrip("/")
+        return get_storage_client().bucket(bucket_name), name
+
+    def get(self, key):
+        """Return (bytes, scale) for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if not self.cache_uri:
+            return None
+        try:
+            bucket, name = self._cache_blob(key)
+            blob = bucket.get_blob(name)
+            if blob is None:
+                return None
+            entry = blob.download_as_bytes(), float((blob.metadata or {}).get("scale", "1"))
+        except Exception as e:
+            logger.warning(f"Could not read preprocessed image cache for {key[0]}: {str(e)}")
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        if not self.cache_uri:
+            return
+        try:
+            bucket, name = self._cache_blob(key)
+            blob = bucket.blob(name)
+            blob.metadata = {"scale": repr(entry[1])}
+            blob.upload_from_string(entry[0], content_type="image/jpeg")
+        except Exception as e:
+            logger.warning(f"Could not write preprocessed image cache for {key[0]}: {str(e)}")
+
+    def _remember(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+preprocessed_image_cache = PreprocessedImageCache()
+
+
+def preprocess_image(uri, max_edge, quality=IMAGE_PREPROCESSING_QUALITY, timeout=60):
+    """
+    Read the image at a gs:// uri and scale it down to max_edge.
+
+    Returns (bytes, scale) as resize_image does, from the cache when this
+    generation of the object was resized before. Each GCS request gives
+    up after timeout seconds. Raises if the object can't be read or decoded.
+    """
+    bucket_name, blob_name = _split_gcs_uri(uri)
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name, timeout=timeout)
+    if blob is None:
+        raise FileNotFoundError(f"Image {uri} not found")
+
+    key = (uri, blob.generation, max_edge, quality)
+    entry = preprocessed_image_cache.get(key)
+    if entry is not None:
+        return entry
+    # Pinned to the generation the key was built from
+    data = blob.download_as_bytes(if_generation_match=blob.generation, timeout=timeout)
+    entry = resize_image(data, max_edge, quality)
+    preprocessed_image_cache.put(key, entry)
+    return entry
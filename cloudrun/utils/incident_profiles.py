@@ -0,0 +1,84 @@
+"""
+Per-zone incident type profiles.
+
+A profile is the subset of SEVERITY_MAPPING's incident types worth asking
+about in a zone; the analysis prompt and response schema are generated from
+it, so Gemini neither scores nor explains types that can't occur there.
+Profiles and their assignment to zones are read from INCIDENT_PROFILES_PATH:
+
+    {
+      "default_profile": "all",
+      "profiles": {
+        "indoor": {"exclude": ["parking_or_traffic_congestion", "weather_related_incidents"]},
+        "car_park": {"include": ["congestion", "theft", "parking_or_traffic_congestion"]}
+      },
+      "zones": {"Hall B": "indoor"}
+    }
+
+A profile either lists the types to include or the types to exclude from
+all of them. The built-in "all" profile asks about every type.
+"""
+import os
+import json
+import logging
+from utils.gemini_segmentation import SEVERITY_MAPPING, incident_types_subset
+
+logger = logging.getLogger(__name__)
+
+INCIDENT_PROFILES_PATH = os.environ.get("INCIDENT_PROFILES_PATH", "config/incident_profiles.json")
+
+ALL_INCIDENT_TYPES = tuple(SEVERITY_MAPPING)
+
+
+def _parse_profile(name, settings) -> tuple:
+    if "include" in settings:
+        incident_types = incident_types_subset(settings["include"])
+    else:
+        excluded = set(settings.get("exclude", ()))
+        incident_types = tuple(incident_type for incident_type in ALL_INCIDENT_TYPES if incident_type not in excluded)
+    if not incident_types:
+        raise ValueError(f"Incident profile {name} has no incident types")
+    return incident_types
+
+
+class IncidentProfiles:
+    """Incident type profiles and which zones use them."""
+
+    def __init__(self, profiles=None, zones=None, default_profile="all"):
+        self.profiles = {"all": ALL_INCIDENT_TYPES}
+        self.profiles.update(profiles or {})
+        self.zones = zones or {}
+        self.default_profile = default_profile
+
+    @classmethod
+    def load(cls, path=INCIDENT_PROFILES_PATH):
+        """Read the config at path; a missing or invalid file has every zone assess every type."""
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path) as f:
+                config = json.load(f)
+            profiles = {
+                name: _parse_profile(name, settings)
+                for name, settings in config.get("profiles", {}).items()
+            }
+            return cls(profiles, config.get("zones"), config.get("default_profile", "all"))
+        except Exception as e:
+            logger.error(f"Ignoring invalid incident profiles in {path}: {str(e)}")
+            return cls()
+
+    def incident_types_for(self, zone_id=None) -> tuple:
+        """The incident types to assess for a clip from zone_id, in SEVERITY_MAPPING order."""
+        name = self.zones.get(zone_id) or self.default_profile
+        incident_types = self.profiles.get(name)
+        if incident_types is None:
+            logger.warning(f"Unknown incident profile {name}, assessing every incident type")
+            return ALL_INCIDENT_TYPES
+        return incident_types
+
+
+incident_profiles = IncidentProfiles.load()
+
+
+def incident_types_for(zone_id=None) -> tuple:
+    return incident_profiles.incident_types_for(zone_id)
@@ -0,0 +1,85 @@
+"""
+Incremental parsing of a JSON document that arrives in chunks.
+
+Used on streamed Gemini responses to act on parts of the analysis, such as
+each incident assessment, as soon as they are complete instead of waiting
+for the whole document.
+"""
+import json
+
+
+class StreamedObjectMembers:
+    """
+    Yields the members of one object in a streamed JSON document as each closes.
+
+    path is the chain of keys from the top-level object to the watched
+    object, e.g. ("incidents",). feed() takes the next chunk of text and
+    returns the (key, value) pairs of the watched object's members whose
+    object or array value was completed by that chunk. Scalar members are
+    not reported. The text fed so far is available as .text.
+    """
+
+    def __init__(self, path):
+        self.path = tuple(path)
+        self._buffer = ""
+        self._scanned = 0
+        # One (bracket, key in parent) frame per open object or array
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._string_is_key = False
+        self._expect_key = False
+        self._last_key = None
+        self._member_key = None
+        self._member_start = None
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    def _in_watched_object(self) -> bool:
+        return (
+            bool(self._stack)
+            and self._stack[-1][0] == "{"
+            and tuple(key for _, key in self._stack[1:]) == self.path
+        )
+
+    def feed(self, chunk: str) -> list:
+        self._buffer += chunk
+        members = []
+        buffer = self._buffer
+        for index in range(self._scanned, len(buffer)):
+            char = buffer[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._last_key = json.loads(buffer[self._string_start:index + 1])
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = index
+                self._string_is_key = self._expect_key
+            elif char in "{[":
+                in_object = bool(self._stack) and self._stack[-1][0] == "{"
+                if self._in_watched_object():
+                    self._member_key, self._member_start = self._last_key, index
+                self._stack.append((char, self._last_key if in_object else None))
+                self._expect_key = char == "{"
+            elif char in "}]":
+                self._stack.pop()
+                self._expect_key = False
+                if self._member_start is not None and self._in_watched_object():
+                    members.append((self._member_key, json.loads(buffer[self._member_start:index + 1])))
+                    self._member_start = None
+            elif char == ",":
+                self._expect_key = bool(self._stack) and self._stack[-1][0] == "{"
+            elif char == ":":
+                self._expect_key = False
+        self._scanned = len(buffer)
+        return members
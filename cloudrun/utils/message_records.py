@@ -0,0 +1,174 @@
+import json
+import base64
+import logging
+from utils.gemini_segmentation import SEVERITY_MAPPING
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ['image_uri', 'zone_id', 'timestamp', 'camera_id']
+INCIDENT_SCORE_THRESHOLD = 0.5
+
+
+class InvalidMessageError(ValueError):
+    """A message that can never be processed, so redelivering it is pointless."""
+
+
+def decode_push_envelope(envelope):
+    """
+    Decodes a Pub/Sub push envelope into (message_data, message_id).
+
+    Envelopes without a 'message' are treated as a direct JSON payload (for
+    testing). Raises InvalidMessageError if there is nothing to process.
+    """
+    if not envelope:
+        raise InvalidMessageError("No Pub/Sub message received")
+
+    # Check if this is a Pub/Sub message
+    if not isinstance(envelope, dict) or 'message' not in envelope:
+        logger.warning("Invalid Pub/Sub message format")
+        # Try processing as direct JSON payload for testing purposes
+        return envelope, None
+
+    # Extract the Pub/Sub message
+    pubsub_message = envelope['message']
+    message_id = pubsub_message.get('messageId') or pubsub_message.get('message_id')
+
+    # If the message has data, it will be base64-encoded
+    if 'data' in pubsub_message:
+        decoded_data = base64.b64decode(pubsub_message['data']).decode('utf-8')
+        logger.debug(f"Decoded message data: {decoded_data}")
+        try:
+            message_data = json.loads(decoded_data)
+        except json.JSONDecodeError:
+            logger.error(f"Failed to parse message as JSON: {decoded_data}")
+            # Permanent failure - don't retry
+            raise InvalidMessageError("Invalid message format")
+    else:
+        # No data field
+        logger.warning("No data field in Pub/Sub message")
+        message_data = {}
+
+    # Include any attributes from the Pub/Sub message
+    if pubsub_message.get('attributes'):
+        message_data.update(pubsub_message['attributes'])
+    return message_data, message_id
+
+
+def validate_message(message_data):
+    """Raise InvalidMessageError if message_data lacks a required field."""
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in message_data]
+    if missing_fields:
+        # Don't retry - this is a permanent failure
+        raise InvalidMessageError(f"Missing required fields: {missing_fields}")
+
+
+def is_incident(incident_data):
+    """Whether an incident assessment scores above the threshold for recording it."""
+    return (incident_data.get('score') or 0) > INCIDENT_SCORE_THRESHOLD
+
+
+def build_incident(message_data, incident_type, incident_data):
+    """The incident document for one assessed incident type."""
+    return {
+        "video_id": message_data.get('video_id'),
+        "image_uri": message_data.get('image_uri'),
+        "video_uri": message_data.get('video_uri'),
+        "camera_id": message_data.get('camera_id'),
+        "location_lat": message_data.get('location_lat'),
+        "location_long": message_data.get('location_long'),
+        "type": incident_type,
+        "severity": SEVERITY_MAPPING.get(incident_type, "unknown"),
+        "zone_id": message_data.get('zone_id'),
+        "timestamp": message_data.get('timestamp'),
+        "source": "gemini_mm",
+        "details": {
+            "confidence": incident_data.get('score'),
+            "timestamps": incident_data.get('timestamps'),
+            "explanation": incident_data.get('explanation')
+        },
+        "status": "active"
+    }
+
+
+def build_incidents(message_data, analysis_results):
+    """Incident documents for every incident type scored above the threshold."""
+    return [
+        build_incident(message_data, incident_type, incident_data)
+        for incident_type, incident_data in analysis_results.get('incidents', {}).items()
+        if is_incident(incident_data)
+    ]
+
+
+def build_analysis_report(message_data, analysis_results, prefilter=None, routing=None):
+    """
+    The overall analysis report; incident_refs are filled in on persist.
+
+    prefilter is the pre-filter decision for the clip and routing the model
+    tier it was analysed with, each recorded on the report when there is one.
+    """
+    report = {
+        "video_id": message_data.get('video_id'),
+        "video_uri": message_data.get('video_uri'),
+        "zone_id": message_data.get('zone_id'),
+        "timestamp": message_data.get('timestamp'),
+        "crowd_density": analysis_results.get("crowd_density"),
+        "crowd_sentiment": analysis_results.get("crowd_sentiment"),
+        "zone_capacity": analysis_results.get("zone_capacity"),
+        "normalized_crowd_density": analysis_results.get("normalized_crowd_density"),
+        "normalized_flow_speed": analysis_results.get("normalized_flow_speed"),
+        "overall_safety_assessment": analysis_results.get("overall_safety_assessment"),
+        "recommended_actions": analysis_results.get("recommended_actions"),
+    }
+    if prefilter is not None:
+        report["prefilter"] = prefilter
+    if routing is not None:
+        report["model_tier"] = routing["tier"]
+        report["model"] = routing["model"]
+        report["routing"] = routing
+    return report
+
+
+def _numeric_score(value):
+    """Get a numeric value from a number or a dict with a score, defaulting to 0.0."""
+    if isinstance(value, dict):
+        if "score" in value:
+            return float(value["score"])
+        # Try to get the first numeric value from the dict
+        for val in value.values():
+            if isinstance(val, (int, float)):
+                return float(val)
+        return 0.0
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def calculate_bottle_neck_index(report):
+    """Bottleneck index of a report: normalized density times (1 - normalized flow speed)."""
+    normalized_crowd_density = _numeric_score(report.get("normalized_crowd_density"))
+    normalized_flow_speed = _numeric_score(report.get("normalized_flow_speed"))
+    bottle_neck_index = normalized_crowd_density * (1 - normalized_flow_speed)
+    log_sampled(
+        logger, "Calculated bottle_neck_index", bottle_neck_index=bottle_neck_index,
+        density=normalized_crowd_density, flow=normalized_flow_speed,
+    )
+    return bottle_neck_index
+
+
+def build_vision_row(message_data, faces_count, bottle_neck_index):
+    """The vision_ml_table row for one message."""
+    return {
+        "image_uri": message_data.get('image_uri'),
+        "zone_id": message_data.get('zone_id'),
+        "video_id": message_data.get('video_id'),
+        "timestamp": message_data.get('timestamp'),
+        "camera_id": message_data.get('camera_id'),
+        "faces_count": faces_count,
+        "location_lat": message_data.get('location_lat'),
+        "location_long": message_data.get('location_long'),
+        "bottle_neck_index": bottle_neck_index
+    }
@@ -0,0 +1,174 @@
+import time
+import contextvars
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Model calls routinely take tens of seconds, so the buckets go well past the defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 240)
+
+STAGE_LATENCY = Histogram(
+    "ingestion_stage_duration_seconds",
+    "Time spent in each stage of the ingestion pipeline",
+    ["stage", "zone", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+MESSAGES = Counter(
+    "ingestion_messages_total",
+    "Messages handled by the ingestion pipeline",
+    ["zone", "outcome"],
+)
+MESSAGES_IN_FLIGHT = Gauge(
+    "ingestion_messages_in_flight",
+    "Messages currently being processed",
+)
+GEMINI_TOKENS = Counter(
+    "gemini_tokens_total",
+    "Gemini tokens used by video analysis, by sampling profile",
+    ["profile", "model", "kind"],
+)
+RATE_LIMIT_RATE = Gauge(
+    "rate_limiter_rate",
+    "Current allowed request rate (per second) of each adaptive rate limiter",
+    ["limiter"],
+)
+RATE_LIMIT_THROTTLED = Counter(
+    "rate_limiter_throttled_total",
+    "Calls answered with 429 / RESOURCE_EXHAUSTED",
+    ["limiter"],
+)
+RATE_LIMIT_RETRIES = Counter(
+    "rate_limiter_retries_total",
+    "Throttled calls retried after a backoff",
+    ["limiter"],
+)
+RATE_LIMIT_WAIT = Histogram(
+    "rate_limiter_wait_seconds",
+    "Time calls waited for a rate limiter token",
+    ["limiter"],
+    buckets=LATENCY_BUCKETS,
+)
+PREFILTER_DECISIONS = Counter(
+    "ingestion_prefilter_decisions_total",
+    "Pre-filter decisions on whether and how to analyse a clip",
+    ["zone", "decision"],
+)
+TIME_TO_ALERT = Histogram(
+    "ingestion_time_to_alert_seconds",
+    "Time from starting to process a message to persisting each of its incidents",
+    ["zone", "severity", "path"],
+    buckets=LATENCY_BUCKETS,
+)
+MODEL_ROUTES = Counter(
+    "ingestion_model_routes_total",
+    "Clips analysed by each model tier",
+    ["zone", "tier"],
+)
+
+# Zone of the message being processed, so stages deep in the call stack can
+# label their timings without the zone being passed down to them
+current_zone = contextvars.ContextVar("current_zone", default="unknown")
+
+
+class _StageTimer:
+    """
+    Context manager that records a stage's latency.
+
+    The outcome label is "error" if the block raises, otherwise whatever
+    .outcome was set to inside the block ("success" by default). The zone
+    defaults to the zone of the message being processed.
+    """
+
+    def __init__(self, stage, zone_id=None):
+        self.stage = stage
+        self.zone_id = zone_id
+        self.outcome = "success"
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.outcome = "error"
+        STAGE_LATENCY.labels(
+            stage=self.stage,
+            zone=self.zone_id or current_zone.get(),
+            outcome=self.outcome,
+        ).observe(time.monotonic() - self._started)
+        return False
+
+
+class _MessageTracker:
+    """
+    Context manager around the processing of one message.
+
+    Sets current_zone for the stages inside it, and records the total latency
+    and a message count labelled with the outcome: "success", "invalid" for
+    exceptions in invalid_errors, or "error".
+    """
+
+    def __init__(self, zone_id, invalid_errors=()):
+        self.zone_id = zone_id or "unknown"
+        self.invalid_errors = invalid_errors
+
+    def __enter__(self):
+        self._token = current_zone.set(self.zone_id)
+        self._started = time.monotonic()
+        MESSAGES_IN_FLIGHT.inc()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            outcome = "success"
+        elif issubclass(exc_type, self.invalid_errors):
+            outcome = "invalid"
+        else:
+            outcome = "error"
+        MESSAGES_IN_FLIGHT.dec()
+        MESSAGES.labels(zone=self.zone_id, outcome=outcome).inc()
+        STAGE_LATENCY.labels(stage="total", zone=self.zone_id, outcome=outcome).observe(
+            time.monotonic() - self._started
+        )
+        current_zone.reset(self._token)
+        return False
+
+
+def stage_timer(stage, zone_id=None):
+    return _StageTimer(stage, zone_id)
+
+
+def track_message(zone_id, invalid_errors=()):
+    return _MessageTracker(zone_id, invalid_errors)
+
+
+def count_prefilter_decision(decision, zone_id=None):
+    PREFILTER_DECISIONS.labels(zone=zone_id or current_zone.get(), decision=decision).inc()
+
+
+def count_model_route(tier, zone_id=None):
+    MODEL_ROUTES.labels(zone=zone_id or current_zone.get(), tier=tier).inc()
+
+
+def observe_time_to_alert(severity, seconds, path, zone_id=None):
+    """path is "early" for incidents persisted from a streamed response, "report" for the rest."""
+    TIME_TO_ALERT.labels(zone=zone_id or current_zone.get(), severity=severity, path=path).observe(seconds)
+
+
+def count_tokens(profile, model, usage_metadata):
+    """Count the prompt, cached and output tokens of one Gemini call."""
+    for kind, count in (
+        ("prompt", usage_metadata.prompt_token_count),
+        ("cached", usage_metadata.cached_content_token_count),
+        ("output", usage_metadata.candidates_token_count),
+    ):
+        if count:
+            GEMINI_TOKENS.labels(profile=profile, model=model, kind=kind).inc(count)
+    # Prompt tokens by modality, which shows what the video itself costs
+    for detail in getattr(usage_metadata, "prompt_tokens_details", None) or []:
+        if detail.token_count and detail.modality is not None:
+            modality = getattr(detail.modality, "name", str(detail.modality)).lower()
+            GEMINI_TOKENS.labels(profile=profile, model=model, kind=f"prompt_{modality}").inc(detail.token_count)
+
+
+def render_metrics():
+    """Return (body, content_type) for a Prometheus /metrics response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,129 @@
+"""
+Risk-adaptive choice of the Gemini model that analyses a clip.
+
+Each message is routed to a model tier from the zone's configured
+criticality, its recent bottleneck index and the severity of its active
+aggregated incidents: quiet zones get the lite model, zones with active
+high-severity incidents the strongest one, everything else the standard
+model. Zone criticality is read from MODEL_ROUTING_PATH:
+
+    {"default_criticality": "normal", "zones": {"Main Stage": "critical"}}
+
+with criticality one of "low", "normal", "high" or "critical".
+"""
+import os
+import json
+import time
+import logging
+import threading
+from utils.gemini_segmentation import GEMINI_MODEL
+
+logger = logging.getLogger(__name__)
+
+MODEL_ROUTING_ENABLED = os.environ.get("MODEL_ROUTING_ENABLED", "true").lower() == "true"
+MODEL_ROUTING_PATH = os.environ.get("MODEL_ROUTING_PATH", "config/model_routing.json")
+
+TIER_LITE = "lite"
+TIER_STANDARD = "standard"
+TIER_PRO = "pro"
+TIER_MODELS = {
+    TIER_LITE: os.environ.get("GEMINI_LITE_MODEL", "gemini-2.5-flash-lite"),
+    TIER_STANDARD: os.environ.get("GEMINI_STANDARD_MODEL", GEMINI_MODEL),
+    TIER_PRO: os.environ.get("GEMINI_PRO_MODEL", "gemini-2.5-pro"),
+}
+
+# Recent bottleneck index at or above which a zone is considered congested, and below which quiet
+BOTTLENECK_HIGH = float(os.environ.get("ROUTING_BOTTLENECK_HIGH", "0.6"))
+BOTTLENECK_LOW = float(os.environ.get("ROUTING_BOTTLENECK_LOW", "0.2"))
+# How long a zone's last bottleneck readings count as recent
+BOTTLENECK_WINDOW = float(os.environ.get("ROUTING_BOTTLENECK_WINDOW", "900"))
+# Weight of the newest reading in a zone's moving average
+BOTTLENECK_SMOOTHING = float(os.environ.get("ROUTING_BOTTLENECK_SMOOTHING", "0.3"))
+
+
+def _load_criticality(path=MODEL_ROUTING_PATH):
+    if not os.path.exists(path):
+        return "normal", {}
+    try:
+        with open(path) as f:
+            config = json.load(f)
+        return config.get("default_criticality", "normal"), config.get("zones", {})
+    except Exception as e:
+        logger.error(f"Ignoring invalid model routing config in {path}: {str(e)}")
+        return "normal", {}
+
+
+DEFAULT_CRITICALITY, ZONE_CRITICALITY = _load_criticality()
+
+
+def zone_criticality(zone_id):
+    return ZONE_CRITICALITY.get(zone_id, DEFAULT_CRITICALITY)
+
+
+class BottleneckTracker:
+    """Exponential moving average of each zone's bottleneck index over the messages this instance processed."""
+
+    def __init__(self, window=BOTTLENECK_WINDOW, smoothing=BOTTLENECK_SMOOTHING):
+        self.window = window
+        self.smoothing = smoothing
+        self._zones = {}  # zone_id -> (average, last update)
+        self._lock = threading.Lock()
+
+    def record(self, zone_id, bottle_neck_index):
+        now = time.monotonic()
+        with self._lock:
+            previous = self._zones.get(zone_id)
+            if previous is None or now - previous[1] > self.window:
+                average = bottle_neck_index
+            else:
+                average = self.smoothing * bottle_neck_index + (1 - self.smoothing) * previous[0]
+            self._zones[zone_id] = (average, now)
+
+    def recent(self, zone_id):
+        """The zone's recent bottleneck index, or None if there is no recent reading."""
+        with self._lock:
+            entry = self._zones.get(zone_id)
+        if entry is None or time.monotonic() - entry[1] > self.window:
+            return None
+        return entry[0]
+
+
+bottleneck_tracker = BottleneckTracker()
+
+
+def route_model(zone_id, risk, activity=None):
+    """
+    Pick the model tier for a clip from zone_id.
+
+    risk is the highest severity among the zone's active incidents (see
+    prefilter.zone_risk) and activity the pre-filter's decision, if it ran.
+    Returns the tier, its model and the reason, for recording on the
+    analysis report.
+    """
+    criticality = zone_criticality(zone_id)
+    bottleneck = bottleneck_tracker.recent(zone_id)
+    congested = bottleneck is not None and bottleneck >= BOTTLENECK_HIGH
+    # Quiet by the pre-filter's reading of the clip, or by the zone's recent history
+    quiet = not congested and (
+        activity == "light" or (activity != "full" and bottleneck is not None and bottleneck < BOTTLENECK_LOW)
+    )
+
+    if not MODEL_ROUTING_ENABLED:
+        tier, reason = TIER_STANDARD, "routing disabled"
+    elif risk in ("high", "critical"):
+        tier, reason = TIER_PRO, f"zone has active {risk} severity incidents"
+    elif criticality == "critical" and (congested or risk == "medium"):
+        tier, reason = TIER_PRO, "critical zone under load"
+    elif criticality in ("low", "normal") and risk in ("none", "low") and quiet:
+        tier, reason = TIER_LITE, "quiet zone"
+    else:
+        tier, reason = TIER_STANDARD, f"{criticality} criticality zone"
+
+    return {
+        "tier": tier,
+        "model": TIER_MODELS[tier],
+        "reason": reason,
+        "zone_criticality": criticality,
+        "recent_bottle_neck_index": bottleneck,
+        "zone_risk": risk,
+    }
@@ -0,0 +1,187 @@
+"""
+The ingestion pipeline's decisions, shared by main.py and asgi_main.py.
+
+The Flask service runs the stages on a thread pool and the ASGI service on
+the event loop, so each entry point keeps its own I/O: calling the stages
+with their timeouts and reading and writing the ledger, Firestore and
+BigQuery. What happens in between (how a clip is analysed, when a message
+can be skipped or resumed, and what gets written) is decided here, so the
+two services can't drift apart.
+"""
+import os
+import logging
+from typing import NamedTuple
+from utils.model_routing import route_model, bottleneck_tracker
+from utils.prefilter import PREFILTER_ENABLED, decide, skip_possible
+from utils.sampling import sampling_profile_for
+from utils.incident_profiles import incident_types_for
+from utils.message_records import build_incidents, build_analysis_report, calculate_bottle_neck_index, build_vision_row
+from utils.metrics import count_prefilter_decision, count_model_route
+from utils.idempotency import STAGE_ANALYSIS, STAGE_BIGQUERY
+from utils.log_sampling import log_sampled
+
+logger = logging.getLogger(__name__)
+
+FACE_DETECTION_TIMEOUT = float(os.environ.get("FACE_DETECTION_TIMEOUT", "30"))
+VIDEO_ANALYSIS_TIMEOUT = float(os.environ.get("VIDEO_ANALYSIS_TIMEOUT", "240"))
+MOTION_ENERGY_TIMEOUT = float(os.environ.get("MOTION_ENERGY_TIMEOUT", "20"))
+
+
+class AnalysisIncomplete(Exception):
+    """
+    The video analysis failed or timed out.
+
+    Nothing is recorded for the message, so raising this fails it back to
+    Pub/Sub and a redelivery analyses the clip again, rather than the
+    ledger keeping an empty analysis that every redelivery would reuse.
+    """
+
+
+def require_analysis(message_data, analysis_results):
+    """Raise AnalysisIncomplete if analysis_results is None, i.e. the video analysis didn't complete."""
+    if analysis_results is None:
+        raise AnalysisIncomplete(f"Video analysis of {message_data.get('video_uri')} did not complete")
+
+
+def analysis_options(message_data) -> dict:
+    """Keyword arguments for analysing the clip of message_data, besides the model."""
+    zone_id = message_data.get('zone_id')
+    return {
+        # Long clips are analysed in parallel windows; the publisher may pass the clip length
+        "duration": message_data.get('video_duration'),
+        "profile": sampling_profile_for(zone_id, message_data.get('camera_id')),
+        # Only the incident types that can occur in the zone are assessed
+        "incident_types": incident_types_for(zone_id),
+    }
+
+
+def gate_on_prefilter(message_data, risk) -> bool:
+    """
+    Whether the video analysis waits for the pre-filter's decision.
+
+    Only when the pre-filter is enabled and could skip the clip (see
+    skip_possible); otherwise face detection and video analysis run side by
+    side.
+    """
+    return bool(PREFILTER_ENABLED and message_data.get('video_uri') and skip_possible(message_data, risk))
+
+
+def route_video(video_uri, zone_id, risk, activity=None) -> dict:
+    """The model tier route_model() picks for the clip, counted and logged."""
+    routing = route_model(zone_id, risk, activity=activity)
+    count_model_route(routing["tier"])
+    log_sampled(logger, "Routed video", video_uri=video_uri, tier=routing['tier'], reason=routing['reason'])
+    return routing
+
+
+def prefilter_decision(video_uri, faces_count, motion, risk) -> dict:
+    """decide() for the clip, counted and logged."""
+    prefilter = decide(faces_count, motion, risk)
+    count_prefilter_decision(prefilter["decision"])
+    log_sampled(
+        logger, "Pre-filter decision", video_uri=video_uri, decision=prefilter['decision'],
+        reason=prefilter['reason'],
+    )
+    return prefilter
+
+
+def faces_from(faces_count_results, image_uri):
+    """The face count of a counting backend result, or None if detection failed."""
+    if not faces_count_results.get("success", False):
+        return None
+    faces_count = faces_count_results.get("total_faces", 0)
+    log_sampled(logger, "Face detection completed", image_uri=image_uri, total_faces=faces_count)
+    return faces_count
+
+
+def already_processed(ledger_key, completed_stages) -> bool:
+    """Whether the ledger shows the message done; logs where a redelivery resumes otherwise."""
+    if STAGE_BIGQUERY in completed_stages:
+        logger.info(f"Message {ledger_key} was already processed, skipping")
+        return True
+    if completed_stages:
+        logger.info(f"Resuming message {ledger_key} after stages: {sorted(completed_stages)}")
+    return False
+
+
+def recorded_analysis(completed_stages):
+    """(faces_count, analysis_results, prefilter, routing) from the ledger, or None if not recorded."""
+    recorded = completed_stages.get(STAGE_ANALYSIS)
+    if recorded is None:
+        return None
+    return recorded["faces_count"], recorded["analysis_results"], recorded.get("prefilter"), recorded.get("routing")
+
+
+def analysis_record(faces_count, analysis_results, prefilter, routing) -> dict:
+    """The ledger value of the analysis stage, as recorded_analysis reads it back."""
+    return {
+        "faces_count": faces_count,
+        "analysis_results": analysis_results,
+        "prefilter": prefilter,
+        "routing": routing,
+    }
+
+
+def active_incidents_query(db, zone_id):
+    """Query for the active aggregated incidents of zone_id, on a sync or async Firestore client."""
+    return db.collection('aggregrated_incidents').where('zone_id', '==', zone_id).where('status', '==', 'active')
+
+
+def incident_types_of(snapshots) -> set:
+    return {snapshot.to_dict().get('type') for snapshot in snapshots}
+
+
+def indexed_active_types(active_index, zone_id):
+    """Active incident types in zone_id from active_index, or None if there is none or it isn't ready."""
+    if active_index is None:
+        return None
+    active_types = active_index.active_types(zone_id)
+    if active_types is None:
+        logger.warning("Active incident index not ready, querying Firestore")
+    return active_types
+
+
+def current_active_types(active_index, zone_id, looked_up):
+    """
+    Active incident types in zone_id for the dedup once the analysis is done.
+
+    The index's current view when it is ready, which includes incidents
+    other messages wrote while this one was analysed; otherwise looked_up,
+    the types found when the message started, rather than another query.
+    """
+    if active_index is not None:
+        active_types = active_index.active_types(zone_id)
+        if active_types is not None:
+            return active_types
+    return looked_up
+
+
+class MessageResults(NamedTuple):
+    """Everything one message writes: Firestore documents and its BigQuery row."""
+    incidents: list
+    report: dict
+    aggregated_incidents: list
+    rows: list
+
+
+def build_message_results(message_data, faces_count, analysis_results, prefilter, routing, active_types,
+                          early_aggregated=()) -> MessageResults:
+    """
+    Build the documents and row of one analysed message.
+
+    Only incident types not already in active_types go to
+    'aggregrated_incidents'; those the early incident writer put there for
+    this message (early_aggregated) are rewritten with the final assessment.
+    The message's congestion is fed into routing of its zone's next clips.
+    """
+    incidents = build_incidents(message_data, analysis_results)
+    report = build_analysis_report(message_data, analysis_results, prefilter, routing)
+    bottle_neck_index = calculate_bottle_neck_index(report)
+    if analysis_results:
+        bottleneck_tracker.record(message_data.get('zone_id'), bottle_neck_index)
+    aggregated_incidents = [
+        incident for incident in incidents
+        if incident.get('type') not in active_types or incident.get('type') in early_aggregated
+    ]
+    rows = [build_vision_row(message_data, faces_count, bottle_neck_index)]
+    return MessageResults(incidents, report, aggregated_incidents, rows)
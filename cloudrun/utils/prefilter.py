@@ -0,0 +1,130 @@
+import os
+import logging
+import tempfile
+from typing import Optional
+from utils.clients import get_storage_client
+from utils.gemini_segmentation import SEVERITY_MAPPING
+from utils.metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+PREFILTER_ENABLED = os.environ.get("PREFILTER_ENABLED", "true").lower() == "true"
+# At or above this many faces a clip always gets the full model
+PREFILTER_FULL_FACES = int(os.environ.get("PREFILTER_FULL_FACES", "10"))
+# Mean frame difference (0-1) below which a clip with no faces is considered static
+PREFILTER_SKIP_MOTION = float(os.environ.get("PREFILTER_SKIP_MOTION", "0.02"))
+# Mean frame difference (0-1) at or above which a clip always gets the full model
+PREFILTER_FULL_MOTION = float(os.environ.get("PREFILTER_FULL_MOTION", "0.15"))
+# Computing motion energy downloads the clip, so it is off unless the publisher can't supply it
+PREFILTER_MOTION_ENABLED = os.environ.get("PREFILTER_MOTION_ENABLED", "false").lower() == "true"
+PREFILTER_MOTION_FRAMES = int(os.environ.get("PREFILTER_MOTION_FRAMES", "8"))
+
+DECISION_SKIP = "skip"
+DECISION_LIGHT = "light"
+DECISION_FULL = "full"
+
+SEVERITY_ORDER = ["none", "low", "medium", "high", "critical"]
+
+
+def zone_risk(active_types) -> str:
+    """Highest severity among the incident types active in a zone, or 'none'."""
+    severities = [SEVERITY_MAPPING.get(incident_type, "none") for incident_type in active_types or ()]
+    return max(severities, key=SEVERITY_ORDER.index, default="none")
+
+
+def motion_energy(message_data, timeout=60) -> Optional[float]:
+    """
+    Motion energy of a clip, from 0.0 (static) to 1.0.
+
+    Taken from the message's 'motion_energy' attribute when the publisher
+    supplies one; otherwise computed from frame differences if
+    PREFILTER_MOTION_ENABLED is set, giving up on the download after
+    timeout seconds. Returns None when it isn't known.
+    """
+    if message_data.get('motion_energy') is not None:
+        try:
+            return float(message_data['motion_energy'])
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid motion_energy: {message_data['motion_energy']}")
+    video_uri = message_data.get('video_uri')
+    if not PREFILTER_MOTION_ENABLED or not video_uri or not video_uri.startswith("gs://"):
+        return None
+    try:
+        with stage_timer("motion_energy"):
+            return compute_motion_energy(video_uri, timeout=timeout)
+    except Exception as e:
+        logger.warning(f"Motion energy failed for {video_uri}: {str(e)}")
+        return None
+
+
+def compute_motion_energy(gcs_uri, frames=PREFILTER_MOTION_FRAMES, timeout=60) -> Optional[float]:
+    """Mean absolute difference between evenly spaced, downscaled grayscale frames of gcs_uri."""
+    import cv2
+    import numpy as np
+
+    bucket_name, _, blob_name = gcs_uri[len("gs://"):].partition("/")
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as video_file:
+        get_storage_client().bucket(bucket_name).blob(blob_name).download_to_filename(video_file.name, timeout=timeout)
+        capture = cv2.VideoCapture(video_file.name)
+        try:
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            if frame_count < 2:
+                return None
+            samples = []
+            for index in np.linspace(0, frame_count - 1, num=min(frames, frame_count), dtype=int):
+                capture.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+                ok, frame = capture.read()
+                if ok:
+                    gray = cv2.cvtColor(cv2.resize(frame, (160, 90)), cv2.COLOR_BGR2GRAY)
+                    samples.append(gray.astype(np.float32))
+        finally:
+            capture.release()
+    if len(samples) < 2:
+        return None
+    differences = [np.mean(np.abs(b - a)) / 255.0 for a, b in zip(samples, samples[1:])]
+    return float(np.mean(differences))
+
+
+def skip_possible(message_data, risk) -> bool:
+    """
+    Whether decide() could skip the clip of message_data.
+
+    Only a clip whose motion energy is known, in a zone without active
+    incidents, can be skipped. For any other clip, waiting for face
+    detection before starting the analysis would only add latency.
+    """
+    if risk != "none":
+        return False
+    return message_data.get('motion_energy') is not None or PREFILTER_MOTION_ENABLED
+
+
+def decide(faces_count, motion, risk) -> dict:
+    """
+    Decide how much analysis a clip needs from cheap signals.
+
+    faces_count and motion are None when unknown; unknown signals never lead
+    to a skip. Returns the decision ('skip', 'light' or 'full'), the reason
+    and the signals it was based on, for recording alongside the analysis.
+    Which model analyses a clip that isn't skipped is up to
+    model_routing.route_model, which takes the decision into account.
+    """
+    if risk in ("high", "critical"):
+        decision, reason = DECISION_FULL, f"zone has active {risk} severity incidents"
+    elif faces_count is None:
+        decision, reason = DECISION_FULL, "face count unavailable"
+    elif faces_count >= PREFILTER_FULL_FACES:
+        decision, reason = DECISION_FULL, f"{faces_count} faces"
+    elif motion is not None and motion >= PREFILTER_FULL_MOTION:
+        decision, reason = DECISION_FULL, f"motion energy {motion:.3f}"
+    elif faces_count == 0 and motion is not None and motion < PREFILTER_SKIP_MOTION and risk == "none":
+        decision, reason = DECISION_SKIP, "no faces, no motion and no active incidents"
+    else:
+        decision, reason = DECISION_LIGHT, "low activity"
+
+    return {
+        "decision": decision,
+        "reason": reason,
+        "faces_count": faces_count,
+        "motion_energy": motion,
+        "zone_risk": risk,
+    }
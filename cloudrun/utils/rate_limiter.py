@@ -0,0 +1,244 @@
+"""
+Process-wide adaptive rate limiting for Vertex AI and Vision API calls.
+
+Each API (or model) gets one token bucket shared by every request thread and
+coroutine in the process. The bucket's rate adapts AIMD-style: it creeps up
+additively while calls succeed and is cut multiplicatively when the API
+answers 429 / RESOURCE_EXHAUSTED, so throughput settles just under the quota
+instead of bursting into it and oscillating. Throttled calls are retried in
+the request with jittered exponential backoff rather than failing the
+message and having Pub/Sub redeliver it into the same exhausted quota.
+A call with a deadline gives up, without calling the API, as soon as waiting
+for a token or a retry would take it past the deadline.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from utils.metrics import RATE_LIMIT_RATE, RATE_LIMIT_THROTTLED, RATE_LIMIT_RETRIES, RATE_LIMIT_WAIT
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Requests per second each limiter starts at, and the bounds it adapts within
+RATE_LIMIT_INITIAL_RATE = float(os.environ.get("RATE_LIMIT_INITIAL_RATE", "5"))
+RATE_LIMIT_MIN_RATE = float(os.environ.get("RATE_LIMIT_MIN_RATE", "0.2"))
+RATE_LIMIT_MAX_RATE = float(os.environ.get("RATE_LIMIT_MAX_RATE", "50"))
+# Per-limiter overrides, e.g. {"vision": {"initial_rate": 20, "max_rate": 100}}
+RATE_LIMIT_OVERRIDES = json.loads(os.environ.get("RATE_LIMITS", "{}"))
+# Requests/second gained per second of successful calls, and the factor applied on a 429
+RATE_LIMIT_INCREASE = float(os.environ.get("RATE_LIMIT_INCREASE", "0.5"))
+RATE_LIMIT_DECREASE = float(os.environ.get("RATE_LIMIT_DECREASE", "0.5"))
+# 429s within this many seconds of a cut are the same overload and don't cut again
+RATE_LIMIT_DECREASE_COOLDOWN = float(os.environ.get("RATE_LIMIT_DECREASE_COOLDOWN", "2"))
+RATE_LIMIT_MAX_ATTEMPTS = int(os.environ.get("RATE_LIMIT_MAX_ATTEMPTS", "5"))
+RATE_LIMIT_BACKOFF_BASE = float(os.environ.get("RATE_LIMIT_BACKOFF_BASE", "1"))
+RATE_LIMIT_BACKOFF_CAP = float(os.environ.get("RATE_LIMIT_BACKOFF_CAP", "30"))
+
+
+class CallAbandoned(TimeoutError):
+    """Raised instead of making a call whose caller's deadline would pass, or who cancelled, while it waited."""
+
+
+def time_left(deadline):
+    """Seconds until deadline (a time.monotonic() value), at least 0; None without a deadline."""
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def is_rate_limited(error):
+    """Whether error is a 429 / RESOURCE_EXHAUSTED from google-api-core, gRPC or google-genai."""
+    code = getattr(error, "code", None)
+    if callable(code):
+        # grpc.RpcError exposes its status code through a method
+        code = code()
+    if code == 429 or getattr(code, "name", None) == "RESOURCE_EXHAUSTED":
+        return True
+    return getattr(error, "status", None) == "RESOURCE_EXHAUSTED"
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket with an AIMD-adapted rate, safe to share across threads and event loops.
+
+    acquire() reserves a token and sleeps until it is due, so waiting callers
+    are served in order at the current rate. A caller whose token wouldn't be
+    due before its deadline, or who is cancelled while waiting, gives the
+    token back and gets CallAbandoned. Report each call's outcome with
+    on_success() or on_throttled().
+    """
+
+    def __init__(self, name, initial_rate=RATE_LIMIT_INITIAL_RATE, min_rate=RATE_LIMIT_MIN_RATE,
+                 max_rate=RATE_LIMIT_MAX_RATE, burst=None):
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = initial_rate
+        self.burst = burst if burst is not None else max(1.0, initial_rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        RATE_LIMIT_RATE.labels(limiter=name).set(self.rate)
+
+    def _reserve(self, deadline=None):
+        """
+        Take a token, possibly going into debt; return how long to wait before using it.
+
+        Raises CallAbandoned, without taking the token, if it wouldn't be due before deadline.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise CallAbandoned(f"No {self.name} token before the deadline, {wait:.1f}s away")
+            self._tokens -= 1
+        RATE_LIMIT_WAIT.labels(limiter=self.name).observe(wait)
+        return wait
+
+    def _release(self):
+        """Give back a reserved token that won't be used."""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def acquire(self, deadline=None, cancelled=None):
+        """
+        Wait for a token.
+
+        Raises CallAbandoned if the token wouldn't be due before deadline
+        (a time.monotonic() value), or if cancelled (a threading.Event) is
+        set while waiting.
+        """
+        wait = self._reserve(deadline)
+        if wait <= 0:
+            return
+        if cancelled is None:
+            time.sleep(wait)
+        elif cancelled.wait(wait):
+            self._release()
+            raise CallAbandoned(f"Cancelled while waiting for a {self.name} token")
+
+    async def acquire_async(self, deadline=None):
+        """Async variant of acquire; cancelling the task gives the token back."""
+        wait = self._reserve(deadline)
+        if wait <= 0:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self._release()
+            raise
+
+    def on_success(self):
+        with self._lock:
+            # Spread over the calls of one second, this adds RATE_LIMIT_INCREASE per second
+            self.rate = min(self.max_rate, self.rate + RATE_LIMIT_INCREASE / self.rate)
+            rate = self.rate
+        RATE_LIMIT_RATE.labels(limiter=self.name).set(rate)
+
+    def on_throttled(self):
+        RATE_LIMIT_THROTTLED.labels(limiter=self.name).inc()
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < RATE_LIMIT_DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * RATE_LIMIT_DECREASE)
+            # Drop any saved-up burst so the lower rate takes effect at once
+            self._tokens = min(self._tokens, 0.0)
+            rate = self.rate
+        RATE_LIMIT_RATE.labels(limiter=self.name).set(rate)
+        logger.warning(f"Rate limiter {self.name} throttled, rate cut to {rate:.2f}/s")
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """The process-wide limiter for name, e.g. 'vision' or 'gemini:<model>'."""
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                limiter = AdaptiveRateLimiter(name, **RATE_LIMIT_OVERRIDES.get(name, {}))
+                _limiters[name] = limiter
+    return limiter
+
+
+def _backoff(attempt):
+    # Full jitter: spreads retries from many callers instead of synchronising them
+    return random.uniform(0, min(RATE_LIMIT_BACKOFF_CAP, RATE_LIMIT_BACKOFF_BASE * 2 ** attempt))
+
+
+def _retry_after(name, attempt, deadline):
+    """The backoff before retry attempt + 1 of a call, or None if the call should give up instead."""
+    if attempt == RATE_LIMIT_MAX_ATTEMPTS - 1:
+        return None
+    backoff = _backoff(attempt)
+    if deadline is not None and time.monotonic() + backoff > deadline:
+        logger.warning(f"Not retrying throttled {name} call, its deadline is {time_left(deadline):.1f}s away")
+        return None
+    RATE_LIMIT_RETRIES.labels(limiter=name).inc()
+    return backoff
+
+
+def call_with_rate_limit(name, fn, *args, deadline=None, cancelled=None, **kwargs):
+    """
+    Call fn through the limiter for name, retrying 429s with jittered backoff.
+
+    Errors other than rate limiting, and the last 429 after
+    RATE_LIMIT_MAX_ATTEMPTS or when the backoff would pass deadline (a
+    time.monotonic() value), are raised to the caller. CallAbandoned is
+    raised if no token is due before deadline, or once cancelled (a
+    threading.Event) is set while waiting. fn is called again for each
+    attempt, so it can size its request timeout with time_left(deadline).
+    """
+    if not RATE_LIMIT_ENABLED:
+        return fn(*args, **kwargs)
+    limiter = get_limiter(name)
+    for attempt in range(RATE_LIMIT_MAX_ATTEMPTS):
+        limiter.acquire(deadline, cancelled)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limited(e):
+                raise
+            limiter.on_throttled()
+            backoff = _retry_after(name, attempt, deadline)
+            if backoff is None:
+                raise
+            if cancelled is None:
+                time.sleep(backoff)
+            elif cancelled.wait(backoff):
+                raise CallAbandoned(f"Cancelled while backing off from a throttled {name} call") from e
+            continue
+        limiter.on_success()
+        return result
+
+
+async def call_with_rate_limit_async(name, fn, *args, deadline=None, **kwargs):
+    """Async variant of call_with_rate_limit for a coroutine function fn; cancel the task to stop it."""
+    if not RATE_LIMIT_ENABLED:
+        return await fn(*args, **kwargs)
+    limiter = get_limiter(name)
+    for attempt in range(RATE_LIMIT_MAX_ATTEMPTS):
+        await limiter.acquire_async(deadline)
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limited(e):
+                raise
+            limiter.on_throttled()
+            backoff = _retry_after(name, attempt, deadline)
+            if backoff is None:
+                raise
+            await asyncio.sleep(backoff)
+            continue
+        limiter.on_success()
+        return result
@@ -0,0 +1,102 @@
+"""
+Per-zone and per-camera video sampling profiles.
+
+A profile sets the frame rate Gemini samples a clip at and the media
+resolution of those frames, trading temporal and spatial detail for video
+tokens. Profiles and their assignment to zones and cameras are read from
+SAMPLING_PROFILES_PATH:
+
+    {
+      "default_profile": "default",
+      "profiles": {"default": {}, "static": {"fps": 0.5, "media_resolution": "low"}},
+      "zones": {"Concourse A": "static"},
+      "cameras": {"cam-12": "default"}
+    }
+
+A camera assignment wins over its zone's. Settings left out of a profile
+keep Gemini's defaults.
+"""
+import os
+import json
+import logging
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_PROFILES_PATH = os.environ.get("SAMPLING_PROFILES_PATH", "config/sampling_profiles.json")
+
+MEDIA_RESOLUTIONS = {
+    "low": "MEDIA_RESOLUTION_LOW",
+    "medium": "MEDIA_RESOLUTION_MEDIUM",
+    "high": "MEDIA_RESOLUTION_HIGH",
+}
+
+
+class SamplingProfile(NamedTuple):
+    name: str
+    fps: Optional[float] = None
+    media_resolution: Optional[str] = None
+
+    def cache_variant(self) -> str:
+        """Identifies the sampling settings in analysis cache keys."""
+        return f"fps={self.fps}|resolution={self.media_resolution}"
+
+
+DEFAULT_PROFILE = SamplingProfile("default")
+
+
+def _parse_profile(name, settings) -> SamplingProfile:
+    media_resolution = settings.get("media_resolution")
+    if media_resolution is not None and media_resolution not in MEDIA_RESOLUTIONS:
+        raise ValueError(f"Sampling profile {name}: unknown media_resolution {media_resolution}")
+    fps = settings.get("fps")
+    return SamplingProfile(name, float(fps) if fps is not None else None, media_resolution)
+
+
+class SamplingConfig:
+    """Sampling profiles and which zones and cameras use them."""
+
+    def __init__(self, profiles=None, zones=None, cameras=None, default_profile="default"):
+        self.profiles = {"default": DEFAULT_PROFILE}
+        self.profiles.update(profiles or {})
+        self.zones = zones or {}
+        self.cameras = cameras or {}
+        self.default_profile = default_profile
+
+    @classmethod
+    def load(cls, path=SAMPLING_PROFILES_PATH):
+        """Read the config at path; a missing or invalid file leaves every clip on Gemini's defaults."""
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path) as f:
+                config = json.load(f)
+            profiles = {
+                name: _parse_profile(name, settings)
+                for name, settings in config.get("profiles", {}).items()
+            }
+            return cls(
+                profiles,
+                config.get("zones"),
+                config.get("cameras"),
+                config.get("default_profile", "default"),
+            )
+        except Exception as e:
+            logger.error(f"Ignoring invalid sampling profiles in {path}: {str(e)}")
+            return cls()
+
+    def profile_for(self, zone_id=None, camera_id=None) -> SamplingProfile:
+        """The profile for a clip from camera_id in zone_id."""
+        name = self.cameras.get(camera_id) or self.zones.get(zone_id) or self.default_profile
+        profile = self.profiles.get(name)
+        if profile is None:
+            logger.warning(f"Unknown sampling profile {name}, using the default")
+            return DEFAULT_PROFILE
+        return profile
+
+
+sampling_config = SamplingConfig.load()
+
+
+def sampling_profile_for(zone_id=None, camera_id=None) -> SamplingProfile:
+    return sampling_config.profile_for(zone_id, camera_id)
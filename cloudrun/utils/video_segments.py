@@ -0,0 +1,125 @@
+"""
+Splitting long clips into overlapping windows and merging the per-window analyses.
+"""
+import os
+import math
+
+SEGMENTED_ANALYSIS_ENABLED = os.environ.get("SEGMENTED_ANALYSIS_ENABLED", "true").lower() == "true"
+# Clips at least this long (seconds) are analysed as concurrent windows
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", "60"))
+SEGMENT_LENGTH = float(os.environ.get("SEGMENT_LENGTH", "30"))
+# Overlap between consecutive windows, so an incident on a boundary is seen whole by one of them
+SEGMENT_OVERLAP = float(os.environ.get("SEGMENT_OVERLAP", "5"))
+# Windows are lengthened rather than exceeding this many per clip
+SEGMENT_MAX_WINDOWS = int(os.environ.get("SEGMENT_MAX_WINDOWS", "8"))
+
+
+def plan_windows(duration, length=SEGMENT_LENGTH, overlap=SEGMENT_OVERLAP, max_windows=SEGMENT_MAX_WINDOWS):
+    """
+    (start, end) offsets in seconds of the windows covering a clip of duration.
+
+    Returns a single window for clips shorter than SEGMENT_MIN_DURATION.
+    """
+    if duration < SEGMENT_MIN_DURATION or duration <= length:
+        return [(0.0, float(duration))]
+    if math.ceil((duration - overlap) / (length - overlap)) > max_windows:
+        length = (duration + overlap * (max_windows - 1)) / max_windows
+
+    windows = []
+    start = 0.0
+    while True:
+        end = min(start + length, float(duration))
+        windows.append((start, end))
+        if end >= duration:
+            return windows
+        start = end - overlap
+
+
+def shift_ranges(ranges, window):
+    """
+    Timestamp ranges of a window in clip time.
+
+    The prompt and schema ask for times relative to the start of the
+    footage Gemini was given, so a window's ranges are always offset by
+    the window's start.
+    """
+    start = window[0]
+    ranges = [r for r in ranges or [] if r.get("start") is not None and r.get("end") is not None]
+    return [{"start": r["start"] + start, "end": r["end"] + start} for r in ranges]
+
+
+def _union_ranges(ranges):
+    merged = []
+    for r in sorted(ranges, key=lambda r: r["start"]):
+        if merged and r["start"] <= merged[-1]["end"]:
+            merged[-1]["end"] = max(merged[-1]["end"], r["end"])
+        else:
+            merged.append(dict(r))
+    return merged
+
+
+def merge_window_results(windows, results):
+    """
+    Merge per-window analyses into one analysis of the whole clip.
+
+    Per incident type the maximum score wins, with that window's explanation,
+    and the timestamp ranges of all windows are moved into clip time and
+    unioned. Crowd density and normalized density take their peak, flow speed
+    its minimum (the worst bottleneck), sentiment and zone capacity their
+    mean. The overall assessment comes from the riskiest window and the
+    recommended actions are de-duplicated in order.
+    """
+    pairs = [(window, result) for window, result in zip(windows, results) if result]
+    if not pairs:
+        return {}
+    if len(pairs) == 1 and pairs[0][0][0] == 0.0:
+        return pairs[0][1]
+
+    incidents = {}
+    for window, result in pairs:
+        for incident_type, incident in (result.get("incidents") or {}).items():
+            merged = incidents.setdefault(incident_type, {"score": None, "explanation": None, "timestamps": []})
+            score = incident.get("score")
+            if score is not None and (merged["score"] is None or score > merged["score"]):
+                merged["score"] = score
+                merged["explanation"] = incident.get("explanation")
+            merged["timestamps"].extend(shift_ranges(incident.get("timestamps"), window))
+    for merged in incidents.values():
+        merged["timestamps"] = _union_ranges(merged["timestamps"])
+        if merged["score"] is None:
+            merged["score"] = 0.0
+
+    def peak(field, key, pick=max):
+        candidates = [r[field] for _, r in pairs if (r.get(field) or {}).get(key) is not None]
+        return dict(pick(candidates, key=lambda c: c[key])) if candidates else None
+
+    def mean(field, key, cast=float):
+        candidates = [r[field] for _, r in pairs if (r.get(field) or {}).get(key) is not None]
+        if not candidates:
+            return None
+        return {
+            key: cast(sum(c[key] for c in candidates) / len(candidates)),
+            "explanation": candidates[0].get("explanation"),
+        }
+
+    riskiest = max(
+        (r for _, r in pairs),
+        key=lambda r: max((i.get("score") or 0.0 for i in (r.get("incidents") or {}).values()), default=0.0),
+    )
+    recommended_actions = []
+    for _, result in pairs:
+        for action in result.get("recommended_actions") or []:
+            if action not in recommended_actions:
+                recommended_actions.append(action)
+
+    return {
+        "incidents": incidents,
+        "crowd_density": peak("crowd_density", "persons_per_sq_m"),
+        "crowd_sentiment": mean("crowd_sentiment", "score"),
+        "zone_capacity": mean("zone_capacity", "estimated_capacity", cast=round),
+        "normalized_crowd_density": peak("normalized_crowd_density", "score"),
+        "normalized_flow_speed": peak("normalized_flow_speed", "score", pick=min),
+        "overall_safety_assessment": riskiest.get("overall_safety_assessment"),
+        "recommended_actions": recommended_actions,
+        "segments": [{"start": start, "end": end} for start, end in windows],
+    }
@@ -1,82 +1,279 @@
-from google.cloud import vision
+import os
+import time
+import bisect
+import asyncio
 import logging
-import re
+from utils.clients import get_vision_client, get_vision_async_client, get_storage_client
+from utils.rate_limiter import call_with_rate_limit, call_with_rate_limit_async, time_left
+from utils.log_sampling import log_sampled
+from utils.image_preprocessing import DEFAULT_MAX_EDGE, preprocess_image
 
 logger = logging.getLogger(__name__)
 
-def detect_faces_uri(uri):
-    """Detects faces in the file located in Google Cloud Storage or the web."""
+# batch_annotate_images takes at most 16 images per call
+VISION_BATCH_SIZE = min(16, int(os.environ.get("VISION_BATCH_SIZE", "16")))
+# and async_batch_annotate_images at most 2000
+VISION_ASYNC_BATCH_SIZE = 2000
+# Responses per JSON file an offline face detection job writes
+VISION_OUTPUT_BATCH_SIZE = int(os.environ.get("VISION_OUTPUT_BATCH_SIZE", "100"))
+# Include the per-face list (likelihoods and bounds of every face) in results
+FACE_DETAIL_ENABLED = os.environ.get("FACE_DETAIL_ENABLED", "false").lower() == "true"
+
+# Names of likelihood from google.cloud.vision.enums, indexed by its value
+LIKELIHOOD_NAMES = (
+    "UNKNOWN",
+    "VERY_UNLIKELY",
+    "UNLIKELY",
+    "POSSIBLE",
+    "LIKELY",
+    "VERY_LIKELY",
+)
+EMOTIONS = ("anger", "joy", "surprise", "sorrow")
+# Upper edges (px²) of the face bounding box area histogram buckets
+FACE_AREA_BUCKETS = (256, 1024, 4096, 16384, 65536)
+
+
+def _validate_uri(uri):
+    """Return an error result if uri can't be sent to the Vision API, else None."""
+    # Validate URI
+    if not uri:
+        logger.error("No image URI provided")
+        return {"success": False, "error": "No image URI provided", "total_faces": 0}
+
+    # Basic validation of URI format
+    if not (uri.startswith('gs://') or uri.startswith('http://') or uri.startswith('https://')):
+        logger.error(f"Invalid URI format: {uri}")
+        return {"success": False, "error": f"Invalid URI format: {uri}", "total_faces": 0}
+    return None
+
+
+def _face_image(uri, max_edge=None, timeout=None):
+    """
+    The Vision image to send for uri, and its scale relative to the original.
+
+    With a max_edge, a gs:// image is downsized and sent as bytes (see
+    utils.image_preprocessing); otherwise, or if that fails, Vision fetches
+    the URI itself.
+    """
+    if max_edge and uri.startswith('gs://'):
+        try:
+            data, scale = preprocess_image(uri, max_edge, timeout=timeout if timeout is not None else 60)
+            return {"content": data}, scale
+        except Exception as e:
+            logger.warning(f"Preprocessing {uri} failed, sending the URI instead: {str(e)}")
+    return {"source": {"image_uri": uri}}, 1.0
+
+
+def _face_request(image):
+    # Imported here so importing this module doesn't load the Vision library
+    from google.cloud import vision
+    return {
+        "image": image,
+        "features": [{"type_": vision.Feature.Type.FACE_DETECTION}],
+    }
+
+
+def face_area_histogram(areas):
+    """Count bounding box areas (px²) into FACE_AREA_BUCKETS; the last count is above the top edge."""
+    counts = [0] * (len(FACE_AREA_BUCKETS) + 1)
+    for area in areas:
+        counts[bisect.bisect_left(FACE_AREA_BUCKETS, area)] += 1
+    return counts
+
+
+def _box_area(vertices):
+    xs = [vertex.x for vertex in vertices]
+    ys = [vertex.y for vertex in vertices]
+    return (max(xs) - min(xs)) * (max(ys) - min(ys)) if xs else 0
+
+
+def _face_detail(face, scale=1.0):
+    face_data = {
+        emotion: LIKELIHOOD_NAMES[getattr(face, f"{emotion}_likelihood")]
+        for emotion in EMOTIONS
+    }
+    face_data["bounds"] = [
+        {"x": int(round(vertex.x / scale)), "y": int(round(vertex.y / scale))}
+        for vertex in face.bounding_poly.vertices
+    ]
+    return face_data
+
+
+def _face_detection_result(response, detail=FACE_DETAIL_ENABLED, uri=None, scale=1.0):
+    """
+    Convert a Vision API face detection response into the result dict.
+
+    The result carries the face count and aggregates as arrays: 'emotions'
+    maps each emotion to the number of faces at each of LIKELIHOOD_NAMES,
+    and 'face_area_histogram' counts bounding box areas per
+    FACE_AREA_BUCKETS. The per-face 'faces' list is only built with detail.
+    Areas and bounds are in the original image's pixels, also when a
+    downsized copy at scale was sent.
+    """
+    # Check for API-level errors first
+    if response.error.message:
+        logger.error(f"Vision API returned error: {response.error.message}")
+        return {
+            "success": False,
+            "error": response.error.message,
+            "total_faces": 0
+        }
+
+    faces = response.face_annotations
+    emotions = {emotion: [0] * len(LIKELIHOOD_NAMES) for emotion in EMOTIONS}
+    areas = []
+    for face in faces:
+        for emotion in EMOTIONS:
+            emotions[emotion][getattr(face, f"{emotion}_likelihood")] += 1
+        areas.append(_box_area(face.bounding_poly.vertices) / (scale * scale))
+
+    result = {
+        "success": True,
+        "total_faces": len(faces),
+        "emotions": emotions,
+        "face_area_histogram": face_area_histogram(areas),
+    }
+    if detail:
+        result["faces"] = [_face_detail(face, scale) for face in faces]
+    log_sampled(logger, "Faces detected", uri=uri, total_faces=len(faces), emotions=emotions)
+    return result
+
+
+def detect_faces_uri(uri, detail=FACE_DETAIL_ENABLED, max_edge=DEFAULT_MAX_EDGE, timeout=None):
+    """Detects faces in the file located in Google Cloud Storage or the web, giving up on the request after timeout seconds."""
     
     try:
-        # Validate URI
-        if not uri:
-            logger.error("No image URI provided")
-            return {"success": False, "error": "No image URI provided", "total_faces": 0}
-            
-        # Basic validation of URI format
-        if not (uri.startswith('gs://') or uri.startswith('http://') or uri.startswith('https://')):
-            logger.error(f"Invalid URI format: {uri}")
-            return {"success": False, "error": f"Invalid URI format: {uri}", "total_faces": 0}
+        error_result = _validate_uri(uri)
+        if error_result:
+            return error_result
             
-        logger.info(f"Attempting face detection with URI: {uri}")
-        
-        client = vision.ImageAnnotatorClient()
-        image = vision.Image()
-        image.source.image_uri = uri
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        image, scale = _face_image(uri, max_edge, timeout)
 
-        # Log client and request details for debugging
-        logger.info(f"Vision API client initialized, sending request for image: {uri}")
+        # The pooled client keeps its channel open, so this is only the request itself;
+        # each attempt may only take the time left until the deadline
+        response = call_with_rate_limit(
+            "vision", lambda: get_vision_client().face_detection(image=image, timeout=time_left(deadline)),
+            deadline=deadline,
+        )
         
-        response = client.face_detection(image=image)
+        return _face_detection_result(response, detail, uri, scale)
         
-        # Check for API-level errors first
-        if response.error.message:
-            logger.error(f"Vision API returned error: {response.error.message}")
-            return {
-                "success": False,
-                "error": response.error.message,
-                "total_faces": 0
-            }
-            
-        faces = response.face_annotations
-        logger.info(f"Face detection request successful. Total faces detected: {len(faces)}")
-
-        # Names of likelihood from google.cloud.vision.enums
-        likelihood_name = (
-            "UNKNOWN",
-            "VERY_UNLIKELY",
-            "UNLIKELY",
-            "POSSIBLE",
-            "LIKELY",
-            "VERY_LIKELY",
-        )
-
-        face_results = []
-        for face in faces:
-            face_data = {
-                "anger": likelihood_name[face.anger_likelihood],
-                "joy": likelihood_name[face.joy_likelihood],
-                "surprise": likelihood_name[face.surprise_likelihood],
-                "sorrow": likelihood_name[face.sorrow_likelihood],
-                "bounds": [
-                    {"x": vertex.x, "y": vertex.y} 
-                    for vertex in face.bounding_poly.vertices
-                ]
-            }
-            face_results.append(face_data)
-            logger.info(f"Face detected: {face_data}")
-
+    except Exception as e:
+        logger.error(f"Error in face detection: {str(e)}")
+        # Ensure we always return total_faces key even on error
         return {
-            "success": True,
-            "total_faces": len(faces),
-            "faces": face_results
+            "success": False,
+            "error": str(e),
+            "total_faces": 0
         }
-        
+
+
+async def detect_faces_uri_async(uri, detail=FACE_DETAIL_ENABLED, max_edge=DEFAULT_MAX_EDGE):
+    """Async variant of detect_faces_uri using the shared async Vision client."""
+    try:
+        error_result = _validate_uri(uri)
+        if error_result:
+            return error_result
+
+        # Reading and resizing block, so off the event loop
+        image, scale = await asyncio.to_thread(_face_image, uri, max_edge)
+        batch_response = await call_with_rate_limit_async(
+            "vision", get_vision_async_client().batch_annotate_images, requests=[_face_request(image)],
+        )
+        return _face_detection_result(batch_response.responses[0], detail, uri, scale)
+
     except Exception as e:
         logger.error(f"Error in face detection: {str(e)}")
-        # Ensure we always return total_faces key even on error
         return {
             "success": False,
             "error": str(e),
             "total_faces": 0
         }
+
+
+def detect_faces_batch(uris, detail=FACE_DETAIL_ENABLED, max_edge=DEFAULT_MAX_EDGE):
+    """
+    Detects faces in several images with as few Vision requests as possible.
+
+    Images are sent VISION_BATCH_SIZE at a time through batch_annotate_images.
+    Returns one result per uri, in the order of uris, each shaped like
+    detect_faces_uri's. A failed request fails only the results of its own
+    images.
+    """
+    results = [_validate_uri(uri) for uri in uris]
+    pending = [index for index, result in enumerate(results) if result is None]
+    for start in range(0, len(pending), VISION_BATCH_SIZE):
+        group = pending[start:start + VISION_BATCH_SIZE]
+        try:
+            images = [_face_image(uris[index], max_edge) for index in group]
+            batch_response = call_with_rate_limit(
+                "vision", get_vision_client().batch_annotate_images,
+                requests=[_face_request(image) for image, _ in images],
+            )
+            for index, (_, scale), response in zip(group, images, batch_response.responses):
+                results[index] = _face_detection_result(response, detail, uris[index], scale)
+        except Exception as e:
+            logger.error(f"Error in batch face detection of {len(group)} images: {str(e)}")
+            for index in group:
+                results[index] = {"success": False, "error": str(e), "total_faces": 0}
+    logger.info(f"Batch face detection of {len(uris)} images in {-(-len(pending) // VISION_BATCH_SIZE)} requests")
+    return results
+
+
+def start_face_detection_job(uris, output_uri):
+    """
+    Starts offline face detection of uris, writing the responses to GCS.
+
+    For backfills: async_batch_annotate_images runs without the online
+    quota and writes JSON files of VISION_OUTPUT_BATCH_SIZE responses under
+    output_uri (a gs:// prefix). Images are split into jobs of up to
+    VISION_ASYNC_BATCH_SIZE, each writing under its own part-NNNN/ prefix.
+    Returns the names of the long-running operations; read the results with
+    read_face_detection_results(output_uri) once face_detection_jobs_done().
+    Images are always sent by URI, not preprocessed: thousands of images as
+    bytes won't fit in the job's requests.
+    """
+    uris = [uri for uri in uris if _validate_uri(uri) is None]
+    output_uri = output_uri.rstrip("/")
+    operation_names = []
+    for start in range(0, len(uris), VISION_ASYNC_BATCH_SIZE):
+        operation = call_with_rate_limit(
+            "vision", get_vision_client().async_batch_annotate_images,
+            requests=[_face_request(_face_image(uri)[0]) for uri in uris[start:start + VISION_ASYNC_BATCH_SIZE]],
+            output_config={
+                "gcs_destination": {"uri": f"{output_uri}/part-{start // VISION_ASYNC_BATCH_SIZE:04d}/"},
+                "batch_size": VISION_OUTPUT_BATCH_SIZE,
+            },
+        )
+        operation_names.append(operation.operation.name)
+    logger.info(f"Started {len(operation_names)} face detection jobs for {len(uris)} images")
+    return operation_names
+
+
+def face_detection_jobs_done(operation_names):
+    """Whether every job started by start_face_detection_job has finished; raises if one failed."""
+    operations_client = get_vision_client().transport.operations_client
+    for name in operation_names:
+        operation = operations_client.get_operation(name)
+        if not operation.done:
+            return False
+        if operation.HasField("error"):
+            raise RuntimeError(f"Face detection job {name} failed: {operation.error.message}")
+    return True
+
+
+def read_face_detection_results(output_uri, detail=FACE_DETAIL_ENABLED):
+    """{image uri: result} for every response written under output_uri by start_face_detection_job."""
+    from google.cloud import vision
+    bucket_name, _, prefix = output_uri[len("gs://"):].partition("/")
+    results = {}
+    for blob in get_storage_client().list_blobs(bucket_name, prefix=prefix.rstrip("/") + "/"):
+        if not blob.name.endswith(".json"):
+            continue
+        batch_response = vision.BatchAnnotateImagesResponse.from_json(
+            blob.download_as_text(), ignore_unknown_fields=True,
+        )
+        for response in batch_response.responses:
+            results[response.context.uri] = _face_detection_result(response, detail, response.context.uri)
+    return results
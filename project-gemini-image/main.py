@@ -4,8 +4,9 @@ import datetime
 from flask import Flask, request, jsonify
 from google.cloud import firestore
 import vertexai
-from google.genai.types import HttpOptions, Part
+from google.genai.types import HttpOptions, Part, GenerateContentConfig
 from utils.common_utils import recover_json
+from utils.context_cache import PromptCache
 from google import genai
 
 app = Flask(__name__)
@@ -217,6 +218,12 @@ Analyze this video and provide a JSON response that assesses the presence of the
     DO NOT include any text outside of the JSON structure. Return ONLY valid, parseable JSON.
  """
 
+# The prompt is static, so it is held in a Gemini cached-content entry that each
+# call references instead of resending it (see utils/context_cache.py); until the
+# entry exists, calls send the prompt inline.
+GEMINI_MODEL = "gemini-2.5-flash"
+prompt_cache = PromptCache(GEMINI_MODEL, analysis_prompt, client)
+
 def save_incident(incident_type, incident_data, zone_id, video_id, ts):
     """Saves a single incident to Firestore."""
     doc_ref = db.collection('incidents').document()
@@ -256,15 +263,19 @@ def analyze_video():
     print(f"Processing video from GCS: {gcs_uri}")
 
     try:
+        cached_content = prompt_cache.name()
+        contents = [
+            Part.from_uri(
+                file_uri=gcs_uri,
+                mime_type="video/mp4",
+            ),
+        ]
+        if cached_content is None:
+            contents.append(analysis_prompt)
         response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                Part.from_uri(
-                    file_uri=gcs_uri,
-                    mime_type="video/mp4",
-                ),
-                analysis_prompt,
-            ],
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=GenerateContentConfig(cached_content=cached_content),
         )
 
         analysis_result = recover_json(response.text)
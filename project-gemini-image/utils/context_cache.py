@@ -0,0 +1,168 @@
+import os
+import hashlib
+import logging
+import datetime
+import threading
+
+logger = logging.getLogger(__name__)
+
+# On by default; refresh() switches it off if the prompt is below the model's minimum cacheable size
+CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+# Lifetime of a cached-content entry; it is extended whenever it gets within the refresh margin
+CONTEXT_CACHE_TTL = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_REFRESH_MARGIN = int(os.environ.get("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN", "300"))
+# After a failed create, calls go out with the prompt inline for this long before trying again
+CONTEXT_CACHE_RETRY_AFTER = int(os.environ.get("GEMINI_CONTEXT_CACHE_RETRY_AFTER", "600"))
+# Smallest instruction Gemini caches (1024 tokens on Flash models; Pro models need more)
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class PromptCache:
+    """
+    A Gemini cached-content entry holding a static system instruction.
+
+    name() returns the resource name to pass as cached_content, so each
+    generate_content call carries only the per-call parts. The entry is
+    reused across instances through its display name (derived from the
+    model and instruction, so a changed prompt gets a new entry), and has
+    its TTL extended before it expires.
+
+    name() never calls the Gemini API: creating and renewing the entry is
+    done by refresh(), at warm-up or on a background thread that name()
+    starts. Until an entry exists, and if caching is disabled, name()
+    returns None and callers send the instruction inline. The instruction's
+    size is checked once with count_tokens, and caching is switched off for
+    the process if it is below min_tokens, since Gemini would reject it.
+    """
+
+    def __init__(self, model, system_instruction, client, ttl=CONTEXT_CACHE_TTL,
+                 refresh_margin=CONTEXT_CACHE_REFRESH_MARGIN, enabled=CONTEXT_CACHE_ENABLED,
+                 min_tokens=CONTEXT_CACHE_MIN_TOKENS):
+        self.model = model
+        self.system_instruction = system_instruction
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self.client = client
+
+        digest = hashlib.sha256(f"{model}\n{system_instruction}".encode("utf-8")).hexdigest()[:16]
+        self.display_name = f"prompt-{digest}"
+
+        # (name, expire_time) of the entry, replaced as a whole so readers never see half an update
+        self._entry = None
+        self._size_checked = False
+        self._retry_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def _name(self):
+        return self._entry[0] if self._entry is not None else None
+
+    def name(self):
+        """The cached-content name to reference, or None; starts a refresh when the entry is missing or due."""
+        if not self.enabled:
+            return None
+        now = _utcnow()
+        entry = self._entry
+        if entry is not None and entry[1] - now > datetime.timedelta(seconds=self.refresh_margin):
+            return entry[0]
+        self._refresh_in_background(now)
+        # An entry within the refresh margin is still usable until it expires
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        return None
+
+    def _refresh_in_background(self, now):
+        with self._lock:
+            if self._refreshing or (self._retry_at is not None and now < self._retry_at):
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="context-cache-refresh", daemon=True).start()
+
+    def refresh(self):
+        """
+        Find, create or renew the entry, calling the Gemini API.
+
+        Runs at warm-up and on the background thread name() starts, never on
+        the request path. Returns the entry's name, or None.
+        """
+        if not self.enabled:
+            return None
+        with self._refresh_lock:
+            now = _utcnow()
+            try:
+                if not self._size_checked:
+                    self._check_size()
+                    if not self.enabled:
+                        return None
+                if self._name is not None:
+                    self._renew()
+                else:
+                    self._find_or_create()
+                self._retry_at = None
+            except Exception as e:
+                logger.warning(f"Gemini context cache {self.display_name} unavailable, sending the prompt inline: {str(e)}")
+                self._retry_at = now + datetime.timedelta(seconds=CONTEXT_CACHE_RETRY_AFTER)
+            return self._name
+
+    def _check_size(self):
+        total_tokens = self.client.models.count_tokens(model=self.model, contents=self.system_instruction).total_tokens
+        self._size_checked = True
+        if total_tokens is not None and total_tokens < self.min_tokens:
+            logger.warning(
+                f"Prompt {self.display_name} is {total_tokens} tokens, below the {self.min_tokens} Gemini caches; "
+                f"context caching is off and the prompt is sent inline"
+            )
+            self.enabled = False
+
+    def _set(self, cached_content):
+        self._entry = (cached_content.name, cached_content.expire_time)
+
+    def _renew(self):
+        from google.genai.types import UpdateCachedContentConfig
+        try:
+            self._set(self.client.caches.update(
+                name=self._name,
+                config=UpdateCachedContentConfig(ttl=f"{self.ttl}s"),
+            ))
+            logger.info(f"Extended Gemini context cache {self._name} until {self._entry[1]}")
+        except Exception as e:
+            # Most likely it expired or was deleted; start over with a fresh entry
+            logger.warning(f"Failed to extend Gemini context cache {self._name}: {str(e)}")
+            self._entry = None
+            self._find_or_create()
+
+    def _find_or_create(self):
+        from google.genai.types import CreateCachedContentConfig
+        min_expire_time = _utcnow() + datetime.timedelta(seconds=self.refresh_margin)
+        for cached_content in self.client.caches.list():
+            if (cached_content.display_name == self.display_name
+                    and cached_content.expire_time and cached_content.expire_time > min_expire_time):
+                self._set(cached_content)
+                logger.info(f"Reusing Gemini context cache {self._name} until {self._entry[1]}")
+                return
+
+        self._set(self.client.caches.create(
+            model=self.model,
+            config=CreateCachedContentConfig(
+                display_name=self.display_name,
+                system_instruction=self.system_instruction,
+                ttl=f"{self.ttl}s",
+            ),
+        ))
+        logger.info(f"Created Gemini context cache {self._name} until {self._entry[1]}")